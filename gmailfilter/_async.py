@@ -0,0 +1,394 @@
+
+"""An asyncio backend, so that one process can filter many mailboxes.
+
+AsyncIMAPConnection does the same job as IMAPConnection, but on an
+AsyncIMAPClient, and yields the same Message objects. Rule tests are
+synchronous, so when a test needs a message part that hasn't been fetched,
+the message raises PartNotLoaded. AsyncRuleProcessor awaits the fetch and
+runs the tests again.
+
+Actions are synchronous too, and expect an IMAPClient-like connection.
+They are run in worker threads, with a BlockingClient that hands each call
+back to the event loop and waits for the result.
+
+"""
+
+import asyncio
+from collections import deque
+import logging
+
+from gmailfilter._asyncimap import (
+    AsyncIMAPClient,
+    IMAPError,
+)
+from gmailfilter._cache import response_key
+from gmailfilter._chunk import MessageChunk
+from gmailfilter._config import ScanOptions
+from gmailfilter._connection import (
+    IDLE_REFRESH_INTERVAL,
+    ConnectionProxy,
+    FolderCache,
+    MessageConnectionProxy,
+    chunk_description,
+    uid_chunk,
+)
+from gmailfilter._executor import BatchingActionExecutor
+from gmailfilter._message import (
+    DEFAULT_FETCH_PARTS,
+    EmailMessage as Message,
+    UID,
+)
+from gmailfilter._retest import RetestScheduler
+from gmailfilter._rules import SimpleRuleProcessor
+
+
+# How many fetches to have in flight at once on each connection:
+DEFAULT_PIPELINE_DEPTH = 4
+
+
+class PartNotLoaded(Exception):
+
+    """A test needed a message part that hasn't been fetched yet.
+
+    Await 'load' to fetch it, then run the test again.
+
+    """
+
+    def __init__(self, proxy, part_name):
+        super().__init__(part_name)
+        self.proxy = proxy
+        self.part_name = part_name
+
+    async def load(self):
+        await self.proxy.load_part(self.part_name)
+
+
+class AsyncMessageConnectionProxy(MessageConnectionProxy):
+
+    """A MessageConnectionProxy for messages from an AsyncIMAPConnection.
+
+    Missing parts can't be fetched without awaiting, so on the event loop
+    thread a missing part raises PartNotLoaded. On any other thread (where
+    actions run), it blocks until the event loop has fetched the part.
+
+    """
+
+    __slots__ = ('_loop',)
+
+    def __init__(self, connection, initial_data, loop):
+        super().__init__(connection, initial_data)
+        self._loop = loop
+
+    def get_message_part(self, part_name):
+        retrieve_key = response_key(part_name)
+        if retrieve_key not in self._data:
+            if _on_loop(self._loop):
+                raise PartNotLoaded(self, part_name)
+            asyncio.run_coroutine_threadsafe(
+                self.load_part(part_name), self._loop).result()
+        return self._data[retrieve_key]
+
+    async def load_part(self, part_name):
+        msg_uid = self._data[b'UID']
+        data = await self._connection._client.fetch([msg_uid], [part_name])
+        if msg_uid not in data:
+            raise IMAPError("Message %d no longer exists" % msg_uid)
+        self._data.update(data[msg_uid])
+
+
+def _on_loop(loop):
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+
+class BlockingClient(object):
+
+    """Make an AsyncIMAPClient look like a (blocking) IMAPClient.
+
+    Every coroutine method becomes a function that runs it on 'loop' and
+    waits for the result. Only call these from threads other than the one
+    running 'loop', or they'll wait forever.
+
+    """
+
+    # ConnectionProxy sets this. AsyncIMAPClient always uses UIDs:
+    use_uid = True
+
+    def __init__(self, client, loop):
+        self._client = client
+        self._loop = loop
+
+    def has_capability(self, capability):
+        return self._client.has_capability(capability)
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+
+        def call(*args, **kwargs):
+            return asyncio.run_coroutine_threadsafe(
+                method(*args, **kwargs), self._loop).result()
+        return call
+
+
+class AsyncIMAPConnection(object):
+
+    """An asyncio version of IMAPConnection.
+
+    Create instances with 'connect'. Fetches are pipelined: up to
+    'pipeline_depth' chunks are requested before the first one has arrived.
+
+    """
+
+    def __init__(self, client, scan_options=None,
+                 pipeline_depth=DEFAULT_PIPELINE_DEPTH):
+        self._client = client
+        self._scan_options = scan_options or ScanOptions()
+        self._pipeline_depth = pipeline_depth
+
+    @classmethod
+    async def connect(cls, server_info, scan_options=None,
+                      pipeline_depth=DEFAULT_PIPELINE_DEPTH):
+        """Connect and log in.
+
+        :raises RuntimeError: If the connection or login steps could not be
+            completed.
+
+        """
+        try:
+            client = await AsyncIMAPClient.connect(
+                server_info.host, int(server_info.port), server_info.use_ssl)
+        except (OSError, IMAPError) as e:
+            raise RuntimeError("Failed to connect: %s" % e)
+        try:
+            await client.login(server_info.username, server_info.password)
+        except IMAPError as e:
+            client.close()
+            raise RuntimeError("Failed to authenticate: %s" % e)
+        return cls(client, scan_options, pipeline_depth)
+
+    async def close(self):
+        await self._client.logout()
+
+    async def get_messages(self, fetch_parts=None, min_uid=None, search=None,
+                           folder="INBOX"):
+        """Yield a Message for every message in 'folder'.
+
+        Arguments are as for IMAPConnection.get_messages.
+
+        """
+        fetch_parts = sorted(set(fetch_parts or DEFAULT_FETCH_PARTS) | {UID})
+        await self._client.select_folder(folder)
+        criteria = list(search) if search is not None else ['ALL']
+        if min_uid is not None:
+            criteria = ['UID', '%d:*' % min_uid] + criteria
+        async for message in self._search_messages(
+                fetch_parts, criteria, min_uid or 1):
+            yield message
+
+    async def get_messages_by_uid(self, fetch_parts, uids):
+        """Yield a Message for each message in 'uids' that still exists."""
+        fetch_parts = sorted(set(fetch_parts or DEFAULT_FETCH_PARTS) | {UID})
+        logging.info("Re-testing %d messages", len(uids))
+        async for message in self._fetch_messages(fetch_parts, sorted(uids)):
+            yield message
+
+    async def watch_messages(self, fetch_parts=None, min_uid=1,
+                             idle_refresh=IDLE_REFRESH_INTERVAL,
+                             scheduler=None, before_wait=None):
+        """Yield new messages as they arrive, like
+        IMAPConnection.watch_messages.
+
+        'before_wait' may be a coroutine function.
+
+        """
+        fetch_parts = sorted(set(fetch_parts or DEFAULT_FETCH_PARTS) | {UID})
+        while True:
+            async for message in self._search_messages(
+                    fetch_parts, ['UID', '%d:*' % min_uid], min_uid):
+                min_uid = max(min_uid, message.uid() + 1)
+                yield message
+            if scheduler is not None:
+                due = scheduler.pop_due()
+                if due:
+                    async for message in self._fetch_messages(
+                            fetch_parts, sorted(due)):
+                        yield message
+            timeout = idle_refresh
+            if scheduler is not None:
+                until_retest = scheduler.seconds_until_next_retest()
+                if until_retest is not None:
+                    timeout = min(timeout, until_retest)
+            if before_wait is not None:
+                result = before_wait()
+                if asyncio.iscoroutine(result):
+                    await result
+            await self._wait_for_new_messages(timeout)
+
+    async def _wait_for_new_messages(self, timeout):
+        if not self._client.has_capability('IDLE'):
+            await asyncio.sleep(timeout)
+            await self._client.noop()
+            return True
+        return await self._client.idle_wait(timeout)
+
+    def supports_substring_search(self):
+        return not self._client.has_capability('X-GM-EXT-1')
+
+    async def _search_messages(self, fetch_parts, criteria, min_uid=1):
+        uids = [
+            uid for uid in await self._client.search(criteria)
+            if uid >= min_uid
+        ]
+        logging.info(
+            "Searching, found %d messages matching %r",
+            len(uids),
+            criteria
+        )
+        async for message in self._fetch_messages(fetch_parts, uids):
+            yield message
+
+    async def _fetch_messages(self, fetch_parts, uids):
+        """Yield a Message for every message in 'uids', in order.
+
+        Up to 'pipeline_depth' chunks are fetched at once.
+
+        """
+        loop = asyncio.get_running_loop()
+        chunks = uid_chunk(uids, self._scan_options.initial_chunk_size)
+        pending = deque()
+        try:
+            for chunk in chunks:
+                logging.info("Fetching: %s", chunk_description(chunk))
+                pending.append(asyncio.ensure_future(
+                    self._client.fetch(chunk, fetch_parts)))
+                if len(pending) < self._pipeline_depth:
+                    continue
+                for message in self._get_fetched_messages(
+                        await pending.popleft(), loop):
+                    yield message
+            while pending:
+                for message in self._get_fetched_messages(
+                        await pending.popleft(), loop):
+                    yield message
+        finally:
+            for fetch in pending:
+                fetch.cancel()
+
+    def _get_fetched_messages(self, data, loop):
+        chunk = MessageChunk(data[msg_uid] for msg_uid in sorted(data))
+        # Don't keep the response alive while the chunk is processed:
+        del data
+        for record in chunk:
+            yield Message(AsyncMessageConnectionProxy(self, record, loop))
+
+    def get_connection_proxy(self):
+        """Get a connection for actions, which must run in another thread."""
+        client = BlockingClient(self._client, asyncio.get_running_loop())
+        return ConnectionProxy(client, FolderCache(client))
+
+
+class AsyncRuleProcessor(object):
+
+    """Run rules on messages from an AsyncIMAPConnection.
+
+    Tests are run on the event loop. If a test needs a part that hasn't been
+    fetched yet, it is fetched and all the tests are run again. Actions are
+    run with a BatchingActionExecutor in a worker thread.
+
+    Create instances with 'create'.
+
+    """
+
+    def __init__(self, rule_processor):
+        self._processor = rule_processor
+
+    @classmethod
+    async def create(cls, ruleset, connection, scheduler=None):
+        connection_proxy = connection.get_connection_proxy()
+        # Actions may talk to the server while they're prepared:
+        processor = await asyncio.to_thread(
+            SimpleRuleProcessor,
+            ruleset,
+            connection_proxy,
+            scheduler,
+            BatchingActionExecutor(connection_proxy)
+        )
+        return cls(processor)
+
+    async def process_message(self, message):
+        while True:
+            try:
+                actions, retest_at = self._processor.match(message)
+                break
+            except PartNotLoaded as e:
+                await e.load()
+        if actions is None:
+            self._processor.apply(message, actions, retest_at)
+        else:
+            await asyncio.to_thread(
+                self._processor.apply, message, actions, retest_at)
+
+    async def flush(self):
+        await asyncio.to_thread(self._processor.flush)
+
+
+async def filter_mailbox(server_info, rulesets, daemon=False, search=True,
+                         scan_options=None):
+    """Run 'rulesets' over the account in 'server_info'.
+
+    'rulesets' is a dictionary mapping folder names to RuleSets, as returned
+    by load_folder_rules. The folders are filtered concurrently, each on its
+    own connection. This is the asyncio equivalent of a plain gmailfilter
+    run (with '--daemon', if 'daemon' is set, in which case the inbox is
+    watched for new messages). Many calls can run at once on one event loop.
+
+    """
+    await asyncio.gather(*[
+        filter_folder(
+            server_info,
+            folder,
+            rules,
+            daemon=daemon and folder == 'INBOX',
+            search=search,
+            scan_options=scan_options
+        )
+        for folder, rules in rulesets.items()
+    ])
+
+
+async def filter_folder(server_info, folder, rules, daemon=False,
+                        search=True, scan_options=None):
+    """Run 'rules' over 'folder', on a new connection.
+
+    If 'search' is set, the server is asked for messages that match the
+    rules, where possible. If 'daemon' is set, the folder is then watched for
+    new messages, and messages that rules asked to see again are retested
+    when they're due.
+
+    """
+    connection = await AsyncIMAPConnection.connect(server_info, scan_options)
+    try:
+        scheduler = RetestScheduler()
+        processor = await AsyncRuleProcessor.create(
+            rules, connection, scheduler)
+        criteria = None
+        if search and not daemon:
+            criteria = rules.get_search_criteria(
+                connection.supports_substring_search())
+        last_uid = 0
+        async for message in connection.get_messages(
+                rules.fetch_parts, search=criteria, folder=folder):
+            last_uid = max(last_uid, message.uid())
+            await processor.process_message(message)
+        await processor.flush()
+        if daemon:
+            async for message in connection.watch_messages(
+                    rules.fetch_parts,
+                    last_uid + 1,
+                    scheduler=scheduler,
+                    before_wait=processor.flush):
+                await processor.process_message(message)
+    finally:
+        await connection.close()
@@ -0,0 +1,495 @@
+
+"""A small asyncio IMAP client.
+
+IMAPClient is built on imaplib, which needs a thread per connection. This
+client implements the handful of IMAP commands gmailfilter uses on top of
+asyncio streams instead, so one event loop can drive many connections. It
+reuses IMAPClient's response parser, so fetch responses look the same as
+they do from IMAPClient.
+
+Commands are pipelined: each command is sent as soon as it is issued, and a
+single reader task matches responses to commands as they arrive. Untagged
+FETCH responses are routed to the UID FETCH command that asked for that UID,
+and the data of other commands (such as LIST or SEARCH) to the oldest
+command of that kind still waiting. Status responses, such as EXISTS, go to
+a waiting SELECT or IDLE if there is one, or else to the oldest command.
+
+"""
+
+import asyncio
+from collections import OrderedDict
+import logging
+import re
+import ssl as ssl_lib
+
+from imapclient import imap_utf7
+from imapclient.response_parser import (
+    parse_fetch_response,
+    parse_response,
+)
+
+
+class IMAPError(Exception):
+    """An IMAP command failed, or the connection was lost."""
+
+
+_LITERAL = re.compile(rb'\{(\d+)\}$')
+_RESPONSE_CODE = re.compile(rb'\[([A-Z-]+) (\d+)\]')
+_FETCH_UID = re.compile(rb'[( ]UID (\d+)', re.IGNORECASE)
+_SEQUENCE_SET = re.compile(r'^[\d:*,]+$')
+_ATOM_SPECIALS = re.compile(r'[\s()%*"\\\]{\x00-\x1f\x7f]')
+# Untagged responses that carry a command's data -> the commands they
+# answer:
+_RESPONSE_COMMANDS = {
+    b'CAPABILITY': ('CAPABILITY',),
+    b'FETCH': ('UID FETCH',),
+    b'LIST': ('LIST',),
+    b'SEARCH': ('UID SEARCH',),
+}
+# Commands that read the status responses, such as EXISTS:
+_STATUS_COMMANDS = ('SELECT', 'EXAMINE', 'IDLE')
+_MONTHS = (
+    'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+    'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec',
+)
+
+
+class _Command(object):
+
+    def __init__(self, tag, name, uids=None):
+        loop = asyncio.get_running_loop()
+        self.tag = tag
+        self.name = name
+        # For UID FETCH, the set of UIDs asked for:
+        self.uids = uids
+        # A list of (type, data) tuples:
+        self.untagged = []
+        self.updated = asyncio.Event()
+        self.continuation = loop.create_future()
+        self.done = loop.create_future()
+
+    def add_untagged(self, response):
+        self.untagged.append(response)
+        self.updated.set()
+
+
+class AsyncIMAPClient(object):
+
+    """An IMAP connection driven by an asyncio event loop.
+
+    Create instances with 'connect'. Methods have the same names and
+    arguments as their IMAPClient equivalents, and always work with UIDs.
+
+    """
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._tag_counter = 0
+        # tag -> _Command, oldest first:
+        self._pending = OrderedDict()
+        self._capabilities = frozenset()
+        self._read_task = asyncio.ensure_future(self._read_responses())
+
+    @classmethod
+    async def connect(cls, host, port=993, ssl=True, ssl_context=None):
+        if ssl and ssl_context is None:
+            ssl_context = ssl_lib.create_default_context()
+        reader, writer = await asyncio.open_connection(
+            host, port, ssl=ssl_context if ssl else None)
+        greeting = await reader.readline()
+        if not greeting.startswith(b'* OK'):
+            writer.close()
+            raise IMAPError("Unexpected greeting: %r" % greeting)
+        return cls(reader, writer)
+
+    async def login(self, username, password):
+        await self._simple_command('LOGIN', _quote(username), _quote(password))
+        await self.capabilities()
+
+    async def logout(self):
+        try:
+            await self._simple_command('LOGOUT')
+        except IMAPError:
+            pass
+        self.close()
+
+    def close(self):
+        self._read_task.cancel()
+        self._writer.close()
+
+    async def capabilities(self):
+        untagged = await self._simple_command('CAPABILITY')
+        capabilities = set()
+        for typ, data in untagged:
+            if typ == b'CAPABILITY':
+                capabilities.update(data[0].upper().split())
+        self._capabilities = frozenset(capabilities)
+        return self._capabilities
+
+    def has_capability(self, capability):
+        return capability.upper().encode() in self._capabilities
+
+    async def select_folder(self, folder, readonly=False):
+        """Select 'folder', and return a dictionary like IMAPClient does.
+
+        The dictionary has EXISTS, UIDVALIDITY and UIDNEXT values, where the
+        server reports them.
+
+        """
+        untagged = await self._simple_command(
+            'EXAMINE' if readonly else 'SELECT', _quote_folder(folder))
+        details = {}
+        for typ, data in untagged:
+            if typ == b'EXISTS':
+                details[b'EXISTS'] = int(data[0])
+            elif typ == b'OK':
+                match = _RESPONSE_CODE.search(data[0])
+                if match:
+                    details[match.group(1)] = int(match.group(2))
+        return details
+
+    async def search(self, criteria):
+        """Search the selected folder, and return a list of UIDs."""
+        untagged = await self._simple_command(
+            'UID SEARCH', format_search_criteria(criteria))
+        uids = []
+        for typ, data in untagged:
+            if typ == b'SEARCH':
+                uids.extend(int(uid) for uid in data[0].split())
+        return uids
+
+    async def fetch(self, uids, parts):
+        """Fetch 'parts' for 'uids', returning a dict keyed by UID.
+
+        Unlike IMAPClient, the data for each message includes its UID.
+        Fetches may be issued concurrently with each other.
+
+        """
+        if isinstance(uids, int):
+            uids = [uids]
+        uids = set(uids)
+        untagged = await self._simple_command(
+            'UID FETCH',
+            format_uid_set(uids),
+            '(%s)' % ' '.join(_to_str(p) for p in parts),
+            uids=uids
+        )
+        data = []
+        for typ, items in untagged:
+            if typ == b'FETCH':
+                data.extend(items)
+        response = parse_fetch_response(data, True, True)
+        result = {}
+        # Drop unsolicited responses for other messages:
+        for uid in uids:
+            if uid in response:
+                # The parser only uses the UID as the key:
+                response[uid][b'UID'] = uid
+                result[uid] = response[uid]
+        return result
+
+    async def noop(self):
+        await self._simple_command('NOOP')
+
+    async def idle_wait(self, timeout):
+        """IDLE for up to 'timeout' seconds, or until new messages arrive.
+
+        Returns True if the server sent an EXISTS response. No other command
+        may be in progress.
+
+        """
+        command = await self._send('IDLE')
+        await asyncio.wait(
+            [command.continuation, command.done],
+            return_when=asyncio.FIRST_COMPLETED
+        )
+        if command.done.done():
+            self._check_status(command)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        exists = False
+        try:
+            while not exists:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                command.updated.clear()
+                exists = any(typ == b'EXISTS' for typ, _ in command.untagged)
+                if not exists:
+                    try:
+                        await asyncio.wait_for(
+                            command.updated.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            self._writer.write(b'DONE\r\n')
+            await self._writer.drain()
+            await command.done
+        self._check_status(command)
+        return exists
+
+    async def list_folders(self, directory='', pattern='*'):
+        """Return a list of (flags, delimiter, name) tuples."""
+        untagged = await self._simple_command(
+            'LIST', _quote_folder(directory), _quote_folder(pattern))
+        folders = []
+        for typ, data in untagged:
+            if typ != b'LIST':
+                continue
+            flags, delimiter, name = parse_response(data)
+            if isinstance(name, int):
+                name = str(name)
+            elif isinstance(name, bytes):
+                name = imap_utf7.decode(name)
+            folders.append((flags, delimiter, name))
+        return folders
+
+    async def folder_exists(self, folder):
+        return bool(await self.list_folders('', folder))
+
+    async def create_folder(self, folder):
+        return await self._text_command('CREATE', _quote_folder(folder))
+
+    async def delete_folder(self, folder):
+        return await self._text_command('DELETE', _quote_folder(folder))
+
+    async def rename_folder(self, old_name, new_name):
+        return await self._text_command(
+            'RENAME', _quote_folder(old_name), _quote_folder(new_name))
+
+    async def copy(self, uids, folder):
+        return await self._text_command(
+            'UID COPY', format_uid_set(uids), _quote_folder(folder))
+
+    async def move(self, uids, folder):
+        return await self._text_command(
+            'UID MOVE', format_uid_set(uids), _quote_folder(folder))
+
+    async def add_flags(self, uids, flags):
+        await self._store(uids, '+FLAGS.SILENT', flags)
+
+    async def remove_flags(self, uids, flags):
+        await self._store(uids, '-FLAGS.SILENT', flags)
+
+    async def set_flags(self, uids, flags):
+        await self._store(uids, 'FLAGS.SILENT', flags)
+
+    async def delete_messages(self, uids, silent=False):
+        # Flags are always stored silently:
+        await self.add_flags(uids, [b'\\Deleted'])
+
+    async def uid_expunge(self, uids):
+        return await self._text_command('UID EXPUNGE', format_uid_set(uids))
+
+    async def expunge(self):
+        return await self._text_command('EXPUNGE')
+
+    async def _store(self, uids, item, flags):
+        if isinstance(flags, (str, bytes)):
+            flags = [flags]
+        await self._simple_command(
+            'UID STORE',
+            format_uid_set(uids),
+            item,
+            '(%s)' % ' '.join(_to_str(f) for f in flags)
+        )
+
+    async def _text_command(self, name, *args):
+        """Run a command, and return the text of its tagged response."""
+        command = await self._send(name, *args)
+        await command.done
+        return self._check_status(command)
+
+    async def _simple_command(self, name, *args, uids=None):
+        """Run a command, and return its untagged responses."""
+        command = await self._send(name, *args, uids=uids)
+        await command.done
+        self._check_status(command)
+        return command.untagged
+
+    async def _send(self, name, *args, uids=None):
+        if self._read_task.done():
+            raise IMAPError("Connection closed")
+        self._tag_counter += 1
+        tag = 'A%d' % self._tag_counter
+        command = _Command(tag.encode(), name, uids)
+        self._pending[command.tag] = command
+        line = ' '.join((tag, name) + args)
+        logging.debug("> %s", line if name != 'LOGIN' else 'LOGIN ***')
+        self._writer.write(line.encode() + b'\r\n')
+        await self._writer.drain()
+        return command
+
+    def _check_status(self, command):
+        status, text = command.done.result()
+        if status != b'OK':
+            raise IMAPError("%s failed: %s" % (
+                command.name, text.decode(errors='replace')))
+        return text
+
+    async def _read_responses(self):
+        try:
+            while True:
+                self._handle_response(await self._read_response())
+        except asyncio.CancelledError:
+            error = IMAPError("Connection closed")
+            raise
+        except Exception as e:
+            error = e if isinstance(e, IMAPError) else IMAPError(str(e))
+        finally:
+            for command in self._pending.values():
+                for future in (command.continuation, command.done):
+                    if not future.done():
+                        future.set_exception(error)
+            self._pending.clear()
+
+    async def _read_response(self):
+        """Read one response, which may contain literals.
+
+        Returns a list in the form imaplib uses: literals are returned as a
+        tuple of (line up to the literal, literal data), followed by the rest
+        of the line.
+
+        """
+        items = []
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                raise IMAPError("Connection closed by server")
+            line = line.rstrip(b'\r\n')
+            match = _LITERAL.search(line)
+            if match is None:
+                items.append(line)
+                return items
+            literal = await self._reader.readexactly(int(match.group(1)))
+            items.append((line, literal))
+
+    def _handle_response(self, items):
+        first = items[0][0] if isinstance(items[0], tuple) else items[0]
+        if first.startswith(b'+'):
+            for command in self._pending.values():
+                if not command.continuation.done():
+                    command.continuation.set_result(first[2:])
+                    break
+        elif first.startswith(b'* '):
+            self._handle_untagged(first[2:], items)
+        else:
+            tag, _, rest = first.partition(b' ')
+            command = self._pending.pop(tag, None)
+            if command is None:
+                logging.warning("Unexpected response: %r", first)
+                return
+            status, _, text = rest.partition(b' ')
+            command.done.set_result((status.upper(), text))
+
+    def _handle_untagged(self, first, items):
+        number, _, rest = first.partition(b' ')
+        if number.isdigit():
+            typ, _, rest = rest.partition(b' ')
+            typ = typ.upper()
+            if typ == b'FETCH':
+                # imaplib (and so IMAPClient's parser) drops the type:
+                rest = number + b' ' + rest
+            else:
+                rest = number
+        else:
+            typ = number.upper()
+        # Put the stripped first line back:
+        if isinstance(items[0], tuple):
+            data = [(rest, items[0][1])] + items[1:]
+        else:
+            data = [rest] + items[1:]
+        if typ == b'BYE':
+            logging.info("Server closed connection: %r", rest)
+        command = self._route_untagged(typ, data)
+        if command is not None:
+            command.add_untagged((typ, data))
+
+    def _route_untagged(self, typ, data):
+        """Find the pending command an untagged response belongs to.
+
+        Returns None if no pending command asked for it.
+
+        """
+        if typ == b'FETCH':
+            # Look for the UID outside of any literals:
+            text = b' '.join(
+                item[0] if isinstance(item, tuple) else item for item in data)
+            match = _FETCH_UID.search(text)
+            if match:
+                uid = int(match.group(1))
+                for command in self._pending.values():
+                    if command.uids is not None and uid in command.uids:
+                        return command
+        names = _RESPONSE_COMMANDS.get(typ)
+        if names is None:
+            names = _STATUS_COMMANDS
+        for command in self._pending.values():
+            if command.name in names:
+                return command
+        if typ in _RESPONSE_COMMANDS:
+            logging.debug("Dropping unsolicited %s response", typ.decode())
+            return None
+        for command in self._pending.values():
+            return command
+        return None
+
+
+def format_uid_set(uids):
+    """Format 'uids' as an IMAP sequence set, collapsing runs into ranges.
+
+    A string is taken to be a sequence set already.
+
+    """
+    if isinstance(uids, str):
+        return uids
+    if isinstance(uids, int):
+        return str(uids)
+    ranges = []
+    for uid in sorted(set(uids)):
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(
+        str(start) if start == end else '%d:%d' % (start, end)
+        for start, end in ranges
+    )
+
+
+def format_search_criteria(criteria):
+    """Format a list of search criteria, as used by IMAPClient.search."""
+    return ' '.join(_format_search_item(item) for item in criteria)
+
+
+def _format_search_item(item):
+    if isinstance(item, (list, tuple)):
+        return '(%s)' % format_search_criteria(item)
+    if isinstance(item, int):
+        return str(item)
+    if hasattr(item, 'strftime'):
+        return '%d-%s-%d' % (item.day, _MONTHS[item.month - 1], item.year)
+    item = _to_str(item)
+    if _SEQUENCE_SET.match(item):
+        return item
+    if not item or _ATOM_SPECIALS.search(item):
+        return _quote(item)
+    return item
+
+
+def _to_str(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _quote(value):
+    value = _to_str(value)
+    try:
+        value.encode('ascii')
+    except UnicodeEncodeError:
+        raise ValueError("Can't send non-ASCII string %r" % value)
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _quote_folder(folder):
+    return _quote(imap_utf7.encode(folder))
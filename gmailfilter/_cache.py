@@ -0,0 +1,194 @@
+
+"""A persistent, on-disk cache of immutable message parts."""
+
+from datetime import datetime
+import functools
+import logging
+import os
+import os.path
+import sqlite3
+import threading
+
+
+def default_cache_path():
+    if 'SNAP_USER_DATA' in os.environ:
+        return os.path.join(os.environ['SNAP_USER_DATA'], 'cache.sqlite')
+    return os.path.expanduser('~/.cache/gmailfilter/cache.sqlite')
+
+
+def response_key(part_name):
+    """Get the key the server will use in a fetch response for 'part_name'.
+
+    'part_name' may be bytes or a string. For example, 'BODY.PEEK[HEADER]' is
+    returned as b'BODY[HEADER]'.
+
+    """
+    if isinstance(part_name, str):
+        part_name = part_name.encode('ascii')
+    part_name = part_name.upper()
+    if part_name.startswith(b'BODY.PEEK'):
+        return b'BODY' + part_name[9:]
+    return part_name
+
+
+def is_cacheable(key):
+    """Return True if the fetch response 'key' is immutable for a given UID.
+
+    Only parts we know how to store are considered. Mutable data, such as
+    FLAGS, is never cached.
+
+    """
+    key = response_key(key)
+    return (
+        key.startswith(b'BODY[')
+        or key in (b'INTERNALDATE', b'RFC822.SIZE')
+    )
+
+
+def _locked(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class MessageCache(object):
+
+    """Store immutable message parts on disk.
+
+    The IMAP protocol guarantees that for a given folder and UIDVALIDITY, a
+    UID always refers to the same message, and that message never changes
+    (flags aside). This class stores the parts of those messages that can
+    never change, so they don't have to be fetched again on the next run.
+
+    Call 'select_folder' before using any other methods. All other methods
+    work on the currently selected folder.
+
+    A cache may be shared between threads (see IMAPConnection's 'prefetch'
+    option), so every method holds a lock while it uses the database.
+
+    """
+
+    def __init__(self, path=None):
+        self.path = path or default_cache_path()
+        if self.path != ':memory:':
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS folders (
+                folder TEXT PRIMARY KEY,
+                uidvalidity INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS parts (
+                folder TEXT NOT NULL,
+                uid INTEGER NOT NULL,
+                part BLOB NOT NULL,
+                value,
+                PRIMARY KEY (folder, uid, part)
+            );
+        ''')
+        self._folder = None
+
+    @_locked
+    def select_folder(self, folder, uidvalidity):
+        """Select 'folder', with its current 'uidvalidity' value.
+
+        If the UIDVALIDITY of the folder has changed since the cache was last
+        used, everything cached for that folder is thrown away.
+
+        """
+        row = self._db.execute(
+            'SELECT uidvalidity FROM folders WHERE folder = ?', (folder,)
+        ).fetchone()
+        if row is None or row[0] != uidvalidity:
+            if row is not None:
+                logging.info(
+                    "UIDVALIDITY for %s changed, clearing message cache.",
+                    folder
+                )
+            with self._db:
+                self._db.execute(
+                    'DELETE FROM parts WHERE folder = ?', (folder,))
+                self._db.execute(
+                    'INSERT OR REPLACE INTO folders VALUES (?, ?)',
+                    (folder, uidvalidity)
+                )
+        self._folder = folder
+
+    @_locked
+    def get_parts(self, uids):
+        """Get all cached parts for 'uids'.
+
+        Returns a dictionary mapping UID to a dictionary of cached parts,
+        keyed the same way as IMAPClient fetch responses. UIDs with nothing
+        cached are not included.
+
+        """
+        uids = list(uids)
+        result = {}
+        # Stay well below sqlite's limit on the number of query parameters:
+        for start in range(0, len(uids), 500):
+            batch = uids[start:start + 500]
+            placeholders = ','.join('?' * len(batch))
+            rows = self._db.execute(
+                'SELECT uid, part, value FROM parts '
+                'WHERE folder = ? AND uid IN (%s)' % placeholders,
+                [self._folder] + batch
+            )
+            for uid, part, value in rows:
+                result.setdefault(uid, {})[bytes(part)] = _decode_value(value)
+        return result
+
+    @_locked
+    def store(self, uid, parts):
+        """Store the cacheable parts from the 'parts' fetch response."""
+        self._db.executemany(
+            'INSERT OR REPLACE INTO parts VALUES (?, ?, ?, ?)',
+            [
+                (self._folder, uid, response_key(key), _encode_value(value))
+                for key, value in parts.items()
+                if is_cacheable(key)
+            ]
+        )
+
+    @_locked
+    def retain(self, uids):
+        """Evict everything for UIDs in the current folder not in 'uids'."""
+        with self._db:
+            self._db.execute('CREATE TEMP TABLE IF NOT EXISTS live (uid)')
+            self._db.execute('DELETE FROM live')
+            self._db.executemany(
+                'INSERT INTO live VALUES (?)', ((uid,) for uid in uids))
+            deleted = self._db.execute(
+                'DELETE FROM parts WHERE folder = ? AND '
+                'uid NOT IN (SELECT uid FROM live)',
+                (self._folder,)
+            ).rowcount
+            self._db.execute('DELETE FROM live')
+        if deleted:
+            logging.debug("Evicted %d cached message parts.", deleted)
+
+    @_locked
+    def commit(self):
+        self._db.commit()
+
+    @_locked
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
@@ -0,0 +1,378 @@
+
+"""Remember how far previous runs got, so later runs can scan incrementally.
+
+Also remember which message parts the rules read without declaring them
+(see Test.get_required_parts), so later runs can fetch them up front.
+
+"""
+
+import json
+import logging
+import os
+import os.path
+import time
+
+from gmailfilter._cache import response_key
+from gmailfilter import _message
+
+
+def default_checkpoint_path():
+    if 'SNAP_USER_DATA' in os.environ:
+        return os.path.join(os.environ['SNAP_USER_DATA'], 'checkpoint.json')
+    return os.path.expanduser('~/.cache/gmailfilter/checkpoint.json')
+
+
+class ScanCheckpoint(object):
+
+    """Records the progress of previous scans, per folder.
+
+    For every folder we store the UIDVALIDITY of the folder, the highest UID
+    we've processed, a hash of the ruleset that processed it, and when we
+    last did a full scan. As long as none of those have changed (or expired)
+    the next run only needs to look at messages with higher UIDs, and any
+    messages that were scheduled to be re-tested. If the server supports
+    CONDSTORE, we also store the folder's HIGHESTMODSEQ, so that the next
+    run can re-test the messages whose flags have changed.
+
+    """
+
+    def __init__(self, path=None):
+        self.path = path or default_checkpoint_path()
+        self._folders = _read_json(self.path)
+
+    def get_min_uid(self, folder, uidvalidity, rules_hash, rescan_interval,
+                    now=None):
+        """Get the lowest UID that a scan of 'folder' needs to look at.
+
+        Returns None if a full scan is needed. That's the case if we've never
+        scanned the folder, if its UIDVALIDITY or the rules have changed, or
+        if the last full scan was more than 'rescan_interval' seconds ago.
+
+        """
+        if now is None:
+            now = time.time()
+        state = self._folders.get(folder)
+        if state is None:
+            logging.info("No checkpoint for %s, doing a full scan.", folder)
+            return None
+        if state['uidvalidity'] != uidvalidity:
+            logging.info("UIDVALIDITY for %s changed, doing a full scan.",
+                         folder)
+            return None
+        if state['rules_hash'] != rules_hash:
+            logging.info("Rules have changed, doing a full scan.")
+            return None
+        if state['last_full_scan'] + rescan_interval < now:
+            logging.info("Full rescan interval expired, doing a full scan.")
+            return None
+        return state['last_uid'] + 1
+
+    def get_highest_modseq(self, folder):
+        """Get the HIGHESTMODSEQ 'folder' had when the last scan started.
+
+        Returns None if it wasn't recorded. Only use it if 'get_min_uid'
+        allows an incremental scan.
+
+        """
+        return self._folders.get(folder, {}).get('highest_modseq')
+
+    def record_scan(self, folder, uidvalidity, rules_hash, last_uid,
+                    full_scan, now=None, highest_modseq=None):
+        """Record a completed scan of 'folder'.
+
+        'last_uid' is the highest UID processed by the scan. It may be 0 if
+        the scan found no messages. 'highest_modseq' should be the folder's
+        HIGHESTMODSEQ from before the scan started, if the server has one.
+        Every message changed since then (or that hadn't been scanned yet)
+        must have been tested by the scan.
+
+        """
+        if now is None:
+            now = time.time()
+        state = self._folders.get(folder)
+        if (state is None or full_scan
+                or state['uidvalidity'] != uidvalidity):
+            state = {'last_uid': 0, 'last_full_scan': now}
+        state['uidvalidity'] = uidvalidity
+        state['rules_hash'] = rules_hash
+        state['last_uid'] = max(state['last_uid'], last_uid)
+        state['highest_modseq'] = highest_modseq
+        self._folders[folder] = state
+
+    def get_retests(self, folder):
+        """Get the pending retests for 'folder', as (uid, timestamp) pairs.
+
+        These are the entries of a RetestScheduler.
+
+        """
+        state = self._folders.get(folder, {})
+        return [tuple(entry) for entry in state.get('retests', ())]
+
+    def set_retests(self, folder, entries):
+        """Store the pending retests for 'folder'.
+
+        'record_scan' must have been called for 'folder' first.
+
+        """
+        self._folders[folder]['retests'] = list(entries)
+
+    def save(self):
+        """Write the checkpoint to disk.
+
+        The file is replaced atomically, so a crash never leaves a partially
+        written checkpoint behind.
+
+        """
+        _write_json(self.path, self._folders)
+
+
+def _read_json(path):
+    """Read a JSON file, or return an empty dictionary if we can't."""
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        logging.warning("Ignoring corrupt file '%s': %s", path, e)
+        return {}
+
+
+def _write_json(path, data):
+    """Replace the JSON file at 'path' atomically."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as json_file:
+        json.dump(data, json_file)
+    os.replace(temp_path, path)
+
+
+def default_journal_path():
+    if 'SNAP_USER_DATA' in os.environ:
+        return os.path.join(os.environ['SNAP_USER_DATA'], 'journal.json')
+    return os.path.expanduser('~/.cache/gmailfilter/journal.json')
+
+
+# Don't resume scans that were interrupted longer ago than this many seconds:
+JOURNAL_MAX_AGE = 24 * 3600
+
+
+class ScanJournal(object):
+
+    """Records the progress of scans while they run, so that a scan that is
+    interrupted can be resumed.
+
+    For every folder being scanned we store its UIDVALIDITY, a hash of the
+    ruleset, when the scan started, the UIDs of the messages tested so far,
+    and which of those have actions that haven't run yet (batched actions
+    only run at the end of a folder). Actions are arbitrary objects from the
+    rules file, so they aren't stored: a resumed scan just tests the messages
+    with pending actions again. Messages are identified by UID, since
+    sequence numbers change when messages are moved or deleted.
+
+    A folder's entry is removed when its scan completes.
+
+    """
+
+    def __init__(self, path=None):
+        self.path = path or default_journal_path()
+        self._folders = _read_json(self.path)
+
+    def get_tested_uids(self, folder, uidvalidity, rules_hash, now=None):
+        """Get the UIDs an interrupted scan of 'folder' has dealt with.
+
+        These are the messages that were tested, less those whose actions
+        were still pending. Returns None if there's no scan to resume: none
+        was interrupted, it was interrupted too long ago, or the folder's
+        UIDVALIDITY or the rules have changed since.
+
+        """
+        if now is None:
+            now = time.time()
+        state = self._folders.get(folder)
+        if (state is None
+                or state['uidvalidity'] != uidvalidity
+                or state['rules_hash'] != rules_hash
+                or state['started'] + JOURNAL_MAX_AGE < now):
+            return None
+        tested = set(_expand_ranges(state['tested']))
+        tested.difference_update(state['pending'])
+        return tested
+
+    def get_retests(self, folder):
+        """Get the retests scheduled by the interrupted scan of 'folder'."""
+        state = self._folders.get(folder, {})
+        return [tuple(entry) for entry in state.get('retests', ())]
+
+    def record_progress(self, folder, uidvalidity, rules_hash, tested,
+                        pending, retests, now=None):
+        """Record the progress of a scan of 'folder'.
+
+        'tested' is every UID the scan has tested, and 'pending' the UIDs
+        whose actions haven't run yet. 'retests' are the entries of the
+        scan's RetestScheduler.
+
+        """
+        if now is None:
+            now = time.time()
+        state = self._folders.get(folder)
+        if (state is None
+                or state['uidvalidity'] != uidvalidity
+                or state['rules_hash'] != rules_hash):
+            state = {'started': now}
+        state['uidvalidity'] = uidvalidity
+        state['rules_hash'] = rules_hash
+        state['tested'] = _collapse_ranges(tested)
+        state['pending'] = sorted(pending)
+        state['retests'] = list(retests)
+        self._folders[folder] = state
+
+    def finish(self, folder):
+        """Forget about the scan of 'folder', which has completed."""
+        self._folders.pop(folder, None)
+
+    def save(self):
+        """Write the journal to disk, atomically."""
+        _write_json(self.path, self._folders)
+
+
+def _collapse_ranges(uids):
+    """Turn a collection of UIDs into a sorted list of [start, end] pairs."""
+    ranges = []
+    for uid in sorted(uids):
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ranges
+
+
+def _expand_ranges(ranges):
+    for start, end in ranges:
+        yield from range(start, end + 1)
+
+
+# Fetch a part up front if at least this share of the messages read it:
+MIN_SHARE = 0.1
+
+# How long it takes for the share of a part that's no longer read to halve,
+# in seconds:
+HALF_LIFE = 7 * 24 * 3600
+
+
+def default_profile_path():
+    if 'SNAP_USER_DATA' in os.environ:
+        return os.path.join(os.environ['SNAP_USER_DATA'], 'profile.json')
+    return os.path.expanduser('~/.cache/gmailfilter/profile.json')
+
+
+class PartUsage(object):
+
+    """Counts the messages that read each part, other than 'declared' ones.
+
+    'declared' is the set of parts the rules declare, such as
+    RuleSet.fetch_parts. Reading a part more than once for the same message
+    only counts once, as long as the message's parts are read together.
+
+    """
+
+    def __init__(self, declared):
+        self._declared = {response_key(part) for part in declared}
+        self.counts = {}
+        # Part name -> UID of the message that read it last:
+        self._last_uid = {}
+
+    def record(self, uid, part_name):
+        """Record that the message with 'uid' read 'part_name'."""
+        if isinstance(part_name, bytes):
+            part_name = part_name.decode('ascii')
+        if self._last_uid.get(part_name) == uid:
+            return
+        self._last_uid[part_name] = uid
+        if response_key(part_name) not in self._declared:
+            self.counts[part_name] = self.counts.get(part_name, 0) + 1
+
+
+class FetchProfile(object):
+
+    """Records the parts the rules read without declaring them, per folder.
+
+    For every folder we store a hash of the ruleset, and the share of the
+    messages that read each undeclared part. A share decays with HALF_LIFE
+    once the part stops being read, and the parts whose share is at least
+    MIN_SHARE are fetched up front. A folder's profile is thrown away when
+    the rules change.
+
+    """
+
+    def __init__(self, path=None):
+        self.path = path or default_profile_path()
+        self._folders = _read_json(self.path)
+
+    def _get_shares(self, folder, rules_hash, now):
+        """Get the decayed share of each part, or {} if there's no profile."""
+        state = self._folders.get(folder)
+        if (state is None or rules_hash is None
+                or state['rules_hash'] != rules_hash):
+            return {}
+        decay = 0.5 ** (max(now - state['updated'], 0) / HALF_LIFE)
+        return {
+            part: share * decay
+            for part, share in state['shares'].items()
+            if share * decay >= MIN_SHARE
+        }
+
+    def get_fetch_parts(self, rules, folder, now=None):
+        """Get the parts to fetch for a scan of 'folder' with 'rules'.
+
+        That's the rules' fetch_parts, plus the parts they read without
+        declaring them in earlier scans.
+
+        """
+        if now is None:
+            now = time.time()
+        learned = set(self._get_shares(folder, rules.source_hash, now))
+        learned.difference_update(rules.fetch_parts)
+        if not learned:
+            return rules.fetch_parts
+        logging.info(
+            "Fetching %s too, since the rules read them in earlier scans.",
+            ', '.join(sorted(learned))
+        )
+        parts = set(rules.fetch_parts) | learned
+        if _message.HEADER in parts:
+            # The full header has every field:
+            parts = {
+                part for part in parts
+                if not response_key(part).startswith(b'BODY[HEADER.FIELDS ')
+            }
+        return frozenset(parts)
+
+    def record_scan(self, folder, rules_hash, usage, messages, now=None):
+        """Record the parts read by a scan of 'folder'.
+
+        'usage' is the scan's PartUsage, and 'messages' how many messages it
+        tested. Nothing is recorded for rules that weren't loaded from a
+        file, since there's no way to tell when they change.
+
+        """
+        if rules_hash is None:
+            return
+        if now is None:
+            now = time.time()
+        shares = self._get_shares(folder, rules_hash, now)
+        if messages:
+            for part, count in usage.counts.items():
+                shares[part] = max(
+                    shares.get(part, 0), min(count / messages, 1.0))
+        self._folders[folder] = {
+            'rules_hash': rules_hash,
+            'updated': now,
+            'shares': shares,
+        }
+
+    def save(self):
+        """Write the profile to disk, atomically."""
+        _write_json(self.path, self._folders)
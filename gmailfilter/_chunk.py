@@ -0,0 +1,207 @@
+"""Compact storage for a chunk of fetched messages.
+
+IMAPClient returns a fetch response as a dict for every message, keyed by
+bytes, holding an int object for every UID and size, a tuple for every set
+of flags and a bytes object for every header. MessageChunk stores a response
+column by column instead: ints in arrays, naive datetimes as microseconds in
+an array, tuples (such as flags) as indexes into a table of the distinct
+ones, and bytes (such as headers) in one buffer for the whole chunk.
+
+MessageRecord is the per-message view of a chunk. It has just enough of the
+dict interface for MessageConnectionProxy, and uses __slots__, so a message
+costs a few dozen bytes on top of its share of the chunk. Parts that only
+some messages have, or that are fetched later, are kept in a dict on the
+record.
+
+"""
+
+from array import array
+from datetime import (
+    datetime,
+    timedelta,
+)
+from itertools import accumulate
+
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+class _IntColumn(object):
+
+    __slots__ = ('_values',)
+
+    def __init__(self, values):
+        self._values = array('q', values)
+
+    def get(self, index):
+        return self._values[index]
+
+
+class _DateColumn(object):
+
+    """Naive datetimes, stored as microseconds since the epoch."""
+
+    __slots__ = ('_values',)
+
+    def __init__(self, values):
+        self._values = array(
+            'q', ((value - _EPOCH) // _MICROSECOND for value in values))
+
+    def get(self, index):
+        return _EPOCH + timedelta(microseconds=self._values[index])
+
+
+class _BytesColumn(object):
+
+    """Bytes, concatenated into one buffer."""
+
+    __slots__ = ('_buffer', '_offsets')
+
+    def __init__(self, values):
+        self._buffer = b''.join(values)
+        self._offsets = array('q', [0])
+        self._offsets.extend(accumulate(map(len, values)))
+
+    def get(self, index):
+        return self._buffer[self._offsets[index]:self._offsets[index + 1]]
+
+
+class _TableColumn(object):
+
+    """Values with few distinct ones, stored as indexes into a table."""
+
+    __slots__ = ('_table', '_indexes')
+
+    def __init__(self, values):
+        self._table = []
+        positions = {}
+        self._indexes = array('L')
+        for value in values:
+            position = positions.get(value)
+            if position is None:
+                position = positions[value] = len(self._table)
+                self._table.append(value)
+            self._indexes.append(position)
+
+    def get(self, index):
+        return self._table[self._indexes[index]]
+
+
+class _ListColumn(object):
+
+    __slots__ = ('_values',)
+
+    def __init__(self, values):
+        self._values = values
+
+    def get(self, index):
+        return self._values[index]
+
+
+def _make_column(values):
+    """Pick the most compact column that can hold 'values'."""
+    types = {type(value) for value in values}
+    if types == {int} and all(-2**63 <= v < 2**63 for v in values):
+        return _IntColumn(values)
+    if types == {bytes}:
+        return _BytesColumn(values)
+    if types == {datetime} and all(v.tzinfo is None for v in values):
+        return _DateColumn(values)
+    if types == {tuple}:
+        try:
+            return _TableColumn(values)
+        except TypeError:
+            pass
+    return _ListColumn(values)
+
+
+class MessageChunk(object):
+
+    """The fetch responses for a chunk of messages, stored compactly.
+
+    'responses' is an iterable of the dicts of parts for each message, as in
+    the values of an IMAPClient fetch response. Iterating over the chunk
+    yields a MessageRecord for each message, in the same order.
+
+    """
+
+    __slots__ = ('_columns', '_extras', '_count')
+
+    def __init__(self, responses):
+        responses = list(responses)
+        self._count = len(responses)
+        common = set(responses[0]) if responses else set()
+        for parts in responses[1:]:
+            common.intersection_update(parts)
+        self._columns = {
+            key: _make_column([parts[key] for parts in responses])
+            for key in common
+        }
+        # Parts that only some messages have, or None if there aren't any:
+        self._extras = None
+        if any(len(parts) > len(common) for parts in responses):
+            self._extras = [
+                {k: v for k, v in parts.items() if k not in common} or None
+                for parts in responses
+            ]
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for index in range(self._count):
+            extra = self._extras[index] if self._extras else None
+            yield MessageRecord(self, index, extra)
+
+
+class MessageRecord(object):
+
+    """The parts of one message in a MessageChunk.
+
+    Looks enough like the dict of parts in a fetch response for
+    MessageConnectionProxy: parts can be looked up by their response key,
+    and more can be added with 'update'.
+
+    """
+
+    __slots__ = ('_chunk', '_index', '_extra')
+
+    def __init__(self, chunk, index, extra=None):
+        self._chunk = chunk
+        self._index = index
+        self._extra = extra
+
+    def __getitem__(self, key):
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        return self._chunk._columns[key].get(self._index)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self._chunk._columns or (
+            self._extra is not None and key in self._extra)
+
+    def keys(self):
+        columns = self._chunk._columns
+        keys = list(columns)
+        if self._extra is not None:
+            keys.extend(k for k in self._extra if k not in columns)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def update(self, parts):
+        """Add (or replace) parts, such as ones fetched lazily."""
+        if self._extra is None:
+            self._extra = {}
+        self._extra.update(parts)
@@ -1,25 +1,63 @@
 
+import asyncio
+import functools
+import imaplib
 import logging
+import os
 import sys
+import time
 from argparse import ArgumentParser
 
+from gmailfilter._async import filter_mailbox
+from gmailfilter._cache import MessageCache
+from gmailfilter._checkpoint import (
+    FetchProfile,
+    ScanCheckpoint,
+    ScanJournal,
+)
 from gmailfilter._config import (
+    ScanOptions,
     ServerInfo,
     default_credentials_file_location,
 )
 from gmailfilter._connection import IMAPConnection
+from gmailfilter._fleet import (
+    DEFAULT_ACCOUNT_CONNECTIONS,
+    FleetOptions,
+    find_accounts,
+    run_fleet,
+)
+from gmailfilter._replay import (
+    ReplayConnection,
+    ReplayError,
+    SessionRecorder,
+    SessionRecording,
+)
+from gmailfilter._scan import scan_folder
 from gmailfilter import _rules
 
 
+# How many times to reconnect if the connection drops during a scan, and how
+# long to wait before the first attempt (doubling each time), in seconds:
+RECONNECT_ATTEMPTS = 3
+RECONNECT_DELAY = 5
+
+
 def run():
     """Main entry point for command line executable."""
     args = configure_argument_parser()
     log_level = logging.DEBUG if args.verbose else logging.INFO
-    logging.basicConfig(level=log_level, stream=sys.stdout)
-    run_new_filter()
+    # Importing gmailfilter.test logs, which configures logging already:
+    logging.basicConfig(level=log_level, stream=sys.stdout, force=True)
+    if args.fleet:
+        run_fleet_filter(args)
+    elif args.replay:
+        run_replay_filter(args)
+    else:
+        run_new_filter(args)
 
 
-def run_new_filter():
+def run_new_filter(args):
     try:
         s = ServerInfo.read_config_file()
     except IOError:
@@ -37,23 +75,237 @@ def run_new_filter():
         )
         sys.exit(1)
     try:
-        rules = _rules.load_rules()
+        scan_options = ScanOptions.read_config_file()
+    except RuntimeError as e:
+        print(e)
+        sys.exit(1)
+    try:
+        rulesets = _rules.load_folder_rules()
     except _rules.RuleLoadError as e:
         print(e)
         sys.exit(2)
+    if args.daemon and 'INBOX' not in rulesets:
+        print("--daemon watches the inbox, but there are no rules for it.")
+        sys.exit(2)
+
+    if args.asyncio:
+        if args.record:
+            print("--record can't be used with --asyncio.")
+            sys.exit(1)
+        run_async_filter(args, s, scan_options, rulesets)
+        return
+
+    # Parts read from the cache aren't fetched, so they couldn't be recorded:
+    cache = None if args.no_cache or args.record else MessageCache()
+    recorder = None
+    if args.record:
+        try:
+            recorder = SessionRecorder(args.record)
+        except OSError as e:
+            print("Could not write recording: %s" % e)
+            sys.exit(1)
+    connect = functools.partial(
+        IMAPConnection, s, cache, args.prefetch, scan_options, recorder)
+    try:
+        connection = connect()
+    except RuntimeError as e:
+        print("Error: %s" % e)
+        sys.exit(3)
+
+    checkpoint = ScanCheckpoint() if args.incremental else None
+    journal = ScanJournal()
+    profile = None if args.no_profile else FetchProfile()
+    # Folders are scanned one after the other, on the same connection. Scan
+    # the inbox last, so it's still selected if we go on to watch it:
+    folders = sorted(rulesets, key=lambda folder: folder == 'INBOX')
+    # Messages the server filters out are never tested, so they can't be
+    # scheduled for a retest. Only let the server filter when we're going to
+    # do a full scan next time anyway:
+    search = not (args.incremental or args.daemon or args.no_search)
+    try:
+        for folder in folders:
+            connection, scan = scan_with_reconnect(
+                connect,
+                connection,
+                folder,
+                rulesets[folder],
+                checkpoint,
+                args.rescan_interval * 3600,
+                search,
+                journal,
+                profile
+            )
+            rule_processor, scheduler, next_uid, _ = scan
+        if checkpoint is not None:
+            checkpoint.save()
+        if profile is not None:
+            profile.save()
+        if args.daemon:
+            logging.info("Initial scan complete, waiting for new messages.")
+            fetch_parts = rulesets['INBOX'].fetch_parts
+            if profile is not None:
+                fetch_parts = profile.get_fetch_parts(
+                    rulesets['INBOX'], 'INBOX')
+            for message in connection.watch_messages(
+                    fetch_parts,
+                    next_uid,
+                    scheduler=scheduler,
+                    before_wait=rule_processor.flush):
+                rule_processor.process_message(message)
+    except KeyboardInterrupt:
+        pass
+    except (RuntimeError, imaplib.IMAP4.abort, OSError) as e:
+        print("Error: %s" % e)
+        sys.exit(3)
+    finally:
+        connection.close()
+        if cache:
+            cache.close()
+        if recorder:
+            recorder.close()
+
+
+def scan_with_reconnect(connect, connection, folder, *args):
+    """Run scan_folder on 'folder', reconnecting if the connection drops.
+
+    'connect' is called to make a new connection. The journal passed to
+    scan_folder lets the new connection carry on where the scan stopped.
 
+    Returns a tuple of (connection, scan), where 'connection' is the one
+    that finished the scan.
+
+    :raises RuntimeError: If we couldn't reconnect.
+
+    """
+    for attempt in range(RECONNECT_ATTEMPTS + 1):
+        try:
+            return connection, scan_folder(connection, folder, *args)
+        except (imaplib.IMAP4.abort, OSError) as e:
+            if attempt == RECONNECT_ATTEMPTS:
+                raise
+            delay = RECONNECT_DELAY * 2 ** attempt
+            logging.warning(
+                "Lost the connection while scanning %s (%s). Reconnecting "
+                "in %d seconds.",
+                folder,
+                e,
+                delay
+            )
+            connection.close()
+            time.sleep(delay)
+            connection = connect()
+
+
+def run_async_filter(args, server_info, scan_options, rulesets):
+    if args.incremental:
+        print("--incremental can't be used with --asyncio yet.")
+        sys.exit(1)
     try:
-        connection = IMAPConnection(s)
+        asyncio.run(filter_mailbox(
+            server_info,
+            rulesets,
+            daemon=args.daemon,
+            search=not args.no_search,
+            scan_options=scan_options
+        ))
     except RuntimeError as e:
         print("Error: %s" % e)
         sys.exit(3)
+    except KeyboardInterrupt:
+        pass
 
-    rule_processor = _rules.SimpleRuleProcessor(
-        rules,
-        connection.get_connection_proxy()
+
+def run_replay_filter(args):
+    """Run the rules over a recording, rather than the server.
+
+    Nothing is changed: actions are only logged, and no checkpoint, journal
+    or cache is used.
+
+    """
+    if args.daemon or args.asyncio or args.incremental or args.record:
+        print("--daemon, --asyncio, --incremental and --record can't be used "
+              "with --replay.")
+        sys.exit(1)
+    try:
+        scan_options = ScanOptions.read_config_file()
+    except RuntimeError as e:
+        print(e)
+        sys.exit(1)
+    try:
+        rulesets = _rules.load_folder_rules()
+    except _rules.RuleLoadError as e:
+        print(e)
+        sys.exit(2)
+    try:
+        recording = SessionRecording.load(args.replay)
+    except (OSError, ValueError) as e:
+        print("Could not read recording: %s" % e)
+        sys.exit(1)
+    connection = ReplayConnection(
+        recording, prefetch=args.prefetch, scan_options=scan_options)
+    start = time.monotonic()
+    messages = 0
+    try:
+        for folder in sorted(rulesets):
+            messages += scan_folder(
+                connection,
+                folder,
+                rulesets[folder],
+                search=not args.no_search
+            ).messages
+    except ReplayError as e:
+        print("Error: %s" % e)
+        sys.exit(3)
+    finally:
+        connection.close()
+    elapsed = time.monotonic() - start
+    logging.info(
+        "Replayed %d messages in %.2fs (%.0f messages/s).",
+        messages,
+        elapsed,
+        messages / elapsed if elapsed else 0
     )
-    for message in connection.get_messages():
-        rule_processor.process_message(message)
+
+
+def run_fleet_filter(args):
+    if args.daemon or args.asyncio or args.record or args.replay:
+        print("--daemon, --asyncio, --record and --replay can't be used with "
+              "--fleet.")
+        sys.exit(1)
+    try:
+        accounts = find_accounts(args.fleet)
+    except OSError as e:
+        print("Could not read fleet directory: %s" % e)
+        sys.exit(1)
+    if not accounts:
+        print("No accounts found in {}.".format(args.fleet))
+        sys.exit(1)
+    try:
+        options = FleetOptions(
+            incremental=args.incremental,
+            rescan_interval=args.rescan_interval * 3600,
+            search=not args.no_search,
+            use_cache=not args.no_cache,
+            use_profile=not args.no_profile,
+            prefetch=args.prefetch,
+            account_connections=args.account_connections
+        )
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    interval = args.repeat * 60 if args.repeat else None
+    try:
+        report = run_fleet(
+            accounts,
+            options,
+            args.workers or os.cpu_count() or 1,
+            args.max_connections,
+            interval
+        )
+    except KeyboardInterrupt:
+        return
+    if report.failures:
+        sys.exit(3)
 
 
 def configure_argument_parser():
@@ -67,4 +319,104 @@ def configure_argument_parser():
         action='store_true',
         help="Be more verbose"
     )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help="Don't read or write the local message cache"
+    )
+    parser.add_argument(
+        '--no-profile',
+        action='store_true',
+        help="Don't learn which message parts the rules read, to fetch them "
+        "up front next time"
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help="Only scan messages that arrived since the last run. A full scan "
+        "is still done if the rules file changes, or the rescan interval "
+        "expires."
+    )
+    parser.add_argument(
+        '--rescan-interval',
+        type=float,
+        default=24,
+        metavar='HOURS',
+        help="In incremental mode, do a full scan if the last one was more "
+        "than this many hours ago (default: %(default)s)"
+    )
+    parser.add_argument(
+        '--no-search',
+        action='store_true',
+        help="Don't ask the server to search for messages matching the rules; "
+        "fetch and test every message instead"
+    )
+    parser.add_argument(
+        '--daemon',
+        action='store_true',
+        help="After the initial scan, keep running and filter new messages "
+        "as they arrive"
+    )
+    parser.add_argument(
+        '--prefetch',
+        type=int,
+        default=0,
+        metavar='CHUNKS',
+        help="Fetch up to this many chunks of messages ahead on a second "
+        "connection while rules run (default: %(default)s, no prefetching)"
+    )
+    parser.add_argument(
+        '--asyncio',
+        action='store_true',
+        help="Use the asyncio IMAP backend. The message cache and "
+        "incremental scans aren't supported with it yet"
+    )
+    parser.add_argument(
+        '--record',
+        metavar='FILE',
+        help="Record everything fetched from the server in FILE, so the run "
+        "can be replayed with --replay. The message cache isn't used"
+    )
+    parser.add_argument(
+        '--replay',
+        metavar='FILE',
+        help="Run the rules over a recording made with --record, rather than "
+        "the server. Actions are logged, not run"
+    )
+    parser.add_argument(
+        '--fleet',
+        metavar='DIRECTORY',
+        help="Filter every account in DIRECTORY. Each subdirectory is an "
+        "account, with its own credentials.ini and rules.py"
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        metavar='N',
+        help="With --fleet, filter up to N accounts at once, each in its own "
+        "worker process (default: the number of CPUs)"
+    )
+    parser.add_argument(
+        '--max-connections',
+        type=int,
+        default=50,
+        metavar='N',
+        help="With --fleet, open at most N connections at once, over all "
+        "accounts (default: %(default)s)"
+    )
+    parser.add_argument(
+        '--account-connections',
+        type=int,
+        default=DEFAULT_ACCOUNT_CONNECTIONS,
+        metavar='N',
+        help="With --fleet, open at most N connections to any one account "
+        "(default: %(default)s)"
+    )
+    parser.add_argument(
+        '--repeat',
+        type=float,
+        metavar='MINUTES',
+        help="With --fleet, keep running, and filter each account again "
+        "this many minutes after it was last filtered"
+    )
     return parser.parse_args()
@@ -0,0 +1,103 @@
+
+"""The IMAP COMPRESS=DEFLATE extension (RFC 4978), for IMAPClient.
+
+Once the server has accepted the COMPRESS command, everything sent in
+either direction is a raw deflate stream. IMAPClient doesn't know about
+that, but all its reads and writes go through the underlying imaplib
+connection, so DeflateStream takes those over.
+
+"""
+
+import imaplib
+import logging
+import zlib
+
+
+# imaplib refuses to send commands it doesn't know about:
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
+
+def enable_compression(client):
+    """Ask the server to compress the connection 'client' is using.
+
+    The server must advertise COMPRESS=DEFLATE. Returns a DeflateStream, or
+    None if the server refused.
+
+    """
+    imap = client._imap
+    typ, data = imap._simple_command('COMPRESS', 'DEFLATE')
+    if typ != 'OK':
+        logging.warning("Server refused to compress the connection: %r", data)
+        return None
+    return DeflateStream(imap)
+
+
+class DeflateStream(object):
+
+    """Compress and decompress everything on an imaplib connection.
+
+    Counts the bytes on the wire and the (uncompressed) bytes of data, in
+    each direction.
+
+    """
+
+    def __init__(self, imap):
+        self._file = imap.file
+        self._sock = imap.sock
+        # RFC 4978 uses raw deflate, with no zlib header:
+        self._compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._buffer = b''
+        self.wire_bytes_received = 0
+        self.data_bytes_received = 0
+        self.wire_bytes_sent = 0
+        self.data_bytes_sent = 0
+        # imaplib reads through 'file', and writes with 'send':
+        imap.file = self
+        imap.send = self.send
+
+    def send(self, data):
+        compressed = (self._compressor.compress(data)
+                      + self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.data_bytes_sent += len(data)
+        self.wire_bytes_sent += len(compressed)
+        self._sock.sendall(compressed)
+
+    def _fill(self):
+        """Decompress more data into the buffer. Returns False at EOF."""
+        compressed = self._file.read1(65536)
+        if compressed is None:
+            # IMAPClient makes the socket non-blocking while idling, and
+            # expects this when there's nothing to read:
+            raise BlockingIOError("No data available")
+        if not compressed:
+            return False
+        self.wire_bytes_received += len(compressed)
+        data = self._decompressor.decompress(compressed)
+        self.data_bytes_received += len(data)
+        self._buffer += data
+        return True
+
+    def read(self, size):
+        while len(self._buffer) < size and self._fill():
+            pass
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self, limit=-1):
+        while True:
+            end = self._buffer.find(b'\n') + 1
+            if end == 0 and 0 <= limit <= len(self._buffer):
+                end = limit
+            if end or not self._fill():
+                break
+        if not end:
+            end = len(self._buffer)
+        if 0 <= limit < end:
+            end = limit
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
+
+    def close(self):
+        self._file.close()
@@ -17,9 +17,11 @@ class ServerInfo(object):
     _default_options = {
         'port': '993',
         'use_ssl': 'True',
+        'compress': 'True',
     }
 
-    def __init__(self, host, username, password, port, use_ssl):
+    def __init__(self, host, username, password, port, use_ssl,
+                 compress=True):
         if not host:
             raise KeyError('host')
         if not username:
@@ -31,6 +33,7 @@ class ServerInfo(object):
         self.password = password
         self.port = port
         self.use_ssl = use_ssl
+        self.compress = compress
 
     @classmethod
     def read_config_file(cls, path=None):
@@ -68,12 +71,23 @@ class ServerInfo(object):
                     str(e)
                 )
             )
+        try:
+            use_ssl = parser['server'].getboolean('use_ssl')
+            compress = parser['server'].getboolean('compress')
+        except ValueError as e:
+            raise RuntimeError(
+                "Could not parse credentials file '{}'. Error was:\n{}".format(
+                    path,
+                    str(e)
+                )
+            )
         return cls(
             host=parser['server']['host'],
             username=parser['server']['username'],
             password=parser['server']['password'],
             port=parser['server']['port'],
-            use_ssl=parser['server']['use_ssl']
+            use_ssl=use_ssl,
+            compress=compress
         )
 
     @classmethod
@@ -109,10 +123,111 @@ class ServerInfo(object):
                 # OPTIONAL: The port to connect to on the host.
                 #port = 993
 
+                # OPTIONAL: Whether to compress the connection, if the
+                # server supports it (COMPRESS=DEFLATE). This helps most on
+                # slow links. Default is to compress.
+                #compress = True
+
+                [scan]
+
+                # OPTIONAL: Messages are fetched in chunks. The chunk size
+                # is adjusted after every chunk, so that fetching a chunk
+                # takes about this many seconds:
+                #target_chunk_seconds = 2
+
+                # OPTIONAL: The number of messages in the first chunk, and
+                # the smallest and largest chunks allowed:
+                #initial_chunk_size = 100
+                #min_chunk_size = 10
+                #max_chunk_size = 1000
+
+                # OPTIONAL: Chunks are kept small enough that a chunk of
+                # messages is expected to take up no more than this many
+                # megabytes:
+                #max_chunk_megabytes = 32
+
+                # OPTIONAL: The number of connections to fetch messages on
+                # in parallel. One more connection is used to run actions.
+                # Most servers limit how many connections an account may
+                # have open (GMail allows 15):
+                #connections = 1
+
                 '''))
         os.chmod(path, stat.S_IRUSR | stat.S_IWUSR)
 
 
+class ScanOptions(object):
+    """Settings that control how messages are fetched during a scan.
+
+    These are read from the optional [scan] section of the credentials file.
+
+    """
+
+    def __init__(self, initial_chunk_size=100, min_chunk_size=10,
+                 max_chunk_size=1000, target_chunk_seconds=2.0,
+                 max_chunk_bytes=32 * 1024 * 1024, connections=1):
+        if min_chunk_size < 1:
+            raise ValueError("min_chunk_size must be at least 1")
+        if max_chunk_size < min_chunk_size:
+            raise ValueError(
+                "max_chunk_size must not be less than min_chunk_size")
+        if target_chunk_seconds <= 0:
+            raise ValueError("target_chunk_seconds must be positive")
+        if max_chunk_bytes <= 0:
+            raise ValueError("max_chunk_megabytes must be positive")
+        if connections < 1:
+            raise ValueError("connections must be at least 1")
+        self.initial_chunk_size = max(
+            min_chunk_size, min(max_chunk_size, initial_chunk_size))
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.target_chunk_seconds = target_chunk_seconds
+        self.max_chunk_bytes = max_chunk_bytes
+        self.connections = connections
+
+    @classmethod
+    def read_config_file(cls, path=None):
+        """Read scan options from a config file, return a ScanOptions instance.
+
+        Options that are not set, or a missing [scan] section or file, get
+        their default values.
+
+        If the file cannot be parsed, or an option has an invalid value, a
+        RuntimeError will be raised.
+
+        """
+        path = path or default_credentials_file_location()
+        parser = configparser.ConfigParser()
+        try:
+            parser.read(path)
+        except configparser.ParsingError as e:
+            raise RuntimeError(
+                "Could not parse credentials file '{}'. Error was:\n{}".format(
+                    path,
+                    str(e)
+                )
+            )
+        if not parser.has_section('scan'):
+            return cls()
+        section = parser['scan']
+        kwargs = {}
+        try:
+            for name in ('initial_chunk_size', 'min_chunk_size',
+                         'max_chunk_size', 'connections'):
+                if name in section:
+                    kwargs[name] = section.getint(name)
+            if 'target_chunk_seconds' in section:
+                kwargs['target_chunk_seconds'] = section.getfloat(
+                    'target_chunk_seconds')
+            if 'max_chunk_megabytes' in section:
+                kwargs['max_chunk_bytes'] = int(
+                    section.getfloat('max_chunk_megabytes') * 1024 * 1024)
+            return cls(**kwargs)
+        except ValueError as e:
+            raise RuntimeError(
+                "Invalid [scan] option in '{}': {}".format(path, e))
+
+
 def default_credentials_file_location():
     if 'SNAP_USER_DATA' in os.environ:
         return os.path.join(os.environ['SNAP_USER_DATA'], 'credentials.ini')
@@ -1,3 +1,5 @@
+from array import array
+from collections import namedtuple
 from contextlib import contextmanager
 import configparser
 import functools
@@ -7,17 +9,47 @@ import os
 import os.path
 import textwrap
 import stat
+import time
 
 from imapclient import IMAPClient
 
-from gmailfilter._message import EmailMessage as Message
+from gmailfilter._cache import (
+    is_cacheable,
+    response_key,
+)
+from gmailfilter._chunk import MessageChunk
+from gmailfilter._compress import enable_compression
+from gmailfilter._config import ScanOptions
+from gmailfilter._pipeline import (
+    merge,
+    prefetch,
+)
+from gmailfilter._message import (
+    DEFAULT_FETCH_PARTS,
+    EmailMessage as Message,
+    UID,
+    parse_header_fields,
+)
+from gmailfilter._stream import FetchStream
+
+
+# Servers may drop clients that have been idle for 30 minutes, so re-issue
+# IDLE a little more often than that (RFC 2177 recommends 29 minutes, but some
+# NAT gateways are less patient):
+IDLE_REFRESH_INTERVAL = 10 * 60
 
 
 def sequence_chunk(num_messages, chunk_size):
-    assert chunk_size >= 1
+    """Split messages 1 to 'num_messages' into sequence set strings.
+
+    'chunk_size' is either an int, or a ChunkSizer whose current size is
+    used for each chunk as it is generated.
+
+    """
     start = 1
     while start <= num_messages:
-        end = min(start + chunk_size - 1, num_messages)
+        size = _get_chunk_size(chunk_size)
+        end = min(start + size - 1, num_messages)
         if end > start:
             if end != num_messages:
                 yield '%d:%d' % (start, end)
@@ -25,24 +57,192 @@ def sequence_chunk(num_messages, chunk_size):
                 yield '%d:*' % start
         else:
             yield '%d' % (start)
-        start += chunk_size
+        start += size
+
+
+def uid_chunk(uids, chunk_size):
+    """Split the list 'uids' into lists of at most 'chunk_size' UIDs.
+
+    'chunk_size' is as for sequence_chunk.
+
+    """
+    start = 0
+    while start < len(uids):
+        size = _get_chunk_size(chunk_size)
+        yield uids[start:start + size]
+        start += size
+
+
+def _get_chunk_size(chunk_size):
+    if isinstance(chunk_size, ChunkSizer):
+        chunk_size = chunk_size.size
+    assert chunk_size >= 1
+    return int(chunk_size)
+
+
+def sequence_set_ids(sequence_set, largest):
+    """Expand a sequence set string from sequence_chunk into a list of ints.
+
+    '*' stands for 'largest', the number of messages in the folder.
+
+    """
+    ids = []
+    for part in sequence_set.split(','):
+        ends = [largest if end == '*' else int(end) for end in part.split(':')]
+        ids.extend(range(min(ends), max(ends) + 1))
+    return ids
+
+
+def chunk_description(chunk):
+    """Describe a chunk from sequence_chunk or uid_chunk, for logging."""
+    if isinstance(chunk, str):
+        return chunk
+    if len(chunk) == 1:
+        return 'UID %d' % chunk[0]
+    return 'UIDs %d-%d' % (chunk[0], chunk[-1])
+
+
+def response_size(data):
+    """Roughly how many bytes of message data are in a fetch response."""
+    total = 0
+    for parts in data.values():
+        for value in parts.values():
+            if isinstance(value, (bytes, str)):
+                total += len(value)
+            elif isinstance(value, tuple):
+                total += sum(
+                    len(v) for v in value if isinstance(v, (bytes, str)))
+    return total
+
+
+# A chunk of messages from _fetch_chunks. 'ids' are the message ids it was
+# fetched with: UIDs if 'use_uid' is set, sequence numbers otherwise.
+# 'messages' is a MessageChunk, or an iterable of the parts of each message:
+FetchedChunk = namedtuple('FetchedChunk', ['ids', 'use_uid', 'messages'])
+
+
+class ChunkSizer(object):
 
+    """Pick fetch chunk sizes from the measured throughput of earlier chunks.
 
-def optimal_chunk_size(total_messages):
-    """Work out the optimal chunk size for an inbox with total_messages."""
-    # use 1000 (maximum sensible chunk size), or 10 retrieval operations,
-    # whichever is smaller:
-    return min(1000, total_messages / 10)
+    The first chunk has the configured initial size. After every chunk, the
+    size moves towards the number of messages that could be fetched in the
+    target time at the rate just measured, as long as a chunk of them is
+    expected to fit in the memory ceiling. The size changes by at most a
+    factor of two per chunk, so one slow response doesn't collapse it, and
+    always stays within the configured bounds.
+
+    """
+
+    def __init__(self, options):
+        """Create a sizer from 'options', a ScanOptions instance."""
+        self._options = options
+        self.size = options.initial_chunk_size
+
+    def record(self, count, size_bytes, seconds):
+        """Record that fetching 'count' messages, totalling 'size_bytes',
+        took 'seconds', and adjust the chunk size.
+
+        """
+        if not count:
+            return
+        options = self._options
+        ideal = options.max_chunk_size
+        if seconds > 0:
+            ideal = min(ideal, options.target_chunk_seconds * count / seconds)
+        if size_bytes > 0:
+            ideal = min(ideal, options.max_chunk_bytes * count / size_bytes)
+        ideal = max(self.size // 2, min(self.size * 2, int(ideal)))
+        self.size = max(
+            options.min_chunk_size, min(options.max_chunk_size, ideal))
+
+
+class LazyFetchGroup(object):
+
+    """Fetch parts that weren't fetched up front for a whole chunk at once.
+
+    A test that needs a part that wasn't fetched with the chunk will usually
+    need it for every message in the chunk. So the first time a message in
+    the chunk asks for a part, it's fetched for all of them with one
+    command, rather than one command per message.
+
+    'ids' and 'use_uid' are as for FetchedChunk. Parts fetched for a message
+    are kept until the message takes them, so the group doesn't keep the
+    rest of the message alive.
+
+    Sequence numbers are only good until the next EXPUNGE, and the chunk may
+    have been fetched on another connection, so in sequence mode the UID is
+    fetched too, and parts are only handed to the message with that UID.
+
+    """
+
+    def __init__(self, connection, ids, use_uid):
+        self._connection = connection
+        self._ids = ids
+        self._use_uid = use_uid
+        # response key -> {message id: parts not yet taken}:
+        self._fetched = {}
+
+    def take(self, data, part_name):
+        """Get the parts fetched with 'part_name' for the message whose parts
+        are 'data', or None if the server didn't return any.
+
+        Fetches 'part_name' for the whole chunk the first time it's asked
+        for.
+
+        """
+        msg_id = data[b'UID'] if self._use_uid else data.get(b'SEQ')
+        key = response_key(part_name)
+        if key not in self._fetched:
+            self._fetched[key] = self._fetch(part_name)
+        parts = self._fetched[key].pop(msg_id, None)
+        if parts is not None and parts.get(b'UID') != data[b'UID']:
+            logging.debug(
+                "Message %r is UID %r now, not %d, fetching %s by UID",
+                msg_id,
+                parts.get(b'UID'),
+                data[b'UID'],
+                part_name
+            )
+            return None
+        return parts
+
+    def _fetch(self, part_name):
+        connection = self._connection
+        logging.debug(
+            "Fetching %s for %d messages", part_name, len(self._ids))
+        if self._use_uid:
+            with connection.use_uid():
+                data = connection._client.fetch(self._ids, [part_name])
+            for msg_uid, parts in data.items():
+                parts.setdefault(b'UID', msg_uid)
+        else:
+            with connection.use_sequence():
+                data = connection._client.fetch(self._ids, [part_name, UID])
+        if connection._cache and is_cacheable(part_name):
+            for parts in data.values():
+                connection._cache.store(parts[b'UID'], parts)
+        return data
 
 
 class MessageConnectionProxy(object):
 
-    """A class that knows how to retrieve additional message parts."""
+    """A class that knows how to retrieve additional message parts.
+
+    'initial_data' is the dict of parts for the message from a fetch
+    response, or a MessageRecord. If 'group' is set, it's the
+    LazyFetchGroup for the chunk the message was fetched in, and parts that
+    weren't fetched are fetched for the whole chunk.
+
+    """
+
+    __slots__ = ('_connection', '_data', '_group')
 
-    def __init__(self, connection, initial_data):
+    def __init__(self, connection, initial_data, group=None):
         assert b'UID' in initial_data
         self._connection = connection
         self._data = initial_data
+        self._group = group
 
     def get_message_part(self, part_name):
         """Get a part of a message, possibly from memory.
@@ -51,10 +251,22 @@ class MessageConnectionProxy(object):
 
         """
         # transform 'BODY.PEEK[HEADER]' into 'BODY[HEADER]'
-        if part_name.startswith(b'BODY.PEEK'):
-            retrieve_key = b'BODY' + part_name[9:]
-        else:
-            retrieve_key = part_name
+        retrieve_key = response_key(part_name)
+
+        usage = self._connection._part_usage
+        if usage is not None:
+            usage.record(self._data[b'UID'], part_name)
+
+        cache = self._connection._cache
+        if (retrieve_key not in self._data and cache
+                and is_cacheable(part_name)):
+            cached = cache.get_parts([self._data[b'UID']])
+            self._data.update(cached.get(self._data[b'UID'], {}))
+
+        if retrieve_key not in self._data and self._group is not None:
+            parts = self._group.take(self._data, part_name)
+            if parts:
+                self._data.update(parts)
 
         # ask the server for 'part_name', but look in our dictionary with
         # 'retrieve_key'
@@ -73,24 +285,87 @@ class MessageConnectionProxy(object):
                     "Server gave us back some other data: %d %r"
                     % (msg_uid, data)
                 )
+                if cache:
+                    cache.store(msg_uid, data[msg_uid])
         return self._data[retrieve_key]
 
+    def get_header_block(self):
+        """Get the raw header of the message.
+
+        Returns a tuple of (raw_header, fields). If only some header fields
+        were fetched, 'fields' is the set of (lower case) header names that
+        were asked for. Otherwise the full header is returned (and fetched, if
+        needed), and 'fields' is None.
+
+        """
+        if b'BODY[HEADER]' not in self._data:
+            for key in self._data:
+                if key.upper().startswith(b'BODY[HEADER.FIELDS '):
+                    return self._data[key], parse_header_fields(key)
+        return self.get_message_part(b'BODY.PEEK[HEADER]'), None
+
+
+def _has_part(parts, part_name):
+    """Check whether a fetch response in 'parts' satisfies 'part_name'."""
+    key = response_key(part_name)
+    if key in parts:
+        return True
+    # The full header satisfies a request for some header fields:
+    return key.startswith(b'BODY[HEADER.FIELDS ') and b'BODY[HEADER]' in parts
+
 
 class IMAPConnection(object):
 
     """A low-level connection to an imap server. """
 
-    def __init__(self, server_info):
+    def __init__(self, server_info, cache=None, prefetch=0,
+                 scan_options=None, recorder=None):
         """Create an IMAPConnection object.
 
         This method connects to the server, and attempts to log in.
 
+        If 'cache' is set, it must be a MessageCache instance. Immutable
+        message parts will be read from it where possible, rather than being
+        fetched from the server.
+
+        If 'prefetch' is more than zero, 'get_messages' opens a second
+        connection to the server, and uses it to fetch up to that many chunks
+        of messages in the background while earlier chunks are processed.
+
+        'scan_options' is a ScanOptions instance that controls the size of the
+        chunks messages are fetched in, and how many connections they are
+        fetched on. If it is not set, the defaults are used. With more than
+        one connection, 'get_messages' splits the messages into that many UID
+        ranges, and fetches each range on its own connection in the
+        background. That's in addition to this connection, which is still
+        used for everything else.
+
+        If 'recorder' is set, it must be a SessionRecorder. Everything this
+        connection (and its fetch connections) gets from the server is
+        recorded with it, so the session can be replayed with
+        ReplayConnection.
+
         :raises RuntimeError: If the connection or login steps could not be
             completed.
 
         """
+        self._server_info = server_info
+        self._cache = cache
+        self._prefetch = prefetch
+        self._fetch_connections = []
+        self._scan_options = scan_options or ScanOptions()
+        self._recorder = recorder
+        self._stream = None
+        self._part_usage = None
+        self._client = self._connect(server_info)
+        if recorder is not None:
+            self._client = recorder.wrap(self._client)
+        self._folder_cache = FolderCache(self._client)
+
+    def _connect(self, server_info):
+        """Connect to the server and log in. Returns the IMAPClient."""
         try:
-            self._client = IMAPClient(
+            client = IMAPClient(
                 host=server_info.host,
                 port=server_info.port,
                 use_uid=False,
@@ -98,44 +373,603 @@ class IMAPConnection(object):
                 )
         except imaplib.IMAP4.error as e:
             raise RuntimeError("Failed to connect: %s" % e)
-        # self._client.debug = True
+        # client.debug = True
         try:
-            self._client.login(
+            client.login(
                 server_info.username,
                 server_info.password,
             )
         except imaplib.IMAP4.error as e:
             raise RuntimeError("Failed to authenticate: %s" % e)
+        if (server_info.compress
+                and client.has_capability('COMPRESS=DEFLATE')):
+            self._stream = enable_compression(client)
+        return client
+
+    def close(self):
+        """Log out, and close the connections used to fetch in the
+        background.
+
+        If the connections were compressed, the bytes on the wire and the
+        bytes of data they carried are logged.
+
+        """
+        connections = [self] + self._fetch_connections
+        self._log_compression([c._stream for c in connections if c._stream])
+        for connection in connections:
+            connection._logout()
+        self._fetch_connections = []
+
+    def _logout(self):
+        try:
+            self._client.logout()
+        except (imaplib.IMAP4.error, OSError) as e:
+            logging.warning("Failed to log out cleanly: %s", e)
 
-    def get_messages(self):
+    def _log_compression(self, streams):
+        if not streams:
+            return
+        wire = sum(stream.wire_bytes_received for stream in streams)
+        data = sum(stream.data_bytes_received for stream in streams)
+        logging.info(
+            "Compression: received %.1f KiB on the wire for %.1f KiB of data "
+            "(%.1fx), sent %.1f KiB for %.1f KiB.",
+            wire / 1024,
+            data / 1024,
+            data / wire if wire else 1.0,
+            sum(stream.wire_bytes_sent for stream in streams) / 1024,
+            sum(stream.data_bytes_sent for stream in streams) / 1024
+        )
+
+    def get_messages(self, fetch_parts=None, min_uid=None, search=None,
+                     folder="INBOX", exclude_uids=None):
         """A generator that yields Message instances, one for every message
-        in the users inbox.
+        in 'folder' (the users inbox, by default).
+
+        The folder stays selected afterwards, so actions and later calls to
+        'watch_messages' and 'get_messages_by_uid' work on it.
+
+        'fetch_parts' is an iterable of IMAP data items to fetch for every
+        message (see RuleSet.fetch_parts). If it is not set, everything the
+        Message class knows about will be fetched. Parts that are not fetched
+        here are fetched lazily if they are needed.
+
+        If 'min_uid' is set, only messages with a UID greater than or equal to
+        it are returned.
+
+        If 'search' is set, it must be a list of IMAP SEARCH criteria (see
+        RuleSet.get_search_criteria). Only messages the server finds with
+        those criteria are returned.
+
+        If 'exclude_uids' is set, messages with those UIDs are left out. This
+        is used to resume an interrupted scan.
 
         """
-        # TODO - perahps the user wants to filter a different folder?
-        mbox_details = self._client.select_folder("INBOX")
+        fetch_parts = sorted(set(fetch_parts or DEFAULT_FETCH_PARTS) | {UID})
+        mbox_details = self._select_folder(folder)
         total_messages = mbox_details[b'EXISTS']
-        logging.info("Scanning inbox, found %d messages" % total_messages)
-        # TODO: Research best chunk size - maybe let user tweak this from
-        # config file?:
-        i = 0
-        with self.use_sequence():
-            for chunk in sequence_chunk(
-                                        total_messages,
-                                        optimal_chunk_size(1000)):
-                logging.info("Fetching: " + chunk)
-                data = self._client.fetch(
-                    chunk,
-                    ['UID', 'BODY.PEEK[HEADER]', 'INTERNALDATE', 'FLAGS']
+        if self._cache:
+            self._cache.select_folder(folder, mbox_details[b'UIDVALIDITY'])
+        for fetcher in self._get_fetch_connections():
+            fetcher._select_folder(folder, readonly=True)
+        if search is not None:
+            if min_uid is not None:
+                search = ['UID', '%d:*' % min_uid] + list(search)
+            yield from self._search_messages(
+                fetch_parts, search, min_uid or 1, prefetch=True,
+                exclude_uids=exclude_uids)
+        elif min_uid is None:
+            logging.info(
+                "Scanning %s, found %d messages", folder, total_messages)
+            if self._scan_options.connections > 1 or exclude_uids:
+                # Splitting the folder into ranges, or leaving messages out,
+                # needs the UIDs up front:
+                seen_uids = yield from self._search_messages(
+                    fetch_parts, ['ALL'], prefetch=True,
+                    exclude_uids=exclude_uids)
+            else:
+                sizer = ChunkSizer(self._scan_options)
+                with self.use_sequence():
+                    seen_uids = yield from self._get_chunked_messages(
+                        sequence_chunk(total_messages, sizer),
+                        fetch_parts,
+                        total_messages,
+                        prefetch=True,
+                        sizer=sizer
+                    )
+            if self._cache:
+                # We've seen every message in the folder, so anything else in
+                # the cache has been deleted or moved elsewhere:
+                self._cache.retain(seen_uids)
+                self._cache.commit()
+        else:
+            yield from self._get_messages_since(
+                fetch_parts, min_uid, prefetch=True,
+                exclude_uids=exclude_uids)
+
+    def _select_folder(self, folder, readonly=False):
+        """Select 'folder', remembering how many messages it has."""
+        mbox_details = self._client.select_folder(folder, readonly=readonly)
+        self._exists = mbox_details[b'EXISTS']
+        return mbox_details
+
+    def watch_messages(self, fetch_parts=None, min_uid=1,
+                       idle_refresh=IDLE_REFRESH_INTERVAL, scheduler=None,
+                       before_wait=None):
+        """A generator that yields new messages as they arrive in the selected
+        folder.
+
+        This method never returns. It yields any messages with a UID greater
+        than or equal to 'min_uid' (so pass one more than the highest UID
+        already processed), then waits for the server to announce new
+        messages using IDLE, and yields those.
+
+        'get_messages' must have been called first, so the folder is
+        selected. 'fetch_parts' is as for 'get_messages'.
+
+        IDLE is re-issued every 'idle_refresh' seconds, with a NOOP in between
+        to keep the connection alive. If the server doesn't support IDLE, we
+        poll it with NOOP at that interval instead.
+
+        If 'scheduler' is set, it must be a RetestScheduler. Messages are
+        also yielded again when they're due to be re-tested.
+
+        If 'before_wait' is set, it's called with no arguments every time
+        we've yielded all the messages we know about and are about to wait
+        for more. This is a good time to flush batched actions.
+
+        """
+        fetch_parts = sorted(set(fetch_parts or DEFAULT_FETCH_PARTS) | {UID})
+        while True:
+            for message in self._get_messages_since(fetch_parts, min_uid):
+                min_uid = max(min_uid, message.uid() + 1)
+                yield message
+            timeout = idle_refresh
+            if scheduler is not None:
+                due = scheduler.pop_due()
+                if due:
+                    yield from self.get_messages_by_uid(fetch_parts, due)
+                next_retest = scheduler.seconds_until_next_retest()
+                if next_retest is not None:
+                    timeout = min(timeout, next_retest)
+            if before_wait is not None:
+                before_wait()
+            self._wait_for_new_messages(timeout)
+
+    def get_messages_by_uid(self, fetch_parts, uids):
+        """Yield a Message for each message in 'uids' that still exists.
+
+        The folder must already be selected.
+
+        """
+        fetch_parts = sorted(set(fetch_parts or DEFAULT_FETCH_PARTS) | {UID})
+        uids = sorted(uids)
+        logging.info("Re-testing %d messages", len(uids))
+        sizer = ChunkSizer(self._scan_options)
+        with self.use_uid():
+            yield from self._get_chunked_messages(
+                uid_chunk(uids, sizer),
+                fetch_parts,
+                len(uids),
+                sizer=sizer
+            )
+
+    def _wait_for_new_messages(self, timeout):
+        """Wait up to 'timeout' seconds for the server to report new messages.
+
+        Returns True if the server sent an EXISTS response, False otherwise.
+
+        """
+        if not self._client.has_capability('IDLE'):
+            time.sleep(timeout)
+            self._client.noop()
+            return True
+        self._client.idle()
+        try:
+            deadline = time.monotonic() + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                responses = self._client.idle_check(timeout=remaining)
+                if any(r[1:2] == (b'EXISTS',) for r in responses):
+                    logging.debug("IDLE reported new messages.")
+                    return True
+        finally:
+            self._client.idle_done()
+        logging.debug("Refreshing IDLE.")
+        self._client.noop()
+        return False
+
+    def _get_messages_since(self, fetch_parts, min_uid, prefetch=False,
+                            exclude_uids=None):
+        """Yield a Message for every message with UID >= 'min_uid'."""
+        yield from self._search_messages(
+            fetch_parts, ['UID', '%d:*' % min_uid], min_uid, prefetch,
+            exclude_uids)
+
+    def _search_messages(self, fetch_parts, criteria, min_uid=1,
+                         prefetch=False, exclude_uids=None):
+        """Yield a Message for every message matching 'criteria'.
+
+        Only messages with UID >= 'min_uid' are returned. This is needed
+        because 'n:*' always includes the message with the highest UID, even
+        if that is lower than 'n'. Messages in 'exclude_uids' are left out.
+
+        If 'prefetch' is set, messages may be fetched in the background, on
+        several connections if the scan options ask for them. Otherwise this
+        connection is used.
+
+        Returns an array of the UIDs that were seen, including any that were
+        left out because they're in 'exclude_uids'.
+
+        """
+        with self.use_uid():
+            uids = [
+                uid for uid in self._client.search(criteria)
+                if uid >= min_uid
+            ]
+            logging.info(
+                "Searching, found %d messages matching %r",
+                len(uids),
+                criteria
+            )
+            excluded = []
+            if exclude_uids:
+                excluded = [uid for uid in uids if uid in exclude_uids]
+                uids = [uid for uid in uids if uid not in exclude_uids]
+                logging.info(
+                    "Resuming: %d messages were already tested, %d to go",
+                    len(excluded),
+                    len(uids)
+                )
+            if prefetch and self._scan_options.connections > 1:
+                seen_uids = yield from self._get_parallel_messages(
+                    uids, fetch_parts)
+            else:
+                sizer = ChunkSizer(self._scan_options)
+                seen_uids = yield from self._get_chunked_messages(
+                    uid_chunk(uids, sizer),
+                    fetch_parts,
+                    len(uids),
+                    prefetch,
+                    sizer
                 )
-                for msg_seq in data:
-                    logging.debug("Processing %d / %d", i, total_messages)
-                    proxy = MessageConnectionProxy(self, data[msg_seq])
-                    yield Message(proxy)
-                    i += 1
+            seen_uids.extend(excluded)
+            return seen_uids
+
+    def supports_substring_search(self):
+        """Check whether SEARCH does substring matching on text.
+
+        GMail matches whole words instead, so text search criteria can't be
+        used to narrow down the messages we test.
+
+        """
+        return not self._client.has_capability('X-GM-EXT-1')
+
+    def _get_chunked_messages(self, chunks, fetch_parts, total_messages,
+                              prefetch=False, sizer=None):
+        """Yield a Message for every message in 'chunks'.
+
+        If 'prefetch' is set, and this connection was created with a prefetch
+        depth, chunks are fetched in the background on the fetch connection,
+        which must have the same folder selected.
+
+        If 'sizer' is set, the time and size of every fetch is recorded with
+        it. It should be the ChunkSizer that 'chunks' is generated from.
+
+        Otherwise, chunks are fetched on this connection, and streamed if
+        possible, so each message is yielded as soon as it arrives.
+
+        Returns an array of the UIDs that were seen.
+
+        """
+        if prefetch and self._prefetch:
+            fetched = self._prefetch_chunks(chunks, fetch_parts, sizer)
+        else:
+            fetched = self._fetch_chunks(
+                chunks, fetch_parts, sizer, self._can_stream())
+        return (yield from self._get_fetched_messages(fetched, total_messages))
+
+    def _get_parallel_messages(self, uids, fetch_parts):
+        """Yield a Message for every message in 'uids', fetched in parallel.
+
+        'uids' is split into one contiguous range per fetch connection, and
+        each range is fetched in its own thread. Messages are yielded in the
+        order they arrive, so they aren't sorted by UID.
+
+        Returns an array of the UIDs that were seen.
+
+        """
+        fetchers = self._get_fetch_connections()
+        count = min(len(fetchers), len(uids))
+        ranges = [
+            uids[len(uids) * i // count:len(uids) * (i + 1) // count]
+            for i in range(count)
+        ]
+        logging.info(
+            "Fetching %d messages on %d connections", len(uids), count)
+
+        def fetch_range(fetcher, range_uids):
+            fetcher._client.use_uid = True
+            sizer = ChunkSizer(self._scan_options)
+            yield from fetcher._fetch_chunks(
+                uid_chunk(range_uids, sizer), fetch_parts, sizer)
+        fetched = merge(
+            [fetch_range(f, r) for f, r in zip(fetchers, ranges)],
+            count * max(1, self._prefetch)
+        )
+        return (yield from self._get_fetched_messages(fetched, len(uids)))
+
+    def _get_fetched_messages(self, fetched, total_messages):
+        """Yield a Message for every message in the 'fetched' FetchedChunks.
+
+        Parts that weren't fetched are fetched lazily, for a chunk at a time,
+        on this connection.
+
+        Returns an array of the UIDs that were seen. An array rather than a
+        list, so it's small even for a huge folder.
+
+        """
+        seen_uids = array('L')
+        i = 0
+        for chunk in fetched:
+            group = LazyFetchGroup(self, chunk.ids, chunk.use_uid)
+            for record in chunk.messages:
+                logging.debug("Processing %d / %d", i, total_messages)
+                seen_uids.append(record[b'UID'])
+                yield Message(MessageConnectionProxy(self, record, group))
+                i += 1
+        return seen_uids
+
+    def get_folder_status(self, folder="INBOX"):
+        """Get the UIDVALIDITY and UIDNEXT values for 'folder'.
+
+        If the server supports CONDSTORE, HIGHESTMODSEQ is included too
+        (unless the folder doesn't keep mod-sequences). This does not select
+        the folder.
+
+        """
+        items = ['UIDVALIDITY', 'UIDNEXT']
+        if self.supports_condstore():
+            items.append('HIGHESTMODSEQ')
+        return self._client.folder_status(folder, items)
+
+    def supports_condstore(self):
+        """Check whether the server keeps a mod-sequence for every message.
+
+        See RFC 7162. QRESYNC implies CONDSTORE.
+
+        """
+        return (self._client.has_capability('CONDSTORE')
+                or self._client.has_capability('QRESYNC'))
+
+    def get_changed_uids(self, modseq, max_uid):
+        """Get the UIDs of messages changed since mod-sequence 'modseq'.
+
+        Only messages in the selected folder with UIDs up to 'max_uid' are
+        considered. Changing a message's flags changes its mod-sequence, so
+        this finds the messages whose flags changed, without fetching the
+        flags of every message. The server must support CONDSTORE.
+
+        """
+        if max_uid < 1:
+            return []
+        with self.use_uid():
+            uids = self._client.search(
+                ['UID', '1:%d' % max_uid, 'MODSEQ', modseq + 1])
+        logging.info(
+            "%d messages have changed since mod-sequence %d",
+            len(uids),
+            modseq
+        )
+        return list(uids)
+
+    def _fetch_chunks(self, chunks, fetch_parts, sizer=None, stream=False):
+        """Fetch 'chunks', yielding a FetchedChunk for each one.
+
+        The messages are a MessageChunk. If 'stream' is set, each chunk is
+        yielded straight away, and its messages are a generator that yields
+        the parts of each message as they arrive. It must be read to the end
+        before the next chunk is fetched.
+
+        """
+        for chunk in chunks:
+            logging.info("Fetching: %s", chunk_description(chunk))
+            ids = chunk
+            if isinstance(chunk, str):
+                ids = sequence_set_ids(chunk, self._exists)
+            use_uid = self._client.use_uid
+            if stream:
+                yield FetchedChunk(
+                    ids, use_uid,
+                    self._stream_chunk(chunk, ids, fetch_parts, sizer))
+                continue
+            start = time.monotonic()
+            data = self._fetch_chunk(chunk, fetch_parts)
+            elapsed = time.monotonic() - start
+            self._record_fetch(len(data), response_size(data), elapsed, sizer)
+            fetched = FetchedChunk(ids, use_uid, MessageChunk(data.values()))
+            # Don't keep the response alive while the chunk is processed:
+            del data
+            yield fetched
+
+    def _stream_chunk(self, chunk, ids, fetch_parts, sizer=None):
+        """Stream the fetch of 'chunk', yielding the parts of each message.
+
+        With a cache, only the parts that can't be cached are streamed, and
+        cached parts are added to each message as it arrives. Once a message
+        that isn't fully cached arrives, it and the messages after it are
+        held back, so they're still yielded in order, and what they're
+        missing is fetched by UID when the stream has finished.
+
+        """
+        cacheable = []
+        if self._cache:
+            cacheable = [p for p in fetch_parts if is_cacheable(p)]
+            fetch_parts = [p for p in fetch_parts if not is_cacheable(p)]
+        stream = FetchStream(self._client, chunk, ids, fetch_parts)
+        count = 0
+        held = []
+        missing = []
+        for msg_id, parts in stream:
+            count += 1
+            if cacheable:
+                msg_uid = parts[b'UID']
+                cached = self._cache.get_parts([msg_uid]).get(msg_uid, {})
+                parts.update(cached)
+                if not all(_has_part(cached, p) for p in cacheable):
+                    missing.append(parts)
+            if held or missing:
+                held.append(parts)
+            else:
+                yield parts
+        size_bytes = stream.size_bytes
+        elapsed = stream.seconds
+        if missing:
+            logging.debug("%d of %d messages not cached", len(missing), count)
+            start = time.monotonic()
+            size_bytes += response_size(
+                self._fetch_uncached(missing, cacheable))
+            elapsed += time.monotonic() - start
+        self._record_fetch(count, size_bytes, elapsed, sizer)
+        yield from held
+
+    def _record_fetch(self, count, size_bytes, elapsed, sizer=None):
+        """Log the rate of a fetch, and record it with 'sizer', if set."""
+        logging.info(
+            "Fetched %d messages (%d KiB) in %.2fs: %.0f messages/s, "
+            "%.0f KiB/s",
+            count,
+            size_bytes // 1024,
+            elapsed,
+            count / elapsed if elapsed else 0,
+            size_bytes / 1024 / elapsed if elapsed else 0,
+        )
+        if sizer is not None:
+            sizer.record(count, size_bytes, elapsed)
+            logging.debug("Next chunk size: %d", sizer.size)
+
+    def _can_stream(self):
+        """Check whether fetches on this connection can be streamed.
+
+        FetchStream needs a real IMAPClient, rather than a recording or
+        replaying one.
+
+        """
+        return isinstance(self._client, IMAPClient)
+
+    def _prefetch_chunks(self, chunks, fetch_parts, sizer=None):
+        """Fetch 'chunks' on a fetch connection in a background thread."""
+        fetcher = self._get_fetch_connections()[0]
+        # The fetch connection must address messages the same way we do:
+        use_uid = self._client.use_uid
+
+        def fetch_chunks():
+            fetcher._client.use_uid = use_uid
+            yield from fetcher._fetch_chunks(chunks, fetch_parts, sizer)
+        return prefetch(fetch_chunks(), self._prefetch)
+
+    def _get_fetch_connections(self):
+        """Get the connections used to fetch in the background.
+
+        Connections are opened the first time they're needed. Messages are
+        only fetched on them. Lazy fetches and actions still use this
+        connection, so the folder must be selected on all of them.
+
+        """
+        if self._scan_options.connections > 1:
+            count = self._scan_options.connections
+        else:
+            count = 1 if self._prefetch else 0
+        while len(self._fetch_connections) < count:
+            logging.debug(
+                "Opening fetch connection %d of %d.",
+                len(self._fetch_connections) + 1,
+                count
+            )
+            self._fetch_connections.append(type(self)(
+                self._server_info, self._cache,
+                scan_options=self._scan_options,
+                recorder=self._recorder))
+        return self._fetch_connections[:count]
+
+    def _fetch_chunk(self, chunk, fetch_parts):
+        """Fetch 'fetch_parts' for messages in 'chunk'.
+
+        If we have a cache, only the mutable parts are fetched for the whole
+        chunk. Immutable parts are read from the cache, and only fetched for
+        the messages that are missing from it.
+
+        """
+        if not self._cache:
+            return self._fetch(chunk, fetch_parts)
+        cacheable = [p for p in fetch_parts if is_cacheable(p)]
+        data = self._fetch(
+            chunk,
+            [p for p in fetch_parts if not is_cacheable(p)]
+        )
+        cached = self._cache.get_parts(msg[b'UID'] for msg in data.values())
+        missing = []
+        for msg in data.values():
+            parts = cached.get(msg[b'UID'], {})
+            msg.update(parts)
+            if not all(_has_part(parts, p) for p in cacheable):
+                missing.append(msg)
+        if missing and cacheable:
+            logging.debug(
+                "%d of %d messages not cached", len(missing), len(data))
+            self._fetch_uncached(missing, cacheable)
+        return data
+
+    def _fetch_uncached(self, messages, cacheable):
+        """Fetch the 'cacheable' parts of 'messages' by UID, and cache them.
+
+        'messages' is a list of fetched parts, which are updated with what's
+        fetched. Returns the fetch response.
+
+        """
+        by_uid = {msg[b'UID']: msg for msg in messages}
+        with self.use_uid():
+            fetched = self._client.fetch(list(by_uid), cacheable)
+        for uid, parts in fetched.items():
+            by_uid[uid].update(parts)
+            self._cache.store(uid, parts)
+        self._cache.commit()
+        return fetched
+
+    def _fetch(self, messages, fetch_parts):
+        """Fetch like IMAPClient.fetch, but always include the UID.
+
+        In UID mode, IMAPClient keys the response by UID, and leaves the UID
+        out of the data for each message.
+
+        IMAPClient 3.0 and later match the responses against the message ids
+        they were asked for, which they need as ints, so sequence sets from
+        sequence_chunk are expanded. '*' is the last message there was when
+        the folder was selected.
+
+        """
+        if isinstance(messages, str):
+            messages = sequence_set_ids(messages, self._exists)
+        data = self._client.fetch(messages, fetch_parts)
+        if self._client.use_uid:
+            for msg_uid, parts in data.items():
+                parts.setdefault(b'UID', msg_uid)
+        return data
 
     def get_connection_proxy(self):
-        return ConnectionProxy(self._client)
+        return ConnectionProxy(self._client, self._folder_cache)
+
+    @contextmanager
+    def record_part_usage(self, usage):
+        """Record the parts messages read in 'usage', a PartUsage."""
+        old = self._part_usage
+        self._part_usage = usage
+        try:
+            yield
+        finally:
+            self._part_usage = old
 
     @contextmanager
     def use_uid(self):
@@ -156,18 +990,96 @@ class IMAPConnection(object):
             self._client.use_uid = old
 
 
+class FolderCache(object):
+
+    """Remember which folders exist on the server.
+
+    The folder list is fetched with a single LIST command the first time it's
+    needed, and kept up to date as folders are created, deleted and renamed
+    through ConnectionProxy.
+
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._folders = None
+        self._delimiter = None
+
+    def _normalise(self, folder):
+        # 'Junk/' and 'Junk' are the same folder:
+        if self._delimiter and len(folder) > 1:
+            return folder.rstrip(self._delimiter)
+        return folder
+
+    def _load(self):
+        if self._folders is None:
+            self._folders = set()
+            for flags, delimiter, name in self._client.list_folders():
+                if isinstance(delimiter, bytes):
+                    delimiter = delimiter.decode()
+                self._delimiter = self._delimiter or delimiter
+                self._folders.add(name)
+            logging.debug("Found %d folders", len(self._folders))
+
+    def exists(self, folder):
+        self._load()
+        return self._normalise(folder) in self._folders
+
+    def add(self, folder):
+        if self._folders is not None:
+            self._folders.add(self._normalise(folder))
+
+    def remove(self, folder):
+        if self._folders is not None:
+            self._folders.discard(self._normalise(folder))
+
+
 class ConnectionProxy(object):
 
     """A class that proxies an IMAPClient object, but hides access to methods
     that filter Actions should not call.
 
+    If 'folder_cache' is set, 'folder_exists' is answered from it, and it's
+    kept up to date when folders are created, deleted or renamed.
+
     """
-    def __init__(self, wrapped):
+
+    _folder_methods = (
+        'create_folder',
+        'delete_folder',
+        'folder_exists',
+        'rename_folder',
+    )
+
+    def __init__(self, wrapped, folder_cache=None):
         self._wrapped = wrapped
+        self._folder_cache = folder_cache
+
+    def _folder_exists(self, folder):
+        return self._folder_cache.exists(folder)
+
+    def _create_folder(self, folder):
+        result = self._wrapped.create_folder(folder)
+        self._folder_cache.add(folder)
+        return result
+
+    def _delete_folder(self, folder):
+        result = self._wrapped.delete_folder(folder)
+        self._folder_cache.remove(folder)
+        return result
+
+    def _rename_folder(self, old_name, new_name):
+        result = self._wrapped.rename_folder(old_name, new_name)
+        self._folder_cache.remove(old_name)
+        self._folder_cache.add(new_name)
+        return result
 
     def __getattribute__(self, name):
-        if name == '_wrapped':
+        if name in ('_wrapped', '_folder_cache'):
             return super().__getattribute__(name)
+        if (name in ConnectionProxy._folder_methods
+                and self._folder_cache is not None):
+            return super().__getattribute__('_' + name)
 
         allowed = (
             'add_flags',
@@ -176,16 +1088,21 @@ class ConnectionProxy(object):
             'create_folder',
             'delete_folder',
             'delete_messages',
+            'expunge',
             'folder_exists',
             'get_flags',
             'get_gmail_labels',
+            'has_capability',
             'list_folders',
             'list_sub_folders',
+            'move',
             'remove_flags',
             'remove_gmail_labels',
             'rename_folder',
+            'search',
             'set_flags',
             'set_gmail_labels',
+            'uid_expunge',
         )
         if name in allowed:
             # Wrap these functions so they always use the uid, not the sequence
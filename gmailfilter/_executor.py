@@ -0,0 +1,97 @@
+
+"""Code for running actions on messages."""
+
+import logging
+
+from gmailfilter.actions import BatchAction
+
+
+class ActionExecutor(object):
+
+    """Run actions on messages immediately."""
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def run(self, action, message):
+        action.process(self._connection, message)
+
+    def flush(self):
+        """Finish running any actions that have been deferred."""
+
+    @property
+    def pending_uids(self):
+        """The UIDs of messages with actions that have been deferred."""
+        return frozenset()
+
+
+class BatchingActionExecutor(ActionExecutor):
+
+    """Run actions, collecting batchable actions into one command per batch.
+
+    Actions that implement 'process_batch' (see actions.BatchAction) are not
+    run straight away. Instead, the UIDs of their messages are collected
+    per batch key (for Move, that's the target folder), and the action is
+    run once for all of them when 'flush' is called. Other actions are run
+    immediately.
+
+    Batched actions may expunge messages, which changes message sequence
+    numbers, so only call 'flush' when that can't confuse a scan in
+    progress.
+
+    """
+
+    def __init__(self, connection):
+        super().__init__(connection)
+        # batch key -> (action, [uid, ...]), in the order batches started:
+        self._batches = {}
+        self._pending_uids = set()
+
+    def run(self, action, message):
+        if not _is_batchable(action):
+            action.process(self._connection, message)
+            return
+        uid = message.uid()
+        if uid in self._pending_uids:
+            # An earlier action is already pending for this message (two
+            # Moves in one rule, for example). Run that first, so actions
+            # happen in the order they were given:
+            self.flush()
+        action.log_message(message)
+        key = action.get_batch_key()
+        if key is None:
+            key = action
+        if key not in self._batches:
+            self._batches[key] = (action, [])
+        self._batches[key][1].append(uid)
+        self._pending_uids.add(uid)
+
+    @property
+    def pending_uids(self):
+        return frozenset(self._pending_uids)
+
+    def flush(self):
+        # Batches are only dropped once they've run, so if one fails (when
+        # the connection drops, say), its messages and those of the batches
+        # after it are still in 'pending_uids':
+        while self._batches:
+            key = next(iter(self._batches))
+            action, uids = self._batches[key]
+            logging.debug("Running %r on %d messages", key, len(uids))
+            action.process_batch(self._connection, uids)
+            del self._batches[key]
+            self._pending_uids.difference_update(uids)
+
+
+def _is_batchable(action):
+    """Does 'action' implement 'process_batch'?
+
+    BatchAction's own 'process_batch' does nothing, so subclasses that don't
+    override it aren't batched.
+
+    """
+    process_batch = getattr(type(action), 'process_batch', None)
+    return (
+        callable(process_batch)
+        and process_batch is not BatchAction.process_batch
+    )
@@ -0,0 +1,379 @@
+
+"""Filter many accounts from one process, on a pool of worker processes.
+
+A fleet directory has one subdirectory per account, holding that account's
+credentials.ini and rules.py. The account's message cache, checkpoint and
+journal are kept in the same subdirectory. Each account is filtered by a worker
+process, much as a plain 'gmailfilter' run would filter it, but the workers
+are reused, so interpreter start-up and loading rules files that several
+accounts share only happen once per worker.
+
+"""
+
+from collections import namedtuple
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    wait,
+)
+import hashlib
+import logging
+import os
+import os.path
+import time
+
+from gmailfilter._cache import MessageCache
+from gmailfilter._checkpoint import (
+    FetchProfile,
+    ScanCheckpoint,
+    ScanJournal,
+)
+from gmailfilter._config import (
+    ScanOptions,
+    ServerInfo,
+)
+from gmailfilter._connection import IMAPConnection
+from gmailfilter._rules import (
+    RuleLoadError,
+    load_folder_rules,
+)
+from gmailfilter._scan import scan_folder
+
+
+CREDENTIALS_FILE = 'credentials.ini'
+RULES_FILE = 'rules.py'
+CACHE_FILE = 'cache.sqlite'
+CHECKPOINT_FILE = 'checkpoint.json'
+JOURNAL_FILE = 'journal.json'
+PROFILE_FILE = 'profile.json'
+
+# GMail allows 15 connections per account at once:
+DEFAULT_ACCOUNT_CONNECTIONS = 15
+
+
+class Account(namedtuple('Account', ['name', 'directory'])):
+
+    """An account in a fleet directory."""
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+
+def find_accounts(directory):
+    """Get the accounts in fleet directory 'directory', sorted by name.
+
+    Every subdirectory with a credentials file is an account.
+
+    """
+    accounts = []
+    for name in sorted(os.listdir(directory)):
+        account = Account(name, os.path.join(directory, name))
+        if os.path.isfile(account.path(CREDENTIALS_FILE)):
+            accounts.append(account)
+    return accounts
+
+
+class FleetOptions(object):
+
+    """Options for filtering every account in a fleet.
+
+    These are the same for every account. 'rescan_interval' is in seconds,
+    and 'account_connections' is the most connections to open to any one
+    account at once. The rest are as for a plain gmailfilter run.
+
+    """
+
+    def __init__(self, incremental=False, rescan_interval=24 * 3600,
+                 search=True, use_cache=True, prefetch=0,
+                 account_connections=DEFAULT_ACCOUNT_CONNECTIONS,
+                 use_profile=True):
+        if account_connections < 1:
+            raise ValueError("account_connections must be at least 1")
+        self.incremental = incremental
+        self.rescan_interval = rescan_interval
+        self.search = search
+        self.use_cache = use_cache
+        self.prefetch = prefetch
+        self.account_connections = account_connections
+        self.use_profile = use_profile
+
+
+def get_account_scan_options(account, options):
+    """Read the scan options for 'account', limited by 'options'.
+
+    Returns a tuple of (scan_options, prefetch, connections), where
+    'connections' is how many connections scanning the account will open.
+    Parallel fetch connections and prefetching are cut back so that's no
+    more than 'options.account_connections'.
+
+    :raises RuntimeError: If the account's scan options can't be read.
+
+    """
+    scan_options = ScanOptions.read_config_file(
+        account.path(CREDENTIALS_FILE))
+    prefetch = options.prefetch
+    limit = options.account_connections
+    if scan_options.connections > 1:
+        # Fetch connections are in addition to the main connection:
+        scan_options.connections = min(scan_options.connections, limit - 1)
+        if scan_options.connections < 2:
+            scan_options.connections = 1
+    if scan_options.connections > 1:
+        connections = 1 + scan_options.connections
+    else:
+        if limit < 2:
+            prefetch = 0
+        connections = 2 if prefetch else 1
+    return scan_options, prefetch, connections
+
+
+# The result of filtering one account. 'error' is None if it succeeded:
+AccountResult = namedtuple(
+    'AccountResult', ['name', 'messages', 'seconds', 'error'])
+
+
+# Rules loaded by this (worker) process, by the hash of the rules file:
+_loaded_rules = {}
+
+
+def _load_rules(path):
+    """Load folder rules, reusing any loaded from an identical file."""
+    try:
+        with open(path, 'rb') as rules_file:
+            source_hash = hashlib.sha256(rules_file.read()).hexdigest()
+    except FileNotFoundError:
+        # Unlike a plain run, don't write a default rules file that would
+        # then be used on the next pass:
+        raise RuleLoadError("No rules file found at {}.".format(path))
+    if source_hash not in _loaded_rules:
+        _loaded_rules[source_hash] = load_folder_rules(path)
+    return _loaded_rules[source_hash]
+
+
+def filter_account(account, options):
+    """Filter every folder of 'account'. This runs in a worker process.
+
+    Returns an AccountResult. Errors are logged and reported in the result
+    rather than raised, so one broken account doesn't stop the others.
+
+    """
+    start = time.monotonic()
+    messages = 0
+    error = None
+    try:
+        server_info = ServerInfo.read_config_file(
+            account.path(CREDENTIALS_FILE))
+        scan_options, prefetch, _ = get_account_scan_options(account, options)
+        rulesets = _load_rules(account.path(RULES_FILE))
+        cache = None
+        if options.use_cache:
+            cache = MessageCache(account.path(CACHE_FILE))
+        try:
+            connection = IMAPConnection(
+                server_info, cache, prefetch, scan_options)
+            try:
+                messages = _scan_account(
+                    connection, rulesets, options, account)
+            finally:
+                connection.close()
+        finally:
+            if cache:
+                cache.close()
+    except KeyError as e:
+        error = "Could not find required credentials key '{}'.".format(
+            e.args[0])
+    except (OSError, RuntimeError, RuleLoadError) as e:
+        error = str(e)
+    except Exception as e:
+        logging.exception("Failed to filter account %s", account.name)
+        error = str(e) or repr(e)
+    return AccountResult(
+        account.name, messages, time.monotonic() - start, error)
+
+
+def _scan_account(connection, rulesets, options, account):
+    checkpoint = None
+    if options.incremental:
+        checkpoint = ScanCheckpoint(account.path(CHECKPOINT_FILE))
+    # If a scan is interrupted, the next pass resumes it:
+    journal = ScanJournal(account.path(JOURNAL_FILE))
+    profile = None
+    if options.use_profile:
+        profile = FetchProfile(account.path(PROFILE_FILE))
+    messages = 0
+    for folder in sorted(rulesets):
+        messages += scan_folder(
+            connection,
+            folder,
+            rulesets[folder],
+            checkpoint,
+            options.rescan_interval,
+            search=options.search and not options.incremental,
+            journal=journal,
+            profile=profile
+        ).messages
+    if checkpoint is not None:
+        checkpoint.save()
+    if profile is not None:
+        profile.save()
+    return messages
+
+
+class FleetScheduler(object):
+
+    """Decide which account to filter next.
+
+    'accounts' is a dictionary mapping accounts to the number of connections
+    filtering them opens. At most 'max_connections' are open at once
+    (although an account that needs more than that may still run alone),
+    and no account is filtered twice at once.
+
+    Accounts are started in the order they became due, so the one that has
+    waited longest always goes next. If it doesn't fit in the connections
+    that are left, nothing is started ahead of it, so accounts that need
+    many connections aren't starved by a stream of small ones.
+
+    If 'interval' is set, each account is due again 'interval' seconds after
+    its last run finished. Otherwise every account is filtered once.
+
+    """
+
+    def __init__(self, accounts, max_connections, interval=None, now=0):
+        self._connections = {
+            account: min(connections, max_connections)
+            for account, connections in accounts.items()
+        }
+        self._free_connections = max_connections
+        self._interval = interval
+        self._due = {account: now for account in accounts}
+        self._running = set()
+
+    @property
+    def done(self):
+        return not self._due
+
+    def next_account(self, now):
+        """Start and return the next account to filter, or None."""
+        waiting = [
+            (due, account) for account, due in self._due.items()
+            if due <= now and account not in self._running
+        ]
+        if not waiting:
+            return None
+        due, account = min(waiting)
+        if self._connections[account] > self._free_connections:
+            return None
+        self._free_connections -= self._connections[account]
+        self._running.add(account)
+        return account
+
+    def finished(self, account, now):
+        """Record that 'account' has been filtered."""
+        self._running.remove(account)
+        self._free_connections += self._connections[account]
+        if self._interval is None:
+            del self._due[account]
+        else:
+            self._due[account] = now + self._interval
+
+    def seconds_until_due(self, now):
+        """Get how long until an account that isn't due yet is due.
+
+        Returns None if there are no such accounts.
+
+        """
+        waits = [
+            due - now for account, due in self._due.items()
+            if due > now and account not in self._running
+        ]
+        return min(waits) if waits else None
+
+
+class FleetReport(object):
+
+    """Totals for the accounts filtered since 'start'."""
+
+    def __init__(self, start):
+        self.start = start
+        self.accounts = 0
+        self.failures = 0
+        self.messages = 0
+
+    def add(self, result):
+        self.accounts += 1
+        self.messages += result.messages
+        if result.error is None:
+            logging.info(
+                "Filtered %d messages in account %s in %.1fs.",
+                result.messages,
+                result.name,
+                result.seconds
+            )
+        else:
+            self.failures += 1
+            logging.error(
+                "Failed to filter account %s: %s", result.name, result.error)
+
+    def log(self, now):
+        elapsed = now - self.start
+        logging.info(
+            "Filtered %d messages in %d accounts in %.1fs "
+            "(%.1f messages/s), %d failed.",
+            self.messages,
+            self.accounts,
+            elapsed,
+            self.messages / elapsed if elapsed > 0 else 0,
+            self.failures
+        )
+
+
+def run_fleet(accounts, options, workers, max_connections, interval=None,
+              executor=None):
+    """Filter 'accounts' on a pool of 'workers' worker processes.
+
+    The accounts are scheduled by a FleetScheduler. Totals are logged
+    whenever no accounts are running, which is only at the end unless
+    'interval' is set, in which case this runs forever.
+
+    'executor' is the concurrent.futures executor to run accounts on. By
+    default a ProcessPoolExecutor is created.
+
+    Returns the FleetReport for the last accounts that were filtered.
+
+    """
+    report = FleetReport(time.monotonic())
+    connections = {}
+    for account in accounts:
+        try:
+            _, _, connections[account] = get_account_scan_options(
+                account, options)
+        except RuntimeError as e:
+            report.add(AccountResult(account.name, 0, 0, str(e)))
+    scheduler = FleetScheduler(
+        connections, max_connections, interval, time.monotonic())
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    running = {}
+    with executor:
+        while not scheduler.done:
+            now = time.monotonic()
+            while len(running) < workers:
+                account = scheduler.next_account(now)
+                if account is None:
+                    break
+                future = executor.submit(filter_account, account, options)
+                running[future] = account
+            timeout = scheduler.seconds_until_due(now)
+            if not running:
+                report.log(now)
+                time.sleep(timeout)
+                report = FleetReport(time.monotonic())
+                continue
+            finished, _ = wait(
+                running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in finished:
+                account = running.pop(future)
+                scheduler.finished(account, time.monotonic())
+                report.add(future.result())
+    report.log(time.monotonic())
+    return report
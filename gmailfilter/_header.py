@@ -0,0 +1,182 @@
+"""Parse message headers lazily, from the raw bytes the server sent.
+
+Building an email.message.Message for every message means parsing every
+field of its header, and decoding the header to text first, which fails for
+the 8-bit headers some mailers send. Rules usually read one or two fields,
+so MessageHeader finds where each field is in a single pass over the raw
+header, and only unfolds and decodes (including RFC 2047 encoded words) the
+fields that are read.
+
+"""
+
+import base64
+import binascii
+import codecs
+import re
+
+
+# A field name starts a line, and runs to a ':'. Lines that start with white
+# space continue the field before them, so a value ends at the first line
+# break that isn't followed by white space:
+_FIELD_NAME = re.compile(rb'\n([^\s:]+)[ \t]*:')
+_VALUE_END = re.compile(rb'\r?\n(?![ \t])')
+_FOLD = re.compile(rb'\r?\n(?=[ \t])')
+_ENCODED_WORD = re.compile(r'=\?([^?\s]+)\?([QqBb])\?([^?\s]*)\?=')
+
+
+class MessageHeader(object):
+
+    """A message header, parsed lazily from its raw bytes.
+
+    Field names are case-insensitive. As for email.message.Message, indexing
+    returns the first value of a field, or None if the field isn't there,
+    and 'get_all' returns all the values of a repeated field. Values are
+    unfolded, and their encoded words decoded.
+
+    """
+
+    def __init__(self, raw):
+        end = raw.find(b'\r\n\r\n')
+        if end < 0:
+            end = raw.find(b'\n\n')
+        self._raw = raw[:end + 2] if end >= 0 else raw
+        # Lower case field name -> [offset of each value]. Searching from a
+        # line break finds a field on the first line too:
+        self._fields = {}
+        for match in _FIELD_NAME.finditer(b'\n' + self._raw):
+            self._fields.setdefault(match.group(1).lower(), []).append(
+                match.end() - 1)
+        # Lower case field name -> [decoded value]:
+        self._decoded = {}
+
+    def _key(self, name):
+        return name.lower().encode('ascii', 'replace')
+
+    def get_all(self, name, default=None):
+        """Get every value of the field 'name', in order, or 'default'."""
+        key = self._key(name)
+        values = self._decoded.get(key)
+        if values is None:
+            offsets = self._fields.get(key)
+            if offsets is None:
+                return default
+            values = self._decoded[key] = [
+                self._get_value(offset) for offset in offsets]
+        return list(values)
+
+    def _get_value(self, offset):
+        end = _VALUE_END.search(self._raw, offset)
+        return decode_header_value(
+            self._raw[offset:end.start() if end else len(self._raw)])
+
+    def get(self, name, default=None):
+        """Get the first value of the field 'name', or 'default'."""
+        values = self.get_all(name)
+        return values[0] if values else default
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __contains__(self, name):
+        return self._key(name) in self._fields
+
+    def keys(self):
+        """Get the names of all the fields, in the order they appear."""
+        return [
+            match.group(1).decode('latin-1')
+            for match in _FIELD_NAME.finditer(b'\n' + self._raw)
+        ]
+
+    def items(self):
+        """Get (name, value) pairs for all the fields, in order."""
+        seen = {}
+        items = []
+        for name in self.keys():
+            index = seen.get(name.lower(), 0)
+            seen[name.lower()] = index + 1
+            items.append((name, self.get_all(name)[index]))
+        return items
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return sum(len(offsets) for offsets in self._fields.values())
+
+    def __repr__(self):
+        return '<MessageHeader %r>' % (self.keys(),)
+
+
+def decode_header_value(raw):
+    """Decode the raw bytes of a header field's value to a string.
+
+    The value is unfolded, and stripped of surrounding white space. Bytes
+    that aren't UTF-8 are assumed to be Latin-1, since there's no way to know
+    which 8-bit charset a mailer used.
+
+    """
+    value = _FOLD.sub(b'', raw).strip(b' \t\r\n')
+    try:
+        text = value.decode('utf-8')
+    except UnicodeDecodeError:
+        text = value.decode('latin-1')
+    return decode_encoded_words(text)
+
+
+def decode_encoded_words(text):
+    """Decode the RFC 2047 encoded words in 'text'.
+
+    White space between encoded words is dropped, and adjacent words in the
+    same charset are decoded together, since a character may be split across
+    them. Malformed words, and words in unknown charsets, are left as they
+    are.
+
+    """
+    if '=?' not in text:
+        return text
+    # Strings, and [charset, bytearray] lists for runs of encoded words:
+    pieces = []
+    position = 0
+    for match in _ENCODED_WORD.finditer(text):
+        gap = text[position:match.start()]
+        position = match.end()
+        charset, encoding, encoded = match.groups()
+        # RFC 2231 allows a language after the charset:
+        charset = charset.partition('*')[0].lower()
+        data = _decode_word(encoding, encoded)
+        if data is None or not _is_charset(charset):
+            pieces.append(gap + match.group(0))
+            continue
+        previous = pieces[-1] if pieces else None
+        if isinstance(previous, list) and not gap.strip(' \t'):
+            if previous[0] == charset:
+                previous[1] += data
+                continue
+        else:
+            pieces.append(gap)
+        pieces.append([charset, bytearray(data)])
+    pieces.append(text[position:])
+    return ''.join(
+        piece if isinstance(piece, str) else piece[1].decode(
+            piece[0], 'replace')
+        for piece in pieces
+    )
+
+
+def _decode_word(encoding, encoded):
+    """Get the bytes of an encoded word's text, or None if it's malformed."""
+    try:
+        encoded = encoded.encode('ascii')
+        if encoding in 'Qq':
+            return binascii.a2b_qp(encoded, header=True)
+        return base64.b64decode(encoded + b'=' * (-len(encoded) % 4))
+    except (UnicodeEncodeError, binascii.Error):
+        return None
+
+
+def _is_charset(charset):
+    try:
+        codecs.lookup(charset)
+    except LookupError:
+        return False
+    return True
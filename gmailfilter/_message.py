@@ -1,11 +1,52 @@
-import email
 from email.utils import parseaddr
+import logging
+
+from gmailfilter._header import MessageHeader
+
+
+# The IMAP data items the EmailMessage class knows how to use. These are the
+# strings that get passed to IMAPClient.fetch:
+UID = 'UID'
+HEADER = 'BODY.PEEK[HEADER]'
+INTERNALDATE = 'INTERNALDATE'
+FLAGS = 'FLAGS'
+SIZE = 'RFC822.SIZE'
+
+# Fetch everything by default, since we don't know what the tests need:
+DEFAULT_FETCH_PARTS = frozenset((UID, HEADER, INTERNALDATE, FLAGS))
+
+
+def header_fields_part(names):
+    """Get the fetch item that retrieves only the named header fields."""
+    return 'BODY.PEEK[HEADER.FIELDS (%s)]' % ' '.join(
+        sorted({name.upper() for name in names})
+    )
+
+
+def parse_header_fields(part_name):
+    """Get the set of header names from a HEADER.FIELDS item or response key.
+
+    Names are returned in lower case. 'part_name' may be bytes (as returned by
+    the server) or a string (as passed to IMAPClient.fetch).
+
+    """
+    if isinstance(part_name, bytes):
+        part_name = part_name.decode('ascii')
+    start = part_name.index('(') + 1
+    end = part_name.index(')', start)
+    return {
+        name.strip('"').lower()
+        for name in part_name[start:end].split()
+    }
 
 
 class Message(object):
 
     """An interface to represent an email message."""
 
+    # Scans create a lot of these, so subclasses should use __slots__ too:
+    __slots__ = ()
+
     def subject(self):
         """Return the subject string of the email message."""
 
@@ -16,10 +57,21 @@ class Message(object):
         """Return the mesage uid."""
 
     def get_headers(self):
-        """Get the dictionary of headers."""
-        # TODO: Define a better interface here that deals with the fact that
-        # message headers can be added multiple times, so it's not actually
-        # good enough to store them in a dictionary.
+        """Get the headers, as a mapping of names to values.
+
+        The mapping may be a MessageHeader, which also has 'get_all' for
+        headers that are set several times.
+
+        """
+
+    def get_header(self, name):
+        """Get the value of the header 'name', or None if it's not set.
+
+        Prefer this to 'get_headers' when only a few headers are needed, since
+        implementations may be able to avoid retrieving the full header.
+
+        """
+        return self.get_headers().get(name)
 
     def get_date(self):
         """Get the date the message was received."""
@@ -27,6 +79,9 @@ class Message(object):
     def get_flags(self):
         """Get the flags set on the message."""
 
+    def get_size(self):
+        """Get the size of the message, in bytes."""
+
     def __repr__(self):
         return "<Message %d %r>" % (self.uid(), self.subject())
 
@@ -39,39 +94,64 @@ class EmailMessage(Message):
     traffic the first time they're called. After that, the results are cached.
     """
 
+    __slots__ = ('_connection_proxy', '_message', '_header_fields')
+
     def __init__(self, connection_proxy):
         self._connection_proxy = connection_proxy
         self._message = None
+        # The set of header names present in self._message, or None if it
+        # was built from the full header:
+        self._header_fields = None
+
+    def _get_email(self, full=False):
+        """Get the message header, as a MessageHeader.
+
+        If only some header fields were fetched up front, the returned object
+        will only contain those, unless 'full' is set, in which case the full
+        header is fetched.
+
+        """
+        if self._message is None or (full and self._header_fields is not None):
+            if full:
+                raw_header = self._connection_proxy.get_message_part(
+                    b'BODY.PEEK[HEADER]')
+                fields = None
+            else:
+                raw_header, fields = self._connection_proxy.get_header_block()
+            self._message = MessageHeader(raw_header)
+            self._header_fields = fields
+        return self._message
 
-    def _get_email(self):
-        if self._message is None:
-            self._message = email.message_from_string(
-                self._connection_proxy.get_message_part(b'BODY.PEEK[HEADER]').decode()
+    def get_header(self, name):
+        headers = self._get_email()
+        if (self._header_fields is not None
+                and name.lower() not in self._header_fields):
+            logging.debug(
+                "Header %r was not prefetched. Fetching the full header for "
+                "message %d", name, self.uid()
             )
-        return self._message
+            headers = self._get_email(full=True)
+        return headers[name]
 
     def subject(self):
-        return self._get_email()['Subject']
+        return self.get_header('Subject')
 
     def from_(self):
-        return self._get_email()['From']
+        return self.get_header('From')
 
     def is_list_message(self):
-        return 'List-Id' in self._get_email()
+        return self.get_header('List-Id') is not None
 
     def list_id(self):
         # Returns None if key is not found, does not raise KeyError:
-        list_id = self._get_email()['List-Id']
+        list_id = self.get_header('List-Id')
         return parse_list_id(list_id) if list_id is not None else None
 
     def uid(self):
         return self._connection_proxy.get_message_part(b'UID')
 
     def get_headers(self):
-        # TODO: email objects are dictionaries for the headers, but also expose
-        # the body contents, attachments etc. etc. It'd be nice if we could
-        # *only* expose the headers here...
-        return self._get_email()
+        return self._get_email(full=True)
 
     def get_date(self):
         return self._connection_proxy.get_message_part(b'INTERNALDATE')
@@ -79,6 +159,9 @@ class EmailMessage(Message):
     def get_flags(self):
         return self._connection_proxy.get_message_part(b'FLAGS')
 
+    def get_size(self):
+        return self._connection_proxy.get_message_part(b'RFC822.SIZE')
+
     def __repr__(self):
         return repr(self.subject())
 
@@ -0,0 +1,74 @@
+
+"""Helpers for overlapping network round-trips with message processing."""
+
+import queue
+import threading
+
+
+_DONE = object()
+
+
+def prefetch(iterable, depth):
+    """Iterate over 'iterable' in a background thread.
+
+    Yields the same items as 'iterable', but the background thread stays up
+    to 'depth' items ahead of the consumer. Exceptions raised by 'iterable'
+    are re-raised in the consumer. If the consumer stops early, the thread
+    stops as soon as it has produced its current item.
+
+    'iterable' must not share any connection with the consumer, since both
+    run at the same time.
+
+    """
+    return merge([iterable], depth)
+
+
+def merge(iterables, depth):
+    """Iterate over all of 'iterables' at once, one background thread each.
+
+    Items are yielded in the order the threads produce them, so items from
+    one iterable stay in order, but are interleaved with the others. All the
+    threads share one queue of 'depth' items. Otherwise this works like
+    'prefetch', and if any iterable raises an exception the others are
+    stopped.
+
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce(iterable):
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as e:
+            put((_DONE, e))
+        else:
+            put((_DONE, None))
+
+    running = 0
+    for iterable in iterables:
+        thread = threading.Thread(
+            target=produce, args=(iterable,), name='prefetch', daemon=True)
+        thread.start()
+        running += 1
+    try:
+        while running:
+            item, error = items.get()
+            if item is _DONE:
+                if error is not None:
+                    raise error
+                running -= 1
+                continue
+            yield item
+    finally:
+        stop.set()
@@ -0,0 +1,451 @@
+"""Record what a scan fetches from the server, and replay it offline.
+
+A SessionRecorder, passed to IMAPConnection, writes everything the
+connection's IMAPClient gets back from the server (folder details, search
+results, and every part of every message fetched) to a compressed file of
+JSON lines, as the scan goes. ReplayConnection is an IMAPConnection that
+reads such a file, and serves the same responses without a server, so rules,
+chunking and parsing can be benchmarked and profiled deterministically.
+
+The recording is stored per message, not per command, so a replayed scan
+may fetch in different chunks, or fewer header fields, than the recorded
+one. Anything that can't be answered from the recording raises ReplayError.
+Actions are never run when replaying: they're logged and remembered.
+
+"""
+
+from collections import Counter
+import datetime
+import gzip
+import json
+import logging
+import re
+import threading
+
+from gmailfilter._cache import response_key
+from gmailfilter._connection import (
+    IMAPConnection,
+    response_size,
+)
+from gmailfilter._message import parse_header_fields
+
+
+RECORDING_VERSION = 1
+
+
+class ReplayError(Exception):
+
+    """The recording doesn't have what a replayed scan asked for."""
+
+
+def _encode(value):
+    """Encode a value from an IMAPClient response as JSON."""
+    if isinstance(value, bytes):
+        return {'b': value.decode('latin-1')}
+    if isinstance(value, datetime.datetime):
+        return {'dt': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'d': value.isoformat()}
+    if isinstance(value, tuple):
+        return {'t': [_encode(v) for v in value]}
+    if isinstance(value, list):
+        return [_encode(v) for v in value]
+    if value is None or isinstance(value, (int, str)):
+        return value
+    raise TypeError("Can't record %r" % (value,))
+
+
+def _decode(value):
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if 'b' in value:
+        return value['b'].encode('latin-1')
+    if 'dt' in value:
+        return datetime.datetime.fromisoformat(value['dt'])
+    if 'd' in value:
+        return datetime.date.fromisoformat(value['d'])
+    return tuple(_decode(v) for v in value['t'])
+
+
+class SessionRecorder(object):
+
+    """Write what IMAPConnections fetch to the recording at 'path'.
+
+    One recorder may be shared by a connection and its fetch connections,
+    which record from their own threads. Call 'close' when the scan is done.
+
+    Parts read from a MessageCache are never fetched, so they aren't
+    recorded: record without a cache to be able to replay everything.
+
+    """
+
+    def __init__(self, path):
+        self._file = gzip.open(path, 'wt', encoding='utf-8')
+        self._lock = threading.Lock()
+        self._write({'version': RECORDING_VERSION})
+
+    def wrap(self, client):
+        """Get a stand-in for IMAPClient 'client' that records responses."""
+        self._write({'capabilities': _encode(tuple(client.capabilities()))})
+        return RecordingIMAPClient(client, self)
+
+    def _write(self, record):
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':'))
+        with self._lock:
+            self._file.write(line + '\n')
+
+    def record_folder(self, folder, key, response):
+        """Record the response to a SELECT or STATUS ('key') of 'folder'."""
+        self._write({
+            'folder': folder,
+            key: {k.decode('ascii'): v for k, v in response.items()
+                  if isinstance(v, int)}
+        })
+
+    def record_folder_list(self, folders):
+        self._write({'folders': _encode(list(folders))})
+
+    def record_search(self, folder, criteria, use_uid, result):
+        self._write({
+            'folder': folder,
+            'search': _encode(criteria),
+            'uid': use_uid,
+            'result': list(result),
+        })
+
+    def record_message(self, folder, uid, parts):
+        """Record the fetched 'parts' of message 'uid' in 'folder'."""
+        encoded = {}
+        for key, value in parts.items():
+            if key in (b'UID', b'SEQ'):
+                continue
+            try:
+                encoded[key.decode('ascii')] = _encode(value)
+            except TypeError:
+                logging.debug("Not recording %s of UID %d", key, uid)
+        self._write({
+            'folder': folder,
+            'uid': uid,
+            'seq': parts.get(b'SEQ'),
+            'parts': encoded,
+        })
+
+    def close(self):
+        self._file.close()
+
+
+class RecordingIMAPClient(object):
+
+    """Wrap an IMAPClient, and record its responses with a SessionRecorder.
+
+    Everything else is passed through to the wrapped client.
+
+    """
+
+    def __init__(self, client, recorder):
+        self._client = client
+        self._recorder = recorder
+        self._folder = None
+
+    @property
+    def use_uid(self):
+        return self._client.use_uid
+
+    @use_uid.setter
+    def use_uid(self, value):
+        self._client.use_uid = value
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def select_folder(self, folder, readonly=False):
+        response = self._client.select_folder(folder, readonly=readonly)
+        self._folder = folder
+        self._recorder.record_folder(folder, 'select', response)
+        return response
+
+    def folder_status(self, folder, what=None):
+        response = self._client.folder_status(folder, what)
+        self._recorder.record_folder(folder, 'status', response)
+        return response
+
+    def list_folders(self, *args, **kwargs):
+        folders = self._client.list_folders(*args, **kwargs)
+        if not args and not kwargs:
+            self._recorder.record_folder_list(folders)
+        return folders
+
+    def search(self, criteria, *args, **kwargs):
+        result = self._client.search(criteria, *args, **kwargs)
+        self._recorder.record_search(
+            self._folder, criteria, self._client.use_uid, result)
+        return result
+
+    def fetch(self, messages, data, *args, **kwargs):
+        response = self._client.fetch(messages, data, *args, **kwargs)
+        for msg_id, parts in response.items():
+            uid = msg_id if self._client.use_uid else parts.get(b'UID')
+            if uid is not None:
+                self._recorder.record_message(self._folder, uid, parts)
+        return response
+
+
+class RecordedFolder(object):
+
+    def __init__(self):
+        self.select = None
+        self.status = None
+        self.messages = {}
+        self.uids_by_seq = {}
+        self.seqs_by_uid = {}
+        self.searches = {}
+
+    @property
+    def complete(self):
+        """Whether every message that was in the folder was recorded."""
+        return (self.select is not None
+                and len(self.messages) >= self.select[b'EXISTS'])
+
+
+class SessionRecording(object):
+
+    """The contents of a recording made by a SessionRecorder."""
+
+    def __init__(self):
+        self.capabilities = ()
+        self.folder_list = []
+        self.folders = {}
+
+    @classmethod
+    def load(cls, path):
+        """Read the recording at 'path'.
+
+        :raises OSError: If the file can't be read.
+        :raises ValueError: If it isn't a recording we understand.
+
+        """
+        recording = cls()
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as recording_file:
+                first = json.loads(recording_file.readline() or '{}')
+                if first.get('version') != RECORDING_VERSION:
+                    raise ValueError(
+                        "{} is not a gmailfilter recording.".format(path))
+                for line in recording_file:
+                    recording._add(json.loads(line))
+        except (gzip.BadGzipFile, EOFError) as e:
+            raise ValueError(
+                "{} is not a gmailfilter recording: {}".format(path, e))
+        return recording
+
+    def _add(self, record):
+        if 'capabilities' in record:
+            self.capabilities = _decode(record['capabilities'])
+            return
+        if 'folders' in record:
+            self.folder_list = [tuple(f) for f in _decode(record['folders'])]
+            return
+        folder = self.folders.setdefault(record['folder'], RecordedFolder())
+        for key in ('select', 'status'):
+            if key in record:
+                response = {k.encode(): v for k, v in record[key].items()}
+                setattr(folder, key, response)
+        if 'search' in record:
+            key = (json.dumps(record['search']), record['uid'])
+            folder.searches[key] = record['result']
+        if 'parts' in record:
+            parts = folder.messages.setdefault(record['uid'], {})
+            parts.update(
+                (k.encode('ascii'), _decode(v))
+                for k, v in record['parts'].items()
+            )
+            if record['seq'] is not None:
+                folder.uids_by_seq[record['seq']] = record['uid']
+                folder.seqs_by_uid[record['uid']] = record['seq']
+
+
+def _header_fields(header, names):
+    """Get the fields in 'names' (lower case) from raw header 'header'."""
+    lines = []
+    keep = False
+    for line in header.split(b'\r\n'):
+        if not line:
+            break
+        if not line[:1].isspace():
+            name = line.split(b':', 1)[0].strip().decode('ascii', 'replace')
+            keep = name.lower() in names
+        if keep:
+            lines.append(line + b'\r\n')
+    return b''.join(lines) + b'\r\n'
+
+
+class ReplayIMAPClient(object):
+
+    """A stand-in for IMAPClient that answers from a SessionRecording.
+
+    Counts the commands it answers, and the bytes of message data it
+    returns, in 'commands' and 'bytes_fetched'. Actions are logged and
+    appended to 'actions' rather than run.
+
+    """
+
+    _actions = (
+        'add_flags',
+        'add_gmail_labels',
+        'copy',
+        'delete_folder',
+        'delete_messages',
+        'expunge',
+        'move',
+        'remove_flags',
+        'remove_gmail_labels',
+        'rename_folder',
+        'set_flags',
+        'set_gmail_labels',
+        'uid_expunge',
+    )
+
+    def __init__(self, recording):
+        self.use_uid = False
+        self.actions = []
+        self.commands = Counter()
+        self.bytes_fetched = 0
+        self._recording = recording
+        self._folder_name = None
+        self._folder = None
+
+    def __getattr__(self, name):
+        if name not in ReplayIMAPClient._actions:
+            raise AttributeError(name)
+
+        def action(*args, **kwargs):
+            logging.info("Replaying, so not running %s%r", name, args)
+            self.actions.append((name,) + args)
+        return action
+
+    def capabilities(self):
+        return self._recording.capabilities
+
+    def has_capability(self, capability):
+        return capability.upper().encode() in self._recording.capabilities
+
+    def _get_folder(self, name):
+        try:
+            return self._recording.folders[name]
+        except KeyError:
+            raise ReplayError("{} wasn't recorded.".format(name))
+
+    def select_folder(self, folder, readonly=False):
+        self.commands['SELECT'] += 1
+        recorded = self._get_folder(folder)
+        if recorded.select is None:
+            raise ReplayError("{} wasn't selected.".format(folder))
+        self._folder_name = folder
+        self._folder = recorded
+        return dict(recorded.select)
+
+    def folder_status(self, folder, what=None):
+        self.commands['STATUS'] += 1
+        recorded = self._get_folder(folder)
+        status = recorded.status or recorded.select or {}
+        what = [w.encode() if isinstance(w, str) else w for w in what or ()]
+        missing = [w for w in what if w.upper() not in status]
+        if missing:
+            raise ReplayError(
+                "The status of {} wasn't recorded.".format(folder))
+        return {w.upper(): status[w.upper()] for w in what}
+
+    def list_folders(self, directory='', pattern='*'):
+        self.commands['LIST'] += 1
+        if pattern == '*' and not directory:
+            return list(self._recording.folder_list)
+        return [f for f in self._recording.folder_list if f[2] == pattern]
+
+    def create_folder(self, folder):
+        logging.info("Replaying, so not creating %s", folder)
+        self.actions.append(('create_folder', folder))
+        return b'Success'
+
+    def search(self, criteria):
+        self.commands['SEARCH'] += 1
+        folder = self._folder
+        key = (json.dumps(_encode(criteria)), self.use_uid)
+        if key in folder.searches:
+            return list(folder.searches[key])
+        if self.use_uid and folder.complete:
+            uids = sorted(folder.messages)
+            if criteria == ['ALL']:
+                return uids
+            match = re.match(r'(\d+):\*$', str(criteria[-1]))
+            if len(criteria) == 2 and criteria[0] == 'UID' and match:
+                # Like a real server, 'n:*' includes the highest UID:
+                start = min(int(match.group(1)), uids[-1] if uids else 0)
+                return [uid for uid in uids if uid >= start]
+        raise ReplayError(
+            "The search {!r} in {} wasn't recorded.".format(
+                criteria, self._folder_name))
+
+    def fetch(self, messages, data):
+        self.commands['FETCH'] += 1
+        if isinstance(messages, int):
+            messages = [messages]
+        if isinstance(data, (str, bytes)):
+            data = [data]
+        folder = self._folder
+        response = {}
+        for msg_id in messages:
+            if self.use_uid:
+                uid = msg_id
+            else:
+                uid = folder.uids_by_seq.get(msg_id)
+            if uid not in folder.messages:
+                raise ReplayError(
+                    "Message {} in {} wasn't recorded.".format(
+                        msg_id, self._folder_name))
+            parts = {b'SEQ': folder.seqs_by_uid.get(uid)}
+            if not self.use_uid:
+                parts[b'UID'] = uid
+            for part in data:
+                key = response_key(part)
+                if key != b'UID':
+                    parts[key] = self._get_part(uid, key)
+            response[msg_id] = parts
+        self.bytes_fetched += response_size(response)
+        return response
+
+    def _get_part(self, uid, key):
+        recorded = self._folder.messages[uid]
+        if key in recorded:
+            return recorded[key]
+        if key.startswith(b'BODY[HEADER.FIELDS '):
+            # Fewer fields than were recorded can be cut out of what was:
+            names = parse_header_fields(key)
+            for recorded_key, value in recorded.items():
+                if recorded_key == b'BODY[HEADER]' or (
+                        recorded_key.startswith(b'BODY[HEADER.FIELDS ')
+                        and names <= parse_header_fields(recorded_key)):
+                    return _header_fields(value, names)
+        raise ReplayError("{} of UID {} in {} wasn't recorded.".format(
+            key.decode('ascii'), uid, self._folder_name))
+
+    def noop(self):
+        pass
+
+    def logout(self):
+        pass
+
+
+class ReplayConnection(IMAPConnection):
+
+    """An IMAPConnection that replays a SessionRecording.
+
+    Takes the recording in place of a ServerInfo. Everything else works as
+    for IMAPConnection, including fetching on several (replayed)
+    connections.
+
+    """
+
+    def _connect(self, recording):
+        return ReplayIMAPClient(recording)
@@ -0,0 +1,113 @@
+
+"""Keep track of messages that need to be tested again later."""
+
+from datetime import datetime
+import heapq
+import time
+
+
+# Don't let tests ask for messages to be re-tested more often than this many
+# seconds:
+MINIMUM_RETEST_DELAY = 60
+
+
+class RetestScheduler(object):
+
+    """A queue of messages that need to be re-tested at a certain time.
+
+    Tests that don't match a message may return a Mismatch, which says when
+    the message might match. This class keeps those times, keyed by UID, so
+    we can re-evaluate only the messages that are due, rather than rescanning
+    the whole folder.
+
+    Times are stored as timestamps in a heap of (timestamp, uid) tuples,
+    alongside a dictionary of the current time for each UID. Rescheduling or
+    dropping a UID only updates the dictionary - the stale heap entry is
+    skipped when it reaches the top, and the heap is rebuilt when too many
+    stale entries have built up.
+
+    """
+
+    def __init__(self, entries=(), minimum_delay=MINIMUM_RETEST_DELAY):
+        """Create a scheduler.
+
+        'entries' is an iterable of (uid, timestamp) pairs, as returned by
+        'get_entries'.
+
+        """
+        self._minimum_delay = minimum_delay
+        self._times = dict(entries)
+        self._heap = [(t, uid) for uid, t in self._times.items()]
+        heapq.heapify(self._heap)
+
+    def __len__(self):
+        return len(self._times)
+
+    def __contains__(self, uid):
+        return uid in self._times
+
+    def schedule(self, uid, retest_at, now=None):
+        """Schedule 'uid' to be tested again at 'retest_at' (a datetime).
+
+        Replaces any time the message was already scheduled for.
+
+        """
+        if now is None:
+            now = time.time()
+        timestamp = max(retest_at.timestamp(), now + self._minimum_delay)
+        if self._times.get(uid) == timestamp:
+            return
+        self._times[uid] = timestamp
+        heapq.heappush(self._heap, (timestamp, uid))
+        self._maybe_compact()
+
+    def discard(self, uid):
+        """Stop tracking 'uid', if it's scheduled at all."""
+        if self._times.pop(uid, None) is not None:
+            self._maybe_compact()
+
+    def next_retest(self):
+        """Get the datetime of the next scheduled retest, or None."""
+        self._drop_stale()
+        if not self._heap:
+            return None
+        return datetime.fromtimestamp(self._heap[0][0])
+
+    def seconds_until_next_retest(self, now=None):
+        """Get how long until the next retest is due, or None."""
+        self._drop_stale()
+        if not self._heap:
+            return None
+        if now is None:
+            now = time.time()
+        return max(0, self._heap[0][0] - now)
+
+    def pop_due(self, now=None):
+        """Remove and return the UIDs that are due to be re-tested."""
+        if now is None:
+            now = time.time()
+        due = []
+        self._drop_stale()
+        while self._heap and self._heap[0][0] <= now:
+            timestamp, uid = heapq.heappop(self._heap)
+            del self._times[uid]
+            due.append(uid)
+            self._drop_stale()
+        return due
+
+    def get_entries(self):
+        """Get a list of (uid, timestamp) pairs, suitable for storage."""
+        return sorted(self._times.items())
+
+    def _is_stale(self, entry):
+        timestamp, uid = entry
+        return self._times.get(uid) != timestamp
+
+    def _drop_stale(self):
+        while self._heap and self._is_stale(self._heap[0]):
+            heapq.heappop(self._heap)
+
+    def _maybe_compact(self):
+        if len(self._heap) > 2 * len(self._times) + 16:
+            self._heap = [(t, uid) for uid, t in self._times.items()]
+            heapq.heapify(self._heap)
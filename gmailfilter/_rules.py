@@ -2,42 +2,96 @@
 """Code for loading rules."""
 
 import collections.abc
+import hashlib
 import os.path
-import importlib
+import importlib.machinery
+import importlib.util
 from textwrap import dedent
 
+from gmailfilter import _message
+from gmailfilter._executor import ActionExecutor
+from gmailfilter._search import compile_rules
+from gmailfilter.test import (
+    get_required_headers,
+    get_required_parts,
+    get_retest_time,
+)
+
 
 class RuleLoadError(Exception):
     pass
 
 
 def load_rules(path=None):
-    """Load the users ruleset.
+    """Load the users ruleset for the inbox.
 
     Returns a Ruleset object, or raises an exception.
 
     If the rules file is not found, a default one will be written, and a
     RuleLoadError will be raised.
 
+    """
+    path = path or default_rules_path()
+    rulesets = load_folder_rules(path)
+    if 'INBOX' not in rulesets:
+        raise RuleLoadError(
+            "Rules file {} has no attribute 'RULES'".format(path)
+        )
+    return rulesets['INBOX']
+
+
+def load_folder_rules(path=None):
+    """Load the users rulesets for every folder they have rules for.
+
+    Returns a dictionary mapping folder names to RuleSet objects, or raises
+    an exception. The 'RULES' in the rules file are for the inbox. The file
+    may also set 'FOLDER_RULES' to a dictionary mapping other folder names to
+    rules, in the same format as 'RULES'.
+
+    If the rules file is not found, a default one will be written, and a
+    RuleLoadError will be raised.
+
     """
     path = path or default_rules_path()
     loader = importlib.machinery.SourceFileLoader('rules', path)
     # We may want to catch the exception here and provide a more user-friendly
     # exception.
+    # Load into a fresh module each time, so that names from an earlier load
+    # (FOLDER_RULES that have since been removed, say) don't linger:
+    rules = importlib.util.module_from_spec(
+        importlib.util.spec_from_loader('rules', loader))
     try:
-        rules = loader.load_module()
+        loader.exec_module(rules)
     except FileNotFoundError:
         write_default_rules_file(path)
         raise RuleLoadError(
             "No rules file found. "
             "A default one has been written at {}.".format(path)
         )
-    try:
-        return RuleSet(rules.RULES)
-    except AttributeError:
+    with open(path, 'rb') as rules_file:
+        source_hash = hashlib.sha256(rules_file.read()).hexdigest()
+    folder_rules = getattr(rules, 'FOLDER_RULES', {})
+    if not isinstance(folder_rules, collections.abc.Mapping):
+        raise RuleLoadError(
+            'FOLDER_RULES must be a dictionary of folder names to rules'
+        )
+    rulesets = {}
+    if hasattr(rules, 'RULES'):
+        rulesets['INBOX'] = RuleSet(rules.RULES, source_hash)
+    for folder, rules_for_folder in folder_rules.items():
+        # The inbox is the only case-insensitive folder name:
+        if folder.upper() == 'INBOX':
+            folder = 'INBOX'
+        if folder in rulesets:
+            raise RuleLoadError(
+                'Rules for {} are set more than once'.format(folder)
+            )
+        rulesets[folder] = RuleSet(rules_for_folder, source_hash)
+    if not rulesets:
         raise RuleLoadError(
             "Rules file {} has no attribute 'RULES'".format(path)
         )
+    return rulesets
 
 
 def write_default_rules_file(path=None):
@@ -62,6 +116,19 @@ def write_default_rules_file(path=None):
                 # All subsequent items are actions to perform.
                 (test.SubjectContains('test email'), actions.Move('Junk/')),
             )
+
+            # 4. Optionally, set 'FOLDER_RULES' to filter other folders. It
+            #    maps folder names to rules, in the same format as 'RULES':
+
+            # from datetime import timedelta
+            # FOLDER_RULES = {
+            #     'Junk': (
+            #         (
+            #             test.MessageOlderThan(timedelta(days=30)),
+            #             actions.DeleteMessage(),
+            #         ),
+            #     ),
+            # }
             '''
         ))
 
@@ -74,13 +141,61 @@ def default_rules_path():
 
 class RuleSet(object):
 
-    def __init__(self, rules):
+    def __init__(self, rules, source_hash=None):
+        """Create a RuleSet.
+
+        'source_hash' should be a hash of the rules file the rules were loaded
+        from. It's used to notice when the rules have changed between runs.
+
+        """
         RuleSet.check_rules(rules)
         self._rules = rules
+        self.source_hash = source_hash
+        self.fetch_parts = RuleSet.get_fetch_parts(rules)
 
     def __iter__(self):
         yield from self._rules
 
+    @staticmethod
+    def get_fetch_parts(rules):
+        """Get the set of IMAP data items needed to test messages.
+
+        This is the union of the parts required by every test in the ruleset.
+        The message UID is always included.
+
+        If every test that needs the message header names the header fields
+        it reads, only those fields are fetched rather than the full header.
+        The subject is always included, since it's used when logging
+        messages: if no test needs the header, the subject alone is fetched,
+        so logging a message doesn't fetch the full header.
+
+        """
+        parts = {_message.UID}
+        headers = set()
+        for test, *actions in rules:
+            parts.update(get_required_parts(test))
+            if headers is not None:
+                test_headers = get_required_headers(test)
+                if test_headers is None:
+                    headers = None
+                else:
+                    headers.update(test_headers)
+        if _message.HEADER not in parts:
+            parts.add(_message.header_fields_part({'Subject'}))
+        elif headers is not None:
+            parts.remove(_message.HEADER)
+            parts.add(_message.header_fields_part(headers | {'Subject'}))
+        return frozenset(parts)
+
+    def get_search_criteria(self, text_search=True):
+        """Get IMAP SEARCH criteria that find every message a rule may match.
+
+        Returns None if any of the tests can't be translated. 'text_search'
+        is passed on to _search.compile_test.
+
+        """
+        return compile_rules([rule[0] for rule in self._rules], text_search)
+
     @staticmethod
     def check_rules(rules):
         """Check rule validity. Raise RuleLoadError if any are invalid."""
@@ -104,13 +219,68 @@ class RuleSet(object):
 
 class SimpleRuleProcessor(object):
 
-    def __init__(self, ruleset, connection):
+    def __init__(self, ruleset, connection, scheduler=None, executor=None):
+        """Create a rule processor.
+
+        If 'scheduler' is set, it must be a RetestScheduler. Messages that
+        don't match any rule, but might match one later, are scheduled to be
+        tested again. Messages that match a rule are removed from it.
+
+        'executor' runs the actions of matching rules. By default actions are
+        run immediately. Pass a BatchingActionExecutor to batch them, and
+        call 'flush' to make sure they have all been run.
+
+        """
         self._ruleset = ruleset
         self._connection = connection
+        self._scheduler = scheduler
+        self._executor = executor or ActionExecutor(connection)
+        for test, *actions in self._ruleset:
+            for action in actions:
+                prepare = getattr(action, 'prepare', None)
+                if callable(prepare):
+                    prepare(connection)
+
+    def flush(self):
+        """Run any actions that have been deferred."""
+        self._executor.flush()
+
+    @property
+    def pending_uids(self):
+        """The UIDs of messages with actions that have been deferred."""
+        return self._executor.pending_uids
 
     def process_message(self, message):
+        self.apply(message, *self.match(message))
+
+    def match(self, message):
+        """Find the first rule that matches 'message'.
+
+        Returns a tuple of (actions, retest_at). 'actions' are the actions of
+        the matching rule, or None if no rule matched, in which case
+        'retest_at' is the earliest time any rule might match (or None).
+        Nothing is done to the message, so this may safely be called again
+        if a test raises an exception.
+
+        """
+        retest_at = None
         for test, *actions in self._ruleset:
-            if test.match(message):
-                for action in actions:
-                    action.process(self._connection, message)
-                break
+            result = test.match(message)
+            if result:
+                return actions, None
+            rule_retest_at = get_retest_time(result)
+            if rule_retest_at is not None:
+                if retest_at is None or rule_retest_at < retest_at:
+                    retest_at = rule_retest_at
+        return None, retest_at
+
+    def apply(self, message, actions, retest_at):
+        """Act on the result of 'match'."""
+        if actions is not None:
+            for action in actions:
+                self._executor.run(action, message)
+        if self._scheduler is not None:
+            if retest_at is None:
+                self._scheduler.discard(message.uid())
+            else:
+                self._scheduler.schedule(message.uid(), retest_at)
@@ -0,0 +1,207 @@
+
+"""Run a ruleset over one folder, as a plain or incremental scan."""
+
+from collections import namedtuple
+import logging
+import time
+
+from gmailfilter._checkpoint import PartUsage
+from gmailfilter._executor import BatchingActionExecutor
+from gmailfilter._retest import RetestScheduler
+from gmailfilter._rules import SimpleRuleProcessor
+
+
+# How often to save the progress of a scan to the journal, in seconds:
+JOURNAL_INTERVAL = 30
+
+# The result of scan_folder. 'next_uid' is the lowest UID the scan didn't look
+# at, and 'messages' is how many messages were tested:
+FolderScan = namedtuple(
+    'FolderScan', ['rule_processor', 'scheduler', 'next_uid', 'messages'])
+
+
+def scan_folder(connection, folder, rules, checkpoint=None,
+                rescan_interval=24 * 3600, search=False, journal=None,
+                profile=None):
+    """Run 'rules' over the messages in 'folder'.
+
+    If 'checkpoint' is set, the scan is incremental, and the checkpoint is
+    updated (but not saved). A full scan is done anyway if the last one was
+    more than 'rescan_interval' seconds ago. Incremental scans test new
+    messages, messages scheduled for a retest, and (if the server supports
+    CONDSTORE) messages whose flags have changed since the last scan.
+
+    If 'search' is set, the server is asked for the messages that might match
+    the rules, where the rules can be translated to search criteria. Messages
+    the server leaves out are never tested, so they can't be scheduled for a
+    retest: only search when the next run will be a full scan anyway.
+
+    If 'journal' is set, it must be a ScanJournal. The progress of the scan is
+    saved in it as the scan goes, and if the scan is interrupted by an
+    exception. If the journal has the progress of an interrupted scan of the
+    folder, that scan is resumed rather than started again.
+
+    If 'profile' is set, it must be a FetchProfile. The parts the rules read
+    without declaring them in earlier scans of the folder are fetched up
+    front, and the profile is updated (but not saved).
+
+    Returns a FolderScan.
+
+    """
+    status = None
+    if checkpoint is not None or journal is not None:
+        status = connection.get_folder_status(folder)
+    min_uid = None
+    scheduler = RetestScheduler()
+    if checkpoint is not None:
+        min_uid = checkpoint.get_min_uid(
+            folder,
+            status[b'UIDVALIDITY'],
+            rules.source_hash,
+            rescan_interval
+        )
+        if min_uid is not None:
+            scheduler = RetestScheduler(checkpoint.get_retests(folder))
+    resumed = None
+    if journal is not None:
+        resumed = journal.get_tested_uids(
+            folder, status[b'UIDVALIDITY'], rules.source_hash)
+        if resumed is not None:
+            logging.info(
+                "Resuming the interrupted scan of %s, %d messages were "
+                "already tested.",
+                folder,
+                len(resumed)
+            )
+            scheduler = RetestScheduler(journal.get_retests(folder))
+
+    criteria = None
+    if search:
+        criteria = rules.get_search_criteria(
+            connection.supports_substring_search())
+        if criteria is not None:
+            logging.info(
+                "Asking the server for messages in %s matching the rules.",
+                folder
+            )
+
+    connection_proxy = connection.get_connection_proxy()
+    rule_processor = SimpleRuleProcessor(
+        rules,
+        connection_proxy,
+        scheduler,
+        BatchingActionExecutor(connection_proxy)
+    )
+    progress = _ScanProgress(
+        journal, folder, status, rules, rule_processor, scheduler, resumed)
+    last_uid = max(resumed or (), default=0)
+    messages = 0
+    fetch_parts = rules.fetch_parts
+    usage = None
+    if profile is not None:
+        fetch_parts = profile.get_fetch_parts(rules, folder)
+        usage = PartUsage(rules.fetch_parts)
+    try:
+        with connection.record_part_usage(usage):
+            for message in connection.get_messages(
+                    fetch_parts, min_uid, criteria, folder, resumed):
+                last_uid = max(last_uid, message.uid())
+                messages += 1
+                rule_processor.process_message(message)
+                progress.tested(message.uid())
+            if min_uid is not None:
+                # An incremental scan won't see old messages, so re-test those
+                # that might match by now, or whose flags have changed:
+                retest = set(scheduler.pop_due())
+                progress.retesting(retest)
+                modseq = checkpoint.get_highest_modseq(folder)
+                if modseq is not None and b'HIGHESTMODSEQ' in status:
+                    retest.update(
+                        connection.get_changed_uids(modseq, min_uid - 1))
+                retest.difference_update(resumed or ())
+                if retest:
+                    for message in connection.get_messages_by_uid(
+                            fetch_parts, retest):
+                        messages += 1
+                        rule_processor.process_message(message)
+                        progress.tested(message.uid())
+            # Batched actions may expunge messages, so we can't run them until
+            # we're done with the sequence numbers of this scan. They work on
+            # the selected folder, so they must be run before the next one is
+            # selected:
+            rule_processor.flush()
+    except BaseException:
+        progress.save()
+        raise
+    if checkpoint is not None:
+        checkpoint.record_scan(
+            folder,
+            status[b'UIDVALIDITY'],
+            rules.source_hash,
+            last_uid,
+            full_scan=min_uid is None,
+            highest_modseq=status.get(b'HIGHESTMODSEQ')
+        )
+        checkpoint.set_retests(folder, scheduler.get_entries())
+    if profile is not None:
+        profile.record_scan(folder, rules.source_hash, usage, messages)
+    if journal is not None:
+        journal.finish(folder)
+        journal.save()
+    return FolderScan(
+        rule_processor,
+        scheduler,
+        max(last_uid + 1, min_uid or 1),
+        messages
+    )
+
+
+class _ScanProgress(object):
+
+    """Save the progress of a scan to a ScanJournal, every so often.
+
+    Does nothing if 'journal' is None.
+
+    """
+
+    def __init__(self, journal, folder, status, rules, rule_processor,
+                 scheduler, resumed=None):
+        self._journal = journal
+        self._folder = folder
+        self._status = status
+        self._rules = rules
+        self._rule_processor = rule_processor
+        self._scheduler = scheduler
+        self._tested = set(resumed or ())
+        self._retesting = set()
+        self._last_save = time.monotonic()
+
+    def tested(self, uid):
+        """Record that message 'uid' has been tested."""
+        if self._journal is None:
+            return
+        self._tested.add(uid)
+        if time.monotonic() - self._last_save >= JOURNAL_INTERVAL:
+            self.save()
+
+    def retesting(self, uids):
+        """Record that 'uids' have been taken off the scheduler to be
+        tested again, so they need to go back on it if we're interrupted."""
+        self._retesting = set(uids)
+
+    def save(self):
+        if self._journal is None:
+            return
+        retests = self._scheduler.get_entries()
+        # Retests that were due, but haven't happened yet, are due at once:
+        retests.extend((uid, 0) for uid in self._retesting - self._tested)
+        self._journal.record_progress(
+            self._folder,
+            self._status[b'UIDVALIDITY'],
+            self._rules.source_hash,
+            self._tested,
+            self._rule_processor.pending_uids,
+            retests
+        )
+        self._journal.save()
+        self._last_save = time.monotonic()
@@ -0,0 +1,117 @@
+
+"""Compile tests into IMAP SEARCH criteria, so the server can filter for us."""
+
+from gmailfilter.test import (
+    And,
+    Not,
+    Or,
+)
+
+
+# Search keys that do text matching. Not every server does substring matching
+# for these (GMail matches whole words), so they can be turned off:
+TEXT_SEARCH_KEYS = frozenset((
+    'BCC', 'BODY', 'CC', 'FROM', 'HEADER', 'SUBJECT', 'TEXT', 'TO',
+))
+
+# Criteria that never match anything. IMAP has no 'FALSE' search key:
+MATCH_NOTHING = ['NOT', 'ALL']
+
+
+def compile_test(test, text_search=True):
+    """Compile 'test' into IMAP SEARCH criteria.
+
+    Returns a tuple of (criteria, exact), or None if the test can't be
+    translated. 'criteria' is a list suitable for IMAPClient.search. The
+    server will return every message that 'test' would match, but the
+    criteria may match other messages as well, unless 'exact' is True. Either
+    way the test should still be run against the messages the server returns.
+
+    If 'text_search' is False, criteria that use text search keys (SUBJECT,
+    HEADER etc.) are treated as untranslatable.
+
+    """
+    if isinstance(test, And):
+        return _compile_and(test._tests, text_search)
+    if isinstance(test, Or):
+        return _compile_or(test._tests, text_search)
+    if isinstance(test, Not):
+        compiled = compile_test(test._test, text_search)
+        # The inverse of a superset isn't a superset, so only exact criteria
+        # can be negated:
+        if compiled is None or not compiled[1]:
+            return None
+        return ['NOT', compiled[0]], True
+    get_criteria = getattr(test, 'get_search_criteria', None)
+    if get_criteria is None:
+        return None
+    compiled = get_criteria()
+    if compiled is None:
+        return None
+    criteria, exact = compiled
+    if not _is_supported(criteria, text_search):
+        return None
+    return list(criteria), exact
+
+
+def compile_rules(tests, text_search=True):
+    """Compile a sequence of rule tests into criteria that match any of them.
+
+    Returns None unless every test can be translated, since messages that
+    don't match any of the criteria are never seen by the rule processor.
+
+    """
+    compiled = _compile_or(tests, text_search)
+    return None if compiled is None else compiled[0]
+
+
+def _compile_and(tests, text_search):
+    if not tests:
+        return MATCH_NOTHING, True
+    criteria = []
+    exact = True
+    for test in tests:
+        compiled = compile_test(test, text_search)
+        if compiled is None:
+            # The other tests still narrow things down:
+            exact = False
+            continue
+        criteria.extend(compiled[0])
+        exact = exact and compiled[1]
+    if not criteria:
+        return None
+    return criteria, exact
+
+
+def _compile_or(tests, text_search):
+    if not tests:
+        return MATCH_NOTHING, True
+    compiled = [compile_test(test, text_search) for test in tests]
+    if None in compiled:
+        return None
+    # IMAP's OR takes exactly two search keys, so nest them:
+    criteria = compiled[-1][0]
+    for other, _ in reversed(compiled[:-1]):
+        criteria = ['OR', other, criteria]
+    return criteria, all(exact for _, exact in compiled)
+
+
+def _is_supported(criteria, text_search):
+    """Check that 'criteria' is something we can send to the server.
+
+    IMAPClient only applies the search charset to the top level criteria, so
+    we stick to ASCII strings.
+
+    """
+    for item in criteria:
+        if isinstance(item, (list, tuple)):
+            if not _is_supported(item, text_search):
+                return False
+        elif isinstance(item, str):
+            if not text_search and item.upper() in TEXT_SEARCH_KEYS:
+                return False
+            try:
+                item.encode('ascii')
+            except UnicodeEncodeError:
+                return False
+    return True
@@ -0,0 +1,137 @@
+"""Stream the responses to a FETCH command from IMAPClient.
+
+IMAPClient.fetch reads every response to the command, then parses them all
+into one dict, so nothing can be done with the first message of a chunk
+until the last one has arrived, and the whole chunk's raw responses and
+parsed data are in memory at once. FetchStream sends the same command, but
+reads and parses the responses one at a time, and yields each message as
+soon as the server has sent it.
+
+imaplib can't send a command while it's still reading the responses to
+another one. So while a stream is open, any other command on the same
+connection (a lazy fetch, or an action) first reads the rest of the stream
+into memory, like IMAPClient.fetch would have, and the stream carries on
+from there.
+
+"""
+
+from collections import OrderedDict
+import logging
+import time
+
+from imapclient.imapclient import (
+    join_message_ids,
+    seq_to_parenstr_upper,
+)
+from imapclient.response_parser import parse_fetch_response
+
+
+class FetchStream(object):
+
+    """Fetch 'parts' for 'messages', yielding (message id, parts) pairs.
+
+    'messages' is a list of message ids, or a sequence set string, and 'ids'
+    is the list of ids it stands for. As with IMAPClient.fetch, messages are
+    keyed by UID if the client is using UIDs, and responses for other
+    messages are ignored. In UID mode, b'UID' is added to the parts.
+
+    A server may split a message's data over several responses, so a
+    message isn't yielded until a response for another one arrives, or the
+    command completes. Data for a message that was yielded already is
+    logged and dropped.
+
+    The command is sent when the stream is created. 'seconds' is the time
+    spent waiting for and parsing responses, and 'size_bytes' roughly how
+    many bytes of message data arrived (see response_size).
+
+    """
+
+    def __init__(self, client, messages, ids, parts):
+        self._client = client
+        self._imap = client._imap
+        self._use_uid = client.use_uid
+        self._ids = set(ids)
+        # Messages that have arrived but haven't been yielded yet:
+        self._pending = OrderedDict()
+        self._seen = set()
+        self._done = False
+        self.seconds = 0.0
+        self.size_bytes = 0
+        args = ['FETCH', join_message_ids(messages),
+                seq_to_parenstr_upper(parts)]
+        if self._use_uid:
+            args.insert(0, 'UID')
+        start = time.monotonic()
+        self._tag = self._imap._command(*args)
+        self.seconds += time.monotonic() - start
+        # Anything else sent on this connection must wait for us:
+        self._imap._command = self._interrupt
+
+    def __iter__(self):
+        try:
+            while self._pending or not self._done:
+                while len(self._pending) > 1 or (self._done and self._pending):
+                    yield self._pending.popitem(last=False)
+                if not self._done:
+                    self._read_response()
+        except GeneratorExit:
+            # Leave the connection ready for the next command:
+            self.read_all()
+            raise
+
+    def read_all(self):
+        """Read the rest of the responses into memory."""
+        while not self._done:
+            self._read_response()
+
+    def _interrupt(self, *args):
+        logging.debug(
+            "Reading the rest of a fetch before sending %s.", args[0])
+        self.read_all()
+        return self._imap._command(*args)
+
+    def _read_response(self):
+        imap = self._imap
+        start = time.monotonic()
+        try:
+            imap._check_bye()
+            imap._get_response()
+            fetched = imap.untagged_responses.pop('FETCH', None)
+            if fetched:
+                self._add(parse_fetch_response(
+                    fetched, self._client.normalise_times, self._use_uid))
+            if imap.tagged_commands[self._tag] is not None:
+                self._finish()
+        except BaseException:
+            if not self._done:
+                self._done = True
+                del imap._command
+            raise
+        finally:
+            self.seconds += time.monotonic() - start
+
+    def _add(self, response):
+        for msg_id, parts in response.items():
+            if msg_id not in self._ids:
+                continue
+            if self._use_uid:
+                parts.setdefault(b'UID', msg_id)
+            self.size_bytes += sum(
+                len(v) for v in parts.values() if isinstance(v, bytes))
+            if msg_id in self._pending:
+                self._pending[msg_id].update(parts)
+            elif msg_id in self._seen:
+                logging.debug(
+                    "Dropping late fetch data for message %d: %r",
+                    msg_id,
+                    sorted(parts)
+                )
+            else:
+                self._seen.add(msg_id)
+                self._pending[msg_id] = parts
+
+    def _finish(self):
+        self._done = True
+        del self._imap._command
+        typ, data = self._imap._command_complete('FETCH', self._tag)
+        self._client._checkok('fetch', typ, data)
@@ -1,10 +1,17 @@
 
-import imapclient
 import logging
 
+from gmailfilter._asyncimap import format_uid_set
+
 """Classes that manipulate mails."""
 
 
+# Servers limit the length of a command line (Dovecot to 64 KiB, by
+# default), so batches are split into UID sets of at most this many
+# characters:
+MAX_UID_SET_LENGTH = 8000
+
+
 class Action(object):
     """
     All actions must implement this interface (though they need not inherit
@@ -26,20 +33,130 @@ class Action(object):
 
         """
 
+    def prepare(self, client_conn):
+        """Get ready to run. Called once, when the ruleset is loaded.
+
+        This is optional. Actions can use it to set up anything they need on
+        the server, such as folders to move messages to.
+
+        """
+
+
+class BatchAction(Action):
+    """
+    An action that can be run on many messages with a single command.
+
+    Rather than calling 'process' for every message, the rule processor may
+    collect the UIDs of matching messages, and later call 'process_batch'
+    once for all actions with the same batch key.
+
+    """
 
-class Move(Action):
+    def get_batch_key(self):
+        """Return a hashable key. Actions with equal keys are batched
+        together.
+
+        If this returns None, the action is only batched with itself.
+
+        """
+
+    def process_batch(self, client_conn, uids):
+        """Run the action on all the messages in 'uids'.
+
+        Subclasses that don't override this are run with 'process', one
+        message at a time.
+
+        """
+
+    def log_message(self, message):
+        """Log that this action will be run on 'message'.
+
+        This is called when the message is added to the batch.
+
+        """
+
+
+def _ensure_folder(conn, folder):
+    if not conn.folder_exists(folder):
+        status = conn.create_folder(folder)
+        assert status.lower() == b"success", \
+            "Unable to create folder %s" % folder
+
+
+def _uid_sets(uids):
+    """Split 'uids' into IMAP sequence sets, such as '1:3,5'.
+
+    Runs of UIDs are collapsed into ranges, and no set is longer than
+    MAX_UID_SET_LENGTH characters.
+
+    """
+    sets = []
+    items = []
+    length = 0
+    for item in format_uid_set(uids).split(',') if uids else ():
+        if items and length + 1 + len(item) > MAX_UID_SET_LENGTH:
+            sets.append(','.join(items))
+            items = []
+            length = 0
+        length += len(item) + bool(items)
+        items.append(item)
+    if items:
+        sets.append(','.join(items))
+    return sets
+
+
+def _remove_messages(conn, uids):
+    """Flag 'uids' as deleted, and expunge them without touching other
+    messages.
+
+    Without UIDPLUS, the whole folder is expunged, but only if no other
+    messages are flagged as deleted. Otherwise 'uids' are left flagged.
+
+    """
+    uid_sets = _uid_sets(uids)
+    for uid_set in uid_sets:
+        conn.delete_messages(uid_set, silent=True)
+    if conn.has_capability('UIDPLUS'):
+        for uid_set in uid_sets:
+            conn.uid_expunge(uid_set)
+        return
+    others = set(conn.search(['DELETED'])) - set(uids)
+    if others:
+        logging.info(
+            "Not expunging, as %d other messages are flagged as deleted "
+            "and the server can't expunge by UID.", len(others))
+        return
+    conn.expunge()
+
+
+class Move(BatchAction):
 
     def __init__(self, target_folder):
         self._target_folder = target_folder
 
+    def prepare(self, conn):
+        _ensure_folder(conn, self._target_folder)
+
+    def get_batch_key(self):
+        return ('move', self._target_folder)
+
+    def log_message(self, message):
+        logging.info(
+            "Moving message %r to %s" % (message, self._target_folder))
+
+    def process_batch(self, conn, uids):
+        _ensure_folder(conn, self._target_folder)
+        if conn.has_capability('MOVE'):
+            for uid_set in _uid_sets(uids):
+                conn.move(uid_set, self._target_folder)
+        else:
+            for uid_set in _uid_sets(uids):
+                conn.copy(uid_set, self._target_folder)
+            _remove_messages(conn, uids)
+
     def process(self, conn, message):
-        try:
-            conn.copy(message.uid(), self._target_folder)
-        except imapclient.IMAPClient.Error:
-            status = conn.create_folder(self._target_folder)
-            assert status.lower() == b"success", \
-                "Unable to create folder %s" % self._target_folder
-            conn.copy(message.uid(), self._target_folder)
+        _ensure_folder(conn, self._target_folder)
+        conn.copy(message.uid(), self._target_folder)
 
         # TODO: Maybe provide logging facilities in parent 'Action' class?
         conn.delete_messages(message.uid())
@@ -47,12 +164,21 @@ class Move(Action):
             "Moving message %r to %s" % (message, self._target_folder))
 
 
-class DeleteMessage(Action):
+class DeleteMessage(BatchAction):
 
     def process(self, conn, message):
         conn.delete_messages(message.uid())
         logging.info("Deleting message %r" % message)
 
+    def get_batch_key(self):
+        return ('delete',)
+
+    def log_message(self, message):
+        logging.info("Deleting message %r" % message)
+
+    def process_batch(self, conn, uids):
+        _remove_messages(conn, uids)
+
 
 class LogMessage(Action):
 
@@ -3,5 +3,5 @@ from email.utils import parseaddr
 
 
 def get_list_id(message):
-    list_id = message.get_headers().get('List-Id', '')
+    list_id = message.get_header('List-Id') or ''
     return parseaddr(list_id)[1]
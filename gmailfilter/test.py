@@ -16,17 +16,53 @@ import unicodedata
 
 import imapclient
 
+from gmailfilter import _message
 from gmailfilter.messageutils import get_list_id
 
 
 __all__ = [
     'Test',
+    'Mismatch',
     'And',
     'Or',
     'MatchesHeader',
 ]
 
 
+class Mismatch(object):
+
+    """A test result that says a message didn't match, but might later.
+
+    Mismatch objects are falsy, so they can be returned from 'match' wherever
+    False could be. 'retest_at' is a datetime at which the message should be
+    tested again. For example, MessageOlderThan returns a Mismatch for the
+    time the message will be old enough.
+
+    """
+
+    def __init__(self, retest_at):
+        self.retest_at = retest_at
+
+    def __bool__(self):
+        return False
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, Mismatch)
+            and self.retest_at == other.retest_at
+        )
+
+    def __repr__(self):
+        return "Mismatch(%r)" % self.retest_at
+
+
+def get_retest_time(result):
+    """Get the retest time from the result of a test, or None."""
+    if isinstance(result, Mismatch):
+        return result.retest_at
+    return None
+
+
 class Test(object):
 
     """This class represents a single test on a message.
@@ -46,9 +82,99 @@ class Test(object):
         that we know that a message needs to be re-checked at a certain point
         in the future.
 
-        TODO: Implement Mismatch.
+        """
+
+    def get_required_parts(self):
+        """Return the set of IMAP data items this test needs.
+
+        The items are strings as understood by IMAPClient.fetch, such as
+        'FLAGS' or 'BODY.PEEK[HEADER]'. The union of these over the whole
+        ruleset is fetched up front for every message. A part that is not
+        declared here can still be used - it will just be fetched lazily,
+        one message at a time.
+
+        The default implementation asks for everything, so tests that do not
+        override this method keep working efficiently.
+
+        """
+        return set(_message.DEFAULT_FETCH_PARTS)
+
+    def get_required_headers(self):
+        """Return the set of header names this test reads, or None.
+
+        This is only consulted for tests whose required parts include the
+        message header. If every such test in the ruleset names the headers it
+        reads, only those header fields are fetched. Returning None (the
+        default) means the full header is needed.
+
+        Tests that declare their headers should read them with
+        'message.get_header'. Reading a header that was not declared still
+        works, but causes the full header to be fetched for that message.
 
         """
+        return None
+
+    def get_search_criteria(self):
+        """Return IMAP SEARCH criteria equivalent to this test, or None.
+
+        If the whole ruleset can be translated to SEARCH criteria, the server
+        is asked for the messages that might match, and only those are
+        fetched. The return value is a tuple of (criteria, exact), where
+        'criteria' is a list as accepted by IMAPClient.search. The criteria
+        must match every message this test matches. They may match more
+        messages too, in which case 'exact' must be False.
+
+        Returning None (the default) means the test can't be translated,
+        and every message will be fetched and tested.
+
+        """
+        return None
+
+
+def get_required_parts(test):
+    """Get the IMAP data items required by 'test'.
+
+    Tests need not inherit from Test, so this falls back to fetching
+    everything if the test has no 'get_required_parts' method.
+
+    """
+    get_parts = getattr(test, 'get_required_parts', None)
+    if get_parts is None:
+        return set(_message.DEFAULT_FETCH_PARTS)
+    return set(get_parts())
+
+
+def get_required_headers(test):
+    """Get the header names required by 'test'.
+
+    Returns an empty set if the test doesn't need the message header at all,
+    and None if it needs the full header.
+
+    """
+    if _message.HEADER not in get_required_parts(test):
+        return set()
+    get_headers = getattr(test, 'get_required_headers', None)
+    if get_headers is None:
+        return None
+    headers = get_headers()
+    return None if headers is None else set(headers)
+
+
+def _union_required_parts(tests):
+    parts = set()
+    for test in tests:
+        parts.update(get_required_parts(test))
+    return parts
+
+
+def _union_required_headers(tests):
+    headers = set()
+    for test in tests:
+        test_headers = get_required_headers(test)
+        if test_headers is None:
+            return None
+        headers.update(test_headers)
+    return headers
 
 
 class And(Test):
@@ -71,7 +197,21 @@ class And(Test):
     def match(self, message):
         if not self._tests:
             return False
-        return all([t.match(message) for t in self._tests])
+        results = [t.match(message) for t in self._tests]
+        if all(results):
+            return True
+        # We can only match once every failing test matches, so the earliest
+        # we can match is the latest retest time:
+        retest_times = [get_retest_time(r) for r in results if not r]
+        if None in retest_times:
+            return False
+        return Mismatch(max(retest_times))
+
+    def get_required_parts(self):
+        return _union_required_parts(self._tests)
+
+    def get_required_headers(self):
+        return _union_required_headers(self._tests)
 
 
 class Or(Test):
@@ -87,7 +227,21 @@ class Or(Test):
         self._tests = tests
 
     def match(self, message):
-        return any([t.match(message) for t in self._tests])
+        results = [t.match(message) for t in self._tests]
+        if any(results):
+            return True
+        retest_times = [
+            t for t in map(get_retest_time, results) if t is not None
+        ]
+        if retest_times:
+            return Mismatch(min(retest_times))
+        return False
+
+    def get_required_parts(self):
+        return _union_required_parts(self._tests)
+
+    def get_required_headers(self):
+        return _union_required_headers(self._tests)
 
 
 class Not(Test):
@@ -100,6 +254,12 @@ class Not(Test):
     def match(self, message):
         return not self._test.match(message)
 
+    def get_required_parts(self):
+        return get_required_parts(self._test)
+
+    def get_required_headers(self):
+        return get_required_headers(self._test)
+
 
 class MatchesHeader(Test):
 
@@ -122,14 +282,27 @@ class MatchesHeader(Test):
         self.expected_value = expected_value
 
     def match(self, message):
-        headers = message.get_headers()
-        if self.expected_key in headers:
+        value = message.get_header(self.expected_key)
+        if value is not None:
             if self.expected_value:
-                return headers[self.expected_key] == self.expected_value
+                return value == self.expected_value
             else:
                 return True
         return False
 
+    def get_required_parts(self):
+        return {_message.HEADER}
+
+    def get_required_headers(self):
+        return {self.expected_key}
+
+    def get_search_criteria(self):
+        # The server does a case-insensitive substring match on the value:
+        return (
+            ['HEADER', self.expected_key, self.expected_value or ''],
+            not self.expected_value
+        )
+
 
 class SubjectContains(Test):
 
@@ -156,12 +329,27 @@ class SubjectContains(Test):
         self._case_sensitive = case_sensitive
 
     def match(self, message):
-        subject = message.get_headers()['Subject']
+        subject = message.get_header('Subject')
         if self._case_sensitive:
             return self._search_string in subject
         else:
             return self._search_string.casefold() in subject.casefold()
 
+    def get_required_parts(self):
+        return {_message.HEADER}
+
+    def get_required_headers(self):
+        return {'Subject'}
+
+    def get_search_criteria(self):
+        # The server does a case-insensitive match, which finds everything a
+        # case-sensitive match would. Caseless matching here also folds
+        # characters like 'ß', which the server may not do, so we can't
+        # translate that.
+        if not self._case_sensitive:
+            return None
+        return ['SUBJECT', self._search_string], False
+
 
 class ListId(Test):
 
@@ -175,6 +363,15 @@ class ListId(Test):
     def match(self, message):
         return get_list_id(message) == self._target_list
 
+    def get_required_parts(self):
+        return {_message.HEADER}
+
+    def get_required_headers(self):
+        return {'List-Id'}
+
+    def get_search_criteria(self):
+        return ['HEADER', 'List-Id', self._target_list], False
+
 
 # IMAPClient incorrectly declares these as strings. This is reported as
 # https://bitbucket.org/mjs0/imapclient/issues/165/imapclientseen-friends-have-the-wrong-type
@@ -209,12 +406,31 @@ class HasFlag(Test):
     RECENT = _correct_type(imapclient.RECENT)
     SEEN = _correct_type(imapclient.SEEN)
 
+    # The SEARCH keys for system flags. Other flags use 'KEYWORD <flag>':
+    _search_keys = {
+        ANSWERED: 'ANSWERED',
+        DELETED: 'DELETED',
+        DRAFT: 'DRAFT',
+        FLAGGED: 'FLAGGED',
+        RECENT: 'RECENT',
+        SEEN: 'SEEN',
+    }
+
     def __init__(self, flag):
         self.expected_flag = flag
 
     def match(self, message):
         return self.expected_flag in message.get_flags()
 
+    def get_required_parts(self):
+        return {_message.FLAGS}
+
+    def get_search_criteria(self):
+        flag = _correct_type(self.expected_flag)
+        if flag in self._search_keys:
+            return [self._search_keys[flag]], True
+        return ['KEYWORD', flag.decode('utf-8')], True
+
 
 def IsAnswered():
     return HasFlag(HasFlag.ANSWERED)
@@ -256,6 +472,9 @@ class MessageOlderThan(Test):
     >>> from datetime import timedelta
     >>> MessageOlderThan(timedelta(days=12))
 
+    Messages that are too young return a Mismatch for the time they will be
+    old enough.
+
     """
 
     def __init__(self, age):
@@ -264,7 +483,19 @@ class MessageOlderThan(Test):
         self._age = age
 
     def match(self, message):
-        return message.get_date() + self._age < datetime.now()
+        old_enough_at = message.get_date() + self._age
+        if old_enough_at < datetime.now():
+            return True
+        return Mismatch(old_enough_at)
+
+    def get_required_parts(self):
+        return {_message.INTERNALDATE}
+
+    def get_search_criteria(self):
+        # BEFORE only compares dates, in the server's timezone, so allow a
+        # day either side:
+        cutoff = datetime.now() - self._age
+        return ['BEFORE', cutoff.date() + timedelta(days=2)], False
 
 
 # def caseless_comparison(str1, str2, op):
@@ -0,0 +1,411 @@
+"""Benchmarks for scanning a folder, against a local IMAP server.
+
+Run them with::
+
+    python -m gmailfilter.tests.benchmark [--messages N] [--latency MS]
+
+or, to replay a recording made with 'gmailfilter --record' instead (see
+gmailfilter._replay), with the INBOX rules from a rules file::
+
+    python -m gmailfilter.tests.benchmark --replay FILE [--rules RULES]
+
+or, to check that a scan's peak memory depends on the chunk size, and not on
+the size of the folder::
+
+    python -m gmailfilter.tests.benchmark --memory [--messages N]
+
+Every scenario scans a folder of synthetic messages (see make_messages) with
+IMAPConnection.get_messages, tests each message with a SimpleRuleProcessor
+and runs the batched actions. It reports messages tested per second, how
+long it took to test the first message, the bytes the server sent and
+received, the round-trips the scan took, and the peak memory the scan
+allocated.
+
+The FakeIMAPServer runs in a child process, so its work doesn't slow the
+scan down or count towards its memory. Each scenario gets a fresh server,
+since the actions change its folders. Scans are run twice: once to time
+them, and once with tracemalloc running to measure their memory, since that
+slows them down a lot.
+
+The memory benchmark scans folders of N/8, N/4, N/2 and N messages in
+chunks of a fixed size, with rules that only log what they match: batched
+actions keep the UID of every message they'll act on until the scan ends,
+so they'd measure how many messages matched rather than the scan.
+
+When replaying, the compressed and cached scenarios are left out, the bytes
+sent are the bytes of message data replayed, and the round-trips are the
+commands the recording answered.
+
+"""
+
+import argparse
+from collections import namedtuple
+import multiprocessing
+import os.path
+import tempfile
+import time
+import tracemalloc
+
+from gmailfilter import actions, test
+from gmailfilter._cache import MessageCache
+from gmailfilter._config import ScanOptions
+from gmailfilter._connection import IMAPConnection
+from gmailfilter._executor import BatchingActionExecutor
+from gmailfilter._replay import (
+    ReplayConnection,
+    ReplayError,
+    SessionRecording,
+)
+from gmailfilter._rules import (
+    RuleSet,
+    SimpleRuleProcessor,
+    load_rules,
+)
+from gmailfilter.tests.imapserver import (
+    DEFAULT_CAPABILITIES,
+    FakeIMAPServer,
+    make_messages,
+)
+
+
+# 'fetch_parts' is 'rules' to fetch what the rules need, or None to fetch
+# everything. 'search' asks the server for the messages the rules might
+# match, and 'cache' scans once to fill a message cache before measuring:
+Scenario = namedtuple(
+    'Scenario',
+    ['name', 'fetch_parts', 'prefetch', 'connections', 'compress', 'cache',
+     'search']
+)
+
+SCENARIOS = [
+    Scenario('all-parts', None, 0, 1, False, False, False),
+    Scenario('rule-parts', 'rules', 0, 1, False, False, False),
+    Scenario('prefetch', 'rules', 2, 1, False, False, False),
+    Scenario('parallel', 'rules', 0, 4, False, False, False),
+    Scenario('compressed', 'rules', 0, 1, True, False, False),
+    Scenario('cached', None, 0, 1, False, True, False),
+    Scenario('search', 'rules', 0, 1, False, False, True),
+]
+
+BenchmarkResult = namedtuple(
+    'BenchmarkResult',
+    ['name', 'messages', 'seconds', 'first_seconds', 'bytes_sent',
+     'bytes_received', 'round_trips', 'peak_memory']
+)
+
+
+def get_rules():
+    """Get the rules every scenario runs.
+
+    They need a few header fields and the flags, and move or delete around
+    one message in eight.
+
+    """
+    return RuleSet([
+        (test.ListId('announce.lists.example.net'), actions.Move('Lists')),
+        (
+            test.And(test.IsRead(), test.SubjectContains('newsletter')),
+            actions.DeleteMessage()
+        ),
+    ], source_hash='benchmark')
+
+
+def get_memory_rules():
+    """Get rules that test messages like get_rules, but only log matches."""
+    return RuleSet(
+        [(test, actions.LogMessage()) for test, _ in get_rules()],
+        source_hash='benchmark-memory'
+    )
+
+
+class ServerProcess(object):
+
+    """Run a FakeIMAPServer with synthetic messages in a child process.
+
+    Use it as a context manager. 'server_kwargs' are passed to
+    FakeIMAPServer, and 'message_kwargs' to make_messages.
+
+    """
+
+    def __init__(self, message_kwargs, server_kwargs):
+        self._message_kwargs = message_kwargs
+        self._server_kwargs = server_kwargs
+
+    def __enter__(self):
+        self._pipe, child_pipe = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            target=_serve,
+            args=(child_pipe, self._message_kwargs, self._server_kwargs),
+            daemon=True
+        )
+        self._process.start()
+        self.server_info = self._pipe.recv()
+        return self
+
+    def stats(self):
+        """Get the server's ServerStats, and start counting again."""
+        self._pipe.send('stats')
+        return self._pipe.recv()
+
+    def __exit__(self, *exc_info):
+        self._pipe.send('stop')
+        self._process.join()
+
+
+def _serve(pipe, message_kwargs, server_kwargs):
+    messages = make_messages(**message_kwargs)
+    with FakeIMAPServer({'INBOX': messages}, **server_kwargs) as server:
+        pipe.send(server.server_info())
+        while pipe.recv() == 'stats':
+            with server.lock:
+                pipe.send(server.stats)
+                server.reset_stats()
+
+
+def scan(connection, scenario, rules):
+    """Scan INBOX with 'rules', as 'scenario' says.
+
+    Returns the number of messages tested, and how many seconds it took to
+    test the first one.
+
+    """
+    start = time.perf_counter()
+    first_seconds = None
+    fetch_parts = rules.fetch_parts if scenario.fetch_parts else None
+    criteria = None
+    if scenario.search:
+        criteria = rules.get_search_criteria(
+            connection.supports_substring_search())
+    connection_proxy = connection.get_connection_proxy()
+    rule_processor = SimpleRuleProcessor(
+        rules,
+        connection_proxy,
+        executor=BatchingActionExecutor(connection_proxy)
+    )
+    count = 0
+    for message in connection.get_messages(fetch_parts, search=criteria):
+        rule_processor.process_message(message)
+        if first_seconds is None:
+            first_seconds = time.perf_counter() - start
+        count += 1
+    rule_processor.flush()
+    return count, first_seconds or 0
+
+
+def run_scenario(scenario, message_kwargs, latency=0, trace_memory=False):
+    """Run 'scenario' against a fresh server. Returns a BenchmarkResult.
+
+    If 'trace_memory' is set, the peak memory allocated by the scan is
+    measured, otherwise 'peak_memory' is None.
+
+    """
+    capabilities = DEFAULT_CAPABILITIES
+    if not scenario.compress:
+        capabilities = [c for c in capabilities if c != 'COMPRESS=DEFLATE']
+    with tempfile.TemporaryDirectory() as directory, ServerProcess(
+            message_kwargs,
+            {'latency': latency, 'capabilities': capabilities}
+    ) as server:
+        cache = None
+        if scenario.cache:
+            cache = MessageCache(os.path.join(directory, 'cache.sqlite'))
+        connection = IMAPConnection(
+            server.server_info,
+            cache,
+            scenario.prefetch,
+            ScanOptions(connections=scenario.connections)
+        )
+        try:
+            if cache:
+                for message in connection.get_messages():
+                    pass
+            server.stats()
+            if trace_memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            count, first_seconds = scan(connection, scenario, get_rules())
+            seconds = time.perf_counter() - start
+            peak_memory = None
+            if trace_memory:
+                peak_memory = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            stats = server.stats()
+        finally:
+            connection.close()
+            if cache:
+                cache.close()
+    return BenchmarkResult(
+        scenario.name,
+        count,
+        seconds,
+        first_seconds,
+        stats.bytes_sent,
+        stats.bytes_received,
+        stats.round_trips,
+        peak_memory
+    )
+
+
+def run_replay_scenario(scenario, recording, rules, trace_memory=False):
+    """Run 'scenario' over 'recording'. Returns a BenchmarkResult.
+
+    :raises ReplayError: If the scenario needs something that wasn't
+        recorded.
+
+    """
+    connection = ReplayConnection(
+        recording,
+        prefetch=scenario.prefetch,
+        scan_options=ScanOptions(connections=scenario.connections)
+    )
+    try:
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        count, first_seconds = scan(connection, scenario, rules)
+        seconds = time.perf_counter() - start
+        peak_memory = None
+        if trace_memory:
+            peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        # Closing forgets the fetch connections:
+        clients = [
+            c._client for c in [connection] + connection._fetch_connections]
+        connection.close()
+    return BenchmarkResult(
+        scenario.name,
+        count,
+        seconds,
+        first_seconds,
+        sum(client.bytes_fetched for client in clients),
+        0,
+        sum(sum(client.commands.values()) for client in clients),
+        peak_memory
+    )
+
+
+def run_benchmark(run, *args):
+    """Time a scenario with 'run', then measure its memory.
+
+    'run' is run_scenario or run_replay_scenario, and is called with 'args'
+    and whether to trace memory. Returns a BenchmarkResult, with everything
+    but the peak memory from the timed run.
+
+    """
+    result = run(*args, False)
+    traced = run(*args, True)
+    return result._replace(peak_memory=traced.peak_memory)
+
+
+def measure_scan_memory(message_kwargs, chunk_size, fetch_parts=None):
+    """Scan a folder in chunks of 'chunk_size' with get_memory_rules.
+
+    Returns the peak memory the scan allocated, in bytes. 'fetch_parts' is
+    as for Scenario.
+
+    """
+    rules = get_memory_rules()
+    scenario = Scenario('memory', fetch_parts, 0, 1, False, False, False)
+    options = ScanOptions(
+        initial_chunk_size=chunk_size,
+        min_chunk_size=chunk_size,
+        max_chunk_size=chunk_size
+    )
+    with ServerProcess(message_kwargs, {}) as server:
+        connection = IMAPConnection(server.server_info, scan_options=options)
+        try:
+            tracemalloc.start()
+            scan(connection, scenario, rules)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+            connection.close()
+
+
+def run_memory_benchmark(message_kwargs, chunk_size=100):
+    """Print the peak memory of scanning ever larger folders."""
+    print('%8s %10s %12s' % ('messages', 'peak KiB', 'bytes/msg'))
+    count = message_kwargs['count']
+    for divisor in (8, 4, 2, 1):
+        kwargs = dict(message_kwargs, count=max(1, count // divisor))
+        peak = measure_scan_memory(kwargs, chunk_size)
+        print('%8d %10.0f %12.0f' % (
+            kwargs['count'], peak / 1024, peak / kwargs['count']))
+
+
+def format_result(result):
+    return '%-12s %8d %9.0f %8.1f %10.0f %9.0f %6d %10.0f' % (
+        result.name,
+        result.messages,
+        result.messages / result.seconds if result.seconds else 0,
+        result.first_seconds * 1000,
+        result.bytes_sent / 1024,
+        result.bytes_received / 1024,
+        result.round_trips,
+        result.peak_memory / 1024,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m gmailfilter.tests.benchmark',
+        description='Benchmark scanning a folder of synthetic messages.'
+    )
+    parser.add_argument(
+        '--messages', type=int, default=2000,
+        help='Messages in the folder. Default: 2000.')
+    parser.add_argument(
+        '--header-size', type=int, default=3000,
+        help='Average header size, in bytes. Default: 3000.')
+    parser.add_argument(
+        '--latency', type=float, default=0,
+        help='Milliseconds the server waits before every response.')
+    parser.add_argument(
+        '--memory', action='store_true',
+        help='Measure how peak memory grows with the number of messages.')
+    parser.add_argument(
+        '--replay', metavar='FILE',
+        help='Replay the recording in FILE instead of using synthetic '
+        'messages.')
+    parser.add_argument(
+        '--rules', metavar='RULES',
+        help='With --replay, run the INBOX rules from the rules file RULES. '
+        'Default: the benchmark rules.')
+    parser.add_argument(
+        'scenarios', nargs='*', metavar='SCENARIO',
+        help='Scenarios to run: %s. Default: all of them.' % ', '.join(
+            s.name for s in SCENARIOS))
+    args = parser.parse_args(argv)
+    names = [s.name for s in SCENARIOS]
+    for name in args.scenarios:
+        if name not in names:
+            parser.error('Unknown scenario: %s' % name)
+    message_kwargs = {'count': args.messages, 'header_size': args.header_size}
+    if args.memory:
+        run_memory_benchmark(message_kwargs)
+        return
+    scenarios = [
+        s for s in SCENARIOS if not args.scenarios or s.name in args.scenarios]
+    if args.replay:
+        recording = SessionRecording.load(args.replay)
+        rules = load_rules(args.rules) if args.rules else get_rules()
+        scenarios = [s for s in scenarios if not (s.compress or s.cache)]
+    print('%-12s %8s %9s %8s %10s %9s %6s %10s' % (
+        'scenario', 'messages', 'msgs/s', 'first ms', 'KiB sent', 'KiB recv',
+        'trips', 'peak KiB'))
+    for scenario in scenarios:
+        if not args.replay:
+            print(format_result(run_benchmark(
+                run_scenario, scenario, message_kwargs, args.latency / 1000)))
+            continue
+        try:
+            print(format_result(run_benchmark(
+                run_replay_scenario, scenario, recording, rules)))
+        except ReplayError as e:
+            print('%-12s %s' % (scenario.name, e))
+
+
+if __name__ == '__main__':
+    main()
@@ -30,10 +30,14 @@ class TestFactoryMixin(object):
 
 class FakeMessage(Message):
 
-    def __init__(self):
+    def __init__(self, uid=None):
         self.headers = {}
         self.flags = ()
         self.date = datetime.datetime.utcnow()
+        self._uid = uid
+
+    def uid(self):
+        return self._uid
 
     def get_headers(self):
         return self.headers
@@ -46,3 +50,14 @@ class FakeMessage(Message):
 
     def get_date(self):
         return self.date
+
+
+class RecordingAction(object):
+
+    """An action that records the messages it's run on."""
+
+    def __init__(self):
+        self.processed = []
+
+    def process(self, conn, message):
+        self.processed.append(message)
@@ -0,0 +1,935 @@
+"""An IMAP server that runs in the test process.
+
+FakeIMAPServer speaks enough IMAP4rev1 over a real socket for IMAPConnection
+to scan folders and run actions against it, so the real IMAPClient and imaplib
+code is exercised end to end. It counts the commands, round-trips and bytes
+of every session, and can add latency to every response, which makes it
+suitable for benchmarks as well as tests.
+
+It is not a complete or strict implementation: it accepts anything it
+understands, and says BAD to anything else.
+
+"""
+
+from collections import Counter
+import datetime
+import email.parser
+import email.policy
+import random
+import re
+import socket
+import socketserver
+import threading
+import time
+import zlib
+
+import fixtures
+
+from gmailfilter._config import ServerInfo
+
+
+DEFAULT_CAPABILITIES = (
+    'IMAP4rev1',
+    'IDLE',
+    'UIDPLUS',
+    'MOVE',
+    'CONDSTORE',
+    'COMPRESS=DEFLATE',
+)
+
+SEEN = b'\\Seen'
+FLAGGED = b'\\Flagged'
+ANSWERED = b'\\Answered'
+DELETED = b'\\Deleted'
+DRAFT = b'\\Draft'
+
+_SYSTEM_FLAGS = b'(\\Answered \\Flagged \\Deleted \\Seen \\Draft)'
+
+
+class StoredMessage(object):
+
+    """A message in a FakeIMAPServer folder."""
+
+    def __init__(self, header, body=b'', flags=(), internaldate=None):
+        self.uid = None
+        self.modseq = None
+        self.header = header
+        self.body = body
+        self.flags = set(flags)
+        self.internaldate = internaldate or datetime.datetime(
+            2015, 1, 1, tzinfo=datetime.timezone.utc)
+        self._parsed = None
+
+    @property
+    def size(self):
+        return len(self.header) + len(self.body)
+
+    def get_header(self, name):
+        """Get the list of values of header 'name'."""
+        if self._parsed is None:
+            self._parsed = email.parser.BytesHeaderParser(
+                policy=email.policy.compat32).parsebytes(self.header)
+        return [str(value) for value in self._parsed.get_all(name, [])]
+
+    def copy(self):
+        return StoredMessage(
+            self.header, self.body, self.flags, self.internaldate)
+
+
+class Folder(object):
+
+    """A folder of StoredMessages, sorted by UID."""
+
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.highest_modseq = 1
+        self.messages = []
+
+    def add(self, message):
+        message.uid = self.uidnext
+        self.uidnext += 1
+        self.touch(message)
+        self.messages.append(message)
+        return message
+
+    def touch(self, message):
+        """Give 'message' a new mod-sequence, as if its flags changed."""
+        self.highest_modseq += 1
+        message.modseq = self.highest_modseq
+
+
+# Header fields used to make synthetic messages look like real mail:
+_WORDS = (
+    'invoice report meeting update weekly your account order shipped review '
+    'request build failed passed release notes team lunch security alert '
+    'newsletter offer reminder project status question draft agenda'
+).split()
+_DOMAINS = (
+    'example.com', 'example.org', 'lists.example.net', 'mail.example.io')
+_LISTS = ('dev', 'announce', 'users', 'commits')
+
+
+def make_messages(count, header_size=3000, body_size=4000, seed=0,
+                  start=datetime.datetime(2015, 1, 1)):
+    """Make 'count' synthetic StoredMessages, reproducibly from 'seed'.
+
+    Headers have the fields real mail tends to have, including a few
+    Received and signature headers, padded to about 'header_size' bytes on
+    average (sizes vary by half either way). Bodies are 'body_size' bytes of
+    text. Around 60% of the messages are read, 10% answered and 5% flagged,
+    and a third of them come from mailing lists. The messages arrive an hour
+    apart, from 'start'.
+
+    """
+    rng = random.Random(seed)
+    messages = []
+    for i in range(count):
+        date = (start + datetime.timedelta(hours=i)).replace(
+            tzinfo=datetime.timezone.utc)
+        sender = '%s@%s' % (rng.choice(_WORDS), rng.choice(_DOMAINS))
+        fields = [
+            ('Received', 'from mx%d.%s by mail.example.com with ESMTPS; %s'
+             % (rng.randrange(10), rng.choice(_DOMAINS),
+                _format_date(date))),
+            ('Received', 'from localhost by mx.%s with SMTP; %s'
+             % (rng.choice(_DOMAINS), _format_date(date))),
+            ('Date', _format_date(date)),
+            ('From', 'Sender %d <%s>' % (i, sender)),
+            ('To', 'Recipient <me@example.com>'),
+            ('Subject', ' '.join(rng.choice(_WORDS) for _ in range(5))),
+            ('Message-ID', '<%d.%08x@%s>' % (
+                i, rng.getrandbits(32), sender.split('@')[1])),
+            ('MIME-Version', '1.0'),
+            ('Content-Type', 'text/plain; charset="utf-8"'),
+        ]
+        if rng.random() < 1 / 3:
+            name = rng.choice(_LISTS)
+            fields.append(('List-Id', '<%s.lists.example.net>' % name))
+            fields.append(
+                ('List-Unsubscribe', '<mailto:%s-leave@example.net>' % name))
+        header = b''.join(
+            b'%s: %s\r\n' % (name.encode(), value.encode())
+            for name, value in fields
+        )
+        # Signatures and authentication results make up the bulk of most
+        # real headers:
+        target = int(header_size * rng.uniform(0.5, 1.5))
+        while len(header) < target:
+            header += b'X-Signature: %s\r\n' % b' '.join(
+                b'%016x' % rng.getrandbits(64) for _ in range(4))
+        header += b'\r\n'
+        flags = set()
+        if rng.random() < 0.6:
+            flags.add(SEEN)
+        if rng.random() < 0.1:
+            flags.add(ANSWERED)
+        if rng.random() < 0.05:
+            flags.add(FLAGGED)
+        body = (b'%s\r\n' % ' '.join(_WORDS).encode()) * (
+            body_size // (len(' '.join(_WORDS)) + 2) + 1)
+        messages.append(
+            StoredMessage(header, body[:body_size], flags, date))
+    return messages
+
+
+def _format_date(date):
+    return date.strftime('%a, %d %b %Y %H:%M:%S +0000')
+
+
+class ServerStats(object):
+
+    """Counts of what a FakeIMAPServer's clients did.
+
+    'bytes_sent' and 'bytes_received' count bytes on the wire, so they're
+    compressed if the session was.
+
+    """
+
+    def __init__(self):
+        self.connections = 0
+        self.commands = Counter()
+        self.round_trips = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.messages_fetched = 0
+
+
+class _BadCommand(Exception):
+    pass
+
+
+class _NoCommand(Exception):
+    pass
+
+
+class FakeIMAPServer(fixtures.Fixture):
+
+    """An IMAP server listening on localhost, in a background thread.
+
+    'folders' maps folder names to lists of StoredMessages. INBOX always
+    exists. Every response is delayed by 'latency' seconds, as is the
+    continuation the server sends before a client may send a literal, so
+    each is one round-trip.
+
+    """
+
+    def __init__(self, folders=None, latency=0,
+                 capabilities=DEFAULT_CAPABILITIES, username='user',
+                 password='secret'):
+        super().__init__()
+        self.latency = latency
+        self.capabilities = tuple(capabilities)
+        self.username = username
+        self.password = password
+        self.folders = {'INBOX': Folder()}
+        self.lock = threading.RLock()
+        self.stats = ServerStats()
+        for name, messages in (folders or {}).items():
+            self.add_messages(name, messages)
+
+    def add_messages(self, folder, messages):
+        """Add 'messages' to 'folder', creating it if needed."""
+        with self.lock:
+            target = self.folders.setdefault(folder, Folder())
+            for message in messages:
+                target.add(message)
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = ServerStats()
+
+    def _setUp(self):
+        self._server = socketserver.ThreadingTCPServer(
+            ('127.0.0.1', 0), _Session, bind_and_activate=True)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self.port = self._server.server_address[1]
+        thread = threading.Thread(
+            target=self._server.serve_forever, kwargs={'poll_interval': 0.05},
+            daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self._server.server_close)
+        self.addCleanup(self._server.shutdown)
+
+    def server_info(self, compress=True):
+        """Get a ServerInfo for connecting to the server."""
+        return ServerInfo(
+            '127.0.0.1', self.username, self.password, self.port,
+            use_ssl=False, compress=compress)
+
+
+def parse_arguments(data):
+    """Parse IMAP command arguments.
+
+    Atoms, quoted strings and literals become bytes, and parenthesized lists
+    become lists. Brackets in an atom may contain spaces and parentheses, as
+    in 'BODY.PEEK[HEADER.FIELDS (FROM TO)]'.
+
+    """
+    stack = [[]]
+    i = 0
+    while i < len(data):
+        char = data[i:i + 1]
+        if char == b' ':
+            i += 1
+        elif char == b'(':
+            stack[-1].append([])
+            stack.append(stack[-1][-1])
+            i += 1
+        elif char == b')':
+            if len(stack) == 1:
+                raise _BadCommand("Unbalanced parentheses")
+            stack.pop()
+            i += 1
+        elif char == b'"':
+            value = bytearray()
+            i += 1
+            while data[i:i + 1] != b'"':
+                if i >= len(data):
+                    raise _BadCommand("Unterminated string")
+                if data[i:i + 1] == b'\\':
+                    i += 1
+                value += data[i:i + 1]
+                i += 1
+            stack[-1].append(bytes(value))
+            i += 1
+        elif char == b'{':
+            match = re.match(rb'\{(\d+)\}\r\n', data[i:])
+            if match is None:
+                raise _BadCommand("Bad literal")
+            start = i + match.end()
+            i = start + int(match.group(1))
+            stack[-1].append(data[start:i])
+        else:
+            start = i
+            depth = 0
+            while i < len(data) and (depth or data[i:i + 1] not in b' ()'):
+                if data[i:i + 1] == b'[':
+                    depth += 1
+                elif data[i:i + 1] == b']':
+                    depth -= 1
+                i += 1
+            stack[-1].append(data[start:i])
+    if len(stack) != 1:
+        raise _BadCommand("Unbalanced parentheses")
+    return stack[0]
+
+
+def parse_sequence_set(text, largest):
+    """Parse an IMAP sequence set into a list of (low, high) ranges.
+
+    '*' is 'largest', the highest sequence number or UID in the folder.
+
+    """
+    ranges = []
+    try:
+        for part in text.split(b','):
+            ends = [
+                largest if end == b'*' else int(end)
+                for end in part.split(b':')
+            ]
+            if len(ends) > 2:
+                raise ValueError(part)
+            ranges.append((min(ends), max(ends)))
+    except ValueError:
+        raise _BadCommand("Bad sequence set")
+    return ranges
+
+
+def _in_ranges(number, ranges):
+    return any(low <= number <= high for low, high in ranges)
+
+
+def _quote(text):
+    if isinstance(text, str):
+        text = text.encode('utf-8')
+    return b'"%s"' % text.replace(b'\\', b'\\\\').replace(b'"', b'\\"')
+
+
+def _literal(data):
+    return b'{%d}\r\n%s' % (len(data), data)
+
+
+def _format_internaldate(date):
+    return date.strftime('"%d-%b-%Y %H:%M:%S +0000"').encode()
+
+
+_HEADER_FIELDS = re.compile(
+    rb'HEADER\.FIELDS(\.NOT)? \(([^)]*)\)$', re.IGNORECASE)
+
+
+def _get_section(message, section):
+    """Get the content of body section 'section' of 'message'."""
+    upper = section.upper()
+    if upper == b'':
+        return message.header + message.body
+    if upper == b'HEADER':
+        return message.header
+    if upper == b'TEXT':
+        return message.body
+    match = _HEADER_FIELDS.match(section)
+    if match is None:
+        raise _BadCommand("Unsupported section")
+    names = {name.strip(b'"').lower() for name in match.group(2).split()}
+    exclude = bool(match.group(1))
+    lines = []
+    keep = False
+    for line in message.header.split(b'\r\n')[:-2]:
+        if not line[:1].isspace():
+            name = line.split(b':', 1)[0].strip().lower()
+            keep = (name in names) != exclude
+        if keep:
+            lines.append(line + b'\r\n')
+    return b''.join(lines) + b'\r\n'
+
+
+class _Session(socketserver.BaseRequestHandler):
+
+    """One client connection to a FakeIMAPServer."""
+
+    def setup(self):
+        self.fake = self.server.fake
+        self.folder = None
+        self.folder_name = None
+        self.readonly = False
+        self.known_exists = 0
+        self.output = []
+        self.input = b''
+        self.compressor = None
+        self.decompressor = None
+        self.compress_next = False
+        self.closed = False
+        with self.fake.lock:
+            self.fake.stats.connections += 1
+
+    def handle(self):
+        self.untagged(b'OK Fake IMAP server ready')
+        self.flush()
+        while not self.closed:
+            try:
+                data = self.read_command()
+            except (ConnectionError, OSError):
+                return
+            if data is None:
+                return
+            tag = b'*'
+            try:
+                arguments = parse_arguments(data)
+                if len(arguments) < 2:
+                    raise _BadCommand("Missing command")
+                tag = arguments[0]
+                name = arguments[1].upper()
+                arguments = arguments[2:]
+                use_uid = name == b'UID'
+                if use_uid:
+                    if not arguments:
+                        raise _BadCommand("Missing command")
+                    name, arguments = arguments[0].upper(), arguments[1:]
+                self.count_command(name, use_uid)
+                self.wait()
+                with self.fake.lock:
+                    text = self.run(name, arguments, use_uid)
+                self.tagged(tag, b'OK ' + text)
+            except _NoCommand as e:
+                self.tagged(tag, b'NO ' + str(e).encode())
+            except (_BadCommand, IndexError, ValueError, TypeError) as e:
+                self.tagged(tag, b'BAD ' + (str(e).encode() or b'Error'))
+            try:
+                self.flush()
+            except OSError:
+                return
+            if self.compress_next:
+                self.start_compression()
+
+    def count_command(self, name, use_uid):
+        with self.fake.lock:
+            stats = self.fake.stats
+            stats.commands[(b'UID ' if use_uid else b'') + name] += 1
+            stats.round_trips += 1
+
+    def wait(self):
+        if self.fake.latency:
+            time.sleep(self.fake.latency)
+
+    # Input and output:
+
+    def recv(self):
+        data = self.request.recv(65536)
+        if not data:
+            raise ConnectionError("Client disconnected")
+        with self.fake.lock:
+            self.fake.stats.bytes_received += len(data)
+        if self.decompressor is not None:
+            data = self.decompressor.decompress(data)
+        self.input += data
+
+    def read_line(self):
+        while b'\r\n' not in self.input:
+            self.recv()
+        line, self.input = self.input.split(b'\r\n', 1)
+        return line + b'\r\n'
+
+    def read_exact(self, size):
+        while len(self.input) < size:
+            self.recv()
+        data, self.input = self.input[:size], self.input[size:]
+        return data
+
+    def read_command(self):
+        """Read a command, including any literals, without the final CRLF."""
+        data = self.read_line()
+        while True:
+            match = re.search(rb'\{(\d+)\}\r\n$', data)
+            if match is None:
+                return data[:-2]
+            with self.fake.lock:
+                self.fake.stats.round_trips += 1
+            self.wait()
+            self.output.append(b'+ Ready for literal\r\n')
+            self.flush()
+            data += self.read_exact(int(match.group(1)))
+            data += self.read_line()
+
+    def untagged(self, response):
+        self.output.append(b'* ' + response + b'\r\n')
+
+    def tagged(self, tag, response):
+        self.output.append(tag + b' ' + response + b'\r\n')
+
+    def flush(self):
+        data = b''.join(self.output)
+        self.output = []
+        if self.compressor is not None:
+            data = (self.compressor.compress(data)
+                    + self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        with self.fake.lock:
+            self.fake.stats.bytes_sent += len(data)
+        self.request.sendall(data)
+
+    def start_compression(self):
+        self.compress_next = False
+        # RFC 4978 uses raw deflate, with no zlib header:
+        self.compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        if self.input:
+            self.input = self.decompressor.decompress(self.input)
+
+    # Commands. Each returns the text of the tagged OK response, or raises
+    # _NoCommand or _BadCommand:
+
+    def run(self, name, arguments, use_uid):
+        method = getattr(self, 'do_' + name.decode('ascii', 'replace'), None)
+        if method is None or (use_uid and name not in (
+                b'FETCH', b'SEARCH', b'STORE', b'COPY', b'MOVE', b'EXPUNGE')):
+            raise _BadCommand("Unknown command")
+        if name in (b'FETCH', b'SEARCH', b'STORE', b'COPY', b'MOVE',
+                    b'EXPUNGE', b'CLOSE', b'UNSELECT'):
+            if self.folder is None:
+                raise _BadCommand("No folder selected")
+            return method(arguments, use_uid)
+        return method(arguments)
+
+    def do_CAPABILITY(self, arguments):
+        self.untagged(
+            b'CAPABILITY ' + ' '.join(self.fake.capabilities).encode())
+        return b'CAPABILITY completed'
+
+    def do_NOOP(self, arguments):
+        if self.folder is not None:
+            self.report_exists()
+        return b'NOOP completed'
+
+    def do_LOGIN(self, arguments):
+        username, password = arguments
+        if (username.decode() != self.fake.username
+                or password.decode() != self.fake.password):
+            raise _NoCommand("[AUTHENTICATIONFAILED] Invalid credentials")
+        return b'LOGIN completed'
+
+    def do_LOGOUT(self, arguments):
+        self.untagged(b'BYE Logging out')
+        self.closed = True
+        return b'LOGOUT completed'
+
+    def do_COMPRESS(self, arguments):
+        if ('COMPRESS=' + arguments[0].decode().upper()
+                not in self.fake.capabilities):
+            raise _BadCommand("Unsupported compression")
+        if self.compressor is not None:
+            raise _NoCommand("[COMPRESSIONACTIVE] Already compressing")
+        # Everything after the tagged response is compressed:
+        self.compress_next = True
+        return b'DEFLATE active'
+
+    def get_folder(self, name):
+        name = name.decode('utf-8')
+        if name.upper() == 'INBOX':
+            name = 'INBOX'
+        if name not in self.fake.folders:
+            raise _NoCommand("[NONEXISTENT] No such folder")
+        return name, self.fake.folders[name]
+
+    def do_SELECT(self, arguments, readonly=False):
+        self.folder = None
+        self.folder_name, folder = self.get_folder(arguments[0])
+        self.untagged(b'FLAGS ' + _SYSTEM_FLAGS)
+        self.untagged(b'%d EXISTS' % len(folder.messages))
+        self.untagged(b'0 RECENT')
+        self.untagged(b'OK [UIDVALIDITY %d] UIDs valid' % folder.uidvalidity)
+        self.untagged(b'OK [UIDNEXT %d] Predicted next UID' % folder.uidnext)
+        self.untagged(b'OK [PERMANENTFLAGS %s] Limited' % _SYSTEM_FLAGS)
+        if self.condstore:
+            self.untagged(
+                b'OK [HIGHESTMODSEQ %d] Highest' % folder.highest_modseq)
+        self.folder = folder
+        self.readonly = readonly
+        self.known_exists = len(folder.messages)
+        if readonly:
+            return b'[READ-ONLY] EXAMINE completed'
+        return b'[READ-WRITE] SELECT completed'
+
+    def do_EXAMINE(self, arguments):
+        return self.do_SELECT(arguments, readonly=True)
+
+    def do_CLOSE(self, arguments, use_uid=False):
+        if not self.readonly:
+            self.expunge(lambda message: True, report=False)
+        self.folder = None
+        return b'CLOSE completed'
+
+    def do_UNSELECT(self, arguments, use_uid=False):
+        self.folder = None
+        return b'UNSELECT completed'
+
+    @property
+    def condstore(self):
+        return ('CONDSTORE' in self.fake.capabilities
+                or 'QRESYNC' in self.fake.capabilities)
+
+    def do_STATUS(self, arguments):
+        name, folder = self.get_folder(arguments[0])
+        values = {
+            b'MESSAGES': len(folder.messages),
+            b'RECENT': 0,
+            b'UIDNEXT': folder.uidnext,
+            b'UIDVALIDITY': folder.uidvalidity,
+            b'UNSEEN': sum(
+                1 for m in folder.messages if SEEN not in m.flags),
+        }
+        if self.condstore:
+            values[b'HIGHESTMODSEQ'] = folder.highest_modseq
+        items = [item.upper() for item in arguments[1]]
+        self.untagged(b'STATUS %s (%s)' % (_quote(name), b' '.join(
+            b'%s %d' % (item, values[item]) for item in items)))
+        return b'STATUS completed'
+
+    def do_LIST(self, arguments):
+        reference, pattern = arguments
+        pattern = re.escape((reference + pattern).decode('utf-8'))
+        pattern = pattern.replace(r'\*', '.*').replace('%', '[^/]*')
+        for name in sorted(self.fake.folders):
+            if re.fullmatch(pattern, name):
+                self.untagged(b'LIST (\\HasNoChildren) "/" ' + _quote(name))
+        return b'LIST completed'
+
+    def do_CREATE(self, arguments):
+        name = arguments[0].decode('utf-8').rstrip('/')
+        if name.upper() == 'INBOX' or name in self.fake.folders:
+            raise _NoCommand("[ALREADYEXISTS] Folder exists")
+        self.fake.folders[name] = Folder()
+        # GMail says this, and actions check for it:
+        return b'Success'
+
+    def do_DELETE(self, arguments):
+        name, folder = self.get_folder(arguments[0])
+        if name == 'INBOX':
+            raise _NoCommand("Can't delete INBOX")
+        del self.fake.folders[name]
+        return b'DELETE completed'
+
+    def select_messages(self, sequence_set, use_uid):
+        """Get (sequence number, message) pairs for 'sequence_set'."""
+        messages = self.folder.messages
+        if use_uid:
+            largest = messages[-1].uid if messages else 0
+        else:
+            largest = len(messages)
+        ranges = parse_sequence_set(sequence_set, largest)
+        return [
+            (seq, message) for seq, message in enumerate(messages, 1)
+            if _in_ranges(message.uid if use_uid else seq, ranges)
+        ]
+
+    def do_FETCH(self, arguments, use_uid):
+        selected = self.select_messages(arguments[0], use_uid)
+        items = arguments[1]
+        if not isinstance(items, list):
+            items = [items]
+        items = [item.upper() if b'[' not in item else item for item in items]
+        if use_uid and b'UID' not in items:
+            items.insert(0, b'UID')
+        for seq, message in selected:
+            self.untagged(b'%d FETCH (%s)' % (
+                seq, b' '.join(self.fetch_item(message, item)
+                               for item in items)))
+        with self.fake.lock:
+            self.fake.stats.messages_fetched += len(selected)
+        return b'FETCH completed'
+
+    def fetch_item(self, message, item):
+        upper = item.upper()
+        if upper == b'UID':
+            return b'UID %d' % message.uid
+        if upper == b'FLAGS':
+            return b'FLAGS (%s)' % b' '.join(sorted(message.flags))
+        if upper == b'INTERNALDATE':
+            return b'INTERNALDATE ' + _format_internaldate(
+                message.internaldate)
+        if upper == b'RFC822.SIZE':
+            return b'RFC822.SIZE %d' % message.size
+        if upper == b'MODSEQ':
+            return b'MODSEQ (%d)' % message.modseq
+        if upper in (b'RFC822', b'RFC822.HEADER', b'RFC822.TEXT'):
+            section = {b'RFC822': b'', b'RFC822.HEADER': b'HEADER',
+                       b'RFC822.TEXT': b'TEXT'}[upper]
+            return upper + b' ' + _literal(_get_section(message, section))
+        match = re.match(rb'BODY(\.PEEK)?\[(.*)\]$', item, re.IGNORECASE)
+        if match is None:
+            raise _BadCommand("Unsupported fetch item")
+        section = match.group(2)
+        data = _get_section(message, section)
+        if not match.group(1) and not self.readonly and (
+                SEEN not in message.flags):
+            message.flags.add(SEEN)
+            self.folder.touch(message)
+        return b'BODY[%s] %s' % (section, _literal(data))
+
+    def do_SEARCH(self, arguments, use_uid):
+        if arguments and arguments[0].upper() == b'CHARSET':
+            arguments = arguments[2:]
+        matches = _SearchCompiler(self.folder).compile(arguments)
+        found = [
+            message.uid if use_uid else seq
+            for seq, message in enumerate(self.folder.messages, 1)
+            if matches(seq, message)
+        ]
+        response = b'SEARCH'
+        if found:
+            response += b' ' + b' '.join(b'%d' % n for n in found)
+        self.untagged(response)
+        return b'SEARCH completed'
+
+    def do_STORE(self, arguments, use_uid):
+        if self.readonly:
+            raise _NoCommand("Folder is read-only")
+        selected = self.select_messages(arguments[0], use_uid)
+        operation = arguments[1].upper()
+        flags = arguments[2]
+        if not isinstance(flags, list):
+            flags = [flags]
+        silent = operation.endswith(b'.SILENT')
+        operation = operation.rsplit(b'.', 1)[0] if silent else operation
+        for seq, message in selected:
+            if operation == b'+FLAGS':
+                message.flags.update(flags)
+            elif operation == b'-FLAGS':
+                message.flags.difference_update(flags)
+            elif operation == b'FLAGS':
+                message.flags = set(flags)
+            else:
+                raise _BadCommand("Bad STORE operation")
+            self.folder.touch(message)
+            if not silent:
+                self.untagged(b'%d FETCH (%s%s)' % (
+                    seq,
+                    b'UID %d ' % message.uid if use_uid else b'',
+                    self.fetch_item(message, b'FLAGS')
+                ))
+        return b'STORE completed'
+
+    def copy_messages(self, arguments, use_uid):
+        selected = self.select_messages(arguments[0], use_uid)
+        name, target = self.get_folder(arguments[1])
+        source_uids = []
+        target_uids = []
+        for seq, message in selected:
+            copy = target.add(message.copy())
+            source_uids.append(b'%d' % message.uid)
+            target_uids.append(b'%d' % copy.uid)
+        copyuid = b''
+        if selected:
+            copyuid = b'[COPYUID %d %s %s] ' % (
+                target.uidvalidity,
+                b','.join(source_uids),
+                b','.join(target_uids)
+            )
+        return selected, copyuid
+
+    def do_COPY(self, arguments, use_uid):
+        selected, copyuid = self.copy_messages(arguments, use_uid)
+        return copyuid + b'COPY completed'
+
+    def do_MOVE(self, arguments, use_uid):
+        if self.readonly:
+            raise _NoCommand("Folder is read-only")
+        selected, copyuid = self.copy_messages(arguments, use_uid)
+        self.untagged(b'OK ' + copyuid + b'Moved')
+        moved = {id(message) for seq, message in selected}
+        self.expunge(lambda message: id(message) in moved)
+        return b'MOVE completed'
+
+    def do_EXPUNGE(self, arguments, use_uid):
+        if self.readonly:
+            raise _NoCommand("Folder is read-only")
+        if use_uid:
+            uids = {
+                message.uid for seq, message in
+                self.select_messages(arguments[0], True)
+            }
+            self.expunge(
+                lambda m: DELETED in m.flags and m.uid in uids)
+        else:
+            self.expunge(lambda m: DELETED in m.flags)
+        return b'EXPUNGE completed'
+
+    def expunge(self, should_remove, report=True):
+        messages = self.folder.messages
+        # Report from the end, so earlier sequence numbers stay valid:
+        for seq in range(len(messages), 0, -1):
+            if should_remove(messages[seq - 1]):
+                del messages[seq - 1]
+                if report:
+                    self.untagged(b'%d EXPUNGE' % seq)
+        self.known_exists = len(messages)
+
+    def report_exists(self):
+        exists = len(self.folder.messages)
+        if exists != self.known_exists:
+            self.untagged(b'%d EXISTS' % exists)
+            self.known_exists = exists
+
+    def do_IDLE(self, arguments):
+        if self.folder is None:
+            raise _BadCommand("No folder selected")
+        self.output.append(b'+ idling\r\n')
+        self.fake.lock.release()
+        try:
+            self.flush()
+            self.request.settimeout(0.05)
+            while True:
+                try:
+                    line = self.read_line()
+                    break
+                except socket.timeout:
+                    with self.fake.lock:
+                        self.report_exists()
+                    self.flush()
+        finally:
+            self.request.settimeout(None)
+            self.fake.lock.acquire()
+        if line.strip().upper() != b'DONE':
+            raise _BadCommand("Expected DONE")
+        return b'IDLE terminated'
+
+
+class _SearchCompiler(object):
+
+    """Turn parsed SEARCH criteria into a function of (seq, message)."""
+
+    _flag_keys = {
+        b'ANSWERED': (ANSWERED, True),
+        b'DELETED': (DELETED, True),
+        b'DRAFT': (DRAFT, True),
+        b'FLAGGED': (FLAGGED, True),
+        b'SEEN': (SEEN, True),
+        b'UNANSWERED': (ANSWERED, False),
+        b'UNDELETED': (DELETED, False),
+        b'UNDRAFT': (DRAFT, False),
+        b'UNFLAGGED': (FLAGGED, False),
+        b'UNSEEN': (SEEN, False),
+    }
+
+    _header_keys = (b'BCC', b'CC', b'FROM', b'SUBJECT', b'TO')
+
+    def __init__(self, folder):
+        self._folder = folder
+
+    def compile(self, criteria):
+        tokens = iter(criteria)
+        tests = [self._compile_key(token, tokens) for token in tokens]
+        return lambda seq, message: all(t(seq, message) for t in tests)
+
+    def _compile_key(self, token, tokens):
+        if isinstance(token, list):
+            return self.compile(token)
+        key = token.upper()
+        if key == b'ALL':
+            return lambda seq, message: True
+        if key in self._flag_keys:
+            flag, present = self._flag_keys[key]
+            return lambda seq, message: (flag in message.flags) == present
+        if key in (b'KEYWORD', b'UNKEYWORD'):
+            flag = next(tokens)
+            present = key == b'KEYWORD'
+            return lambda seq, message: (flag in message.flags) == present
+        if key in (b'NEW', b'RECENT'):
+            return lambda seq, message: False
+        if key == b'OLD':
+            return lambda seq, message: True
+        if key == b'NOT':
+            test = self._compile_key(next(tokens), tokens)
+            return lambda seq, message: not test(seq, message)
+        if key == b'OR':
+            first = self._compile_key(next(tokens), tokens)
+            second = self._compile_key(next(tokens), tokens)
+            return lambda seq, message: (
+                first(seq, message) or second(seq, message))
+        if key == b'UID':
+            messages = self._folder.messages
+            ranges = parse_sequence_set(
+                next(tokens), messages[-1].uid if messages else 0)
+            return lambda seq, message: _in_ranges(message.uid, ranges)
+        if key[:1].isdigit() or key[:1] == b'*':
+            ranges = parse_sequence_set(key, len(self._folder.messages))
+            return lambda seq, message: _in_ranges(seq, ranges)
+        if key in self._header_keys:
+            return self._contains_header(key.decode(), next(tokens))
+        if key == b'HEADER':
+            name = next(tokens).decode('utf-8')
+            return self._contains_header(name, next(tokens))
+        if key in (b'BODY', b'TEXT'):
+            needle = next(tokens).lower()
+            if key == b'BODY':
+                return lambda seq, message: needle in message.body.lower()
+            return lambda seq, message: (
+                needle in message.header.lower()
+                or needle in message.body.lower())
+        if key in (b'BEFORE', b'ON', b'SINCE',
+                   b'SENTBEFORE', b'SENTON', b'SENTSINCE'):
+            # Messages are made with a Date header matching their internal
+            # date, so the SENT keys use that too:
+            date = datetime.datetime.strptime(
+                next(tokens).decode(), '%d-%b-%Y').date()
+            compare = {
+                b'BEFORE': lambda d: d < date,
+                b'ON': lambda d: d == date,
+                b'SINCE': lambda d: d >= date,
+            }[key.replace(b'SENT', b'')]
+            return lambda seq, message: compare(message.internaldate.date())
+        if key in (b'LARGER', b'SMALLER'):
+            size = int(next(tokens))
+            if key == b'LARGER':
+                return lambda seq, message: message.size > size
+            return lambda seq, message: message.size < size
+        if key == b'MODSEQ':
+            modseq = int(next(tokens))
+            return lambda seq, message: message.modseq >= modseq
+        raise _BadCommand("Unsupported search key")
+
+    def _contains_header(self, name, needle):
+        needle = needle.decode('utf-8').lower()
+        return lambda seq, message: any(
+            needle in value.lower() for value in message.get_header(name))
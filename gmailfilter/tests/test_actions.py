@@ -0,0 +1,161 @@
+from testtools import TestCase
+
+from gmailfilter import actions
+
+
+class FakeConnection(object):
+
+    """Record the calls actions make on the connection."""
+
+    def __init__(self, capabilities=(), folders=('Existing',), deleted=()):
+        self.capabilities = capabilities
+        self.folders = set(folders)
+        self.deleted = set(deleted)
+        self.calls = []
+
+    def has_capability(self, capability):
+        return capability in self.capabilities
+
+    def folder_exists(self, folder):
+        return folder in self.folders
+
+    def create_folder(self, folder):
+        self.calls.append(('create_folder', folder))
+        self.folders.add(folder)
+        return b'Success'
+
+    def delete_messages(self, uids, silent=False):
+        self.calls.append(('delete_messages', uids))
+        if isinstance(uids, int):
+            uids = str(uids)
+        for item in uids.split(','):
+            start, _, end = item.partition(':')
+            self.deleted.update(range(int(start), int(end or start) + 1))
+
+    def search(self, criteria):
+        assert criteria == ['DELETED']
+        return sorted(self.deleted)
+
+    def __getattr__(self, name):
+        def record(*args):
+            self.calls.append((name,) + args)
+        return record
+
+
+class MoveBatchTests(TestCase):
+
+    def test_uses_move_extension(self):
+        conn = FakeConnection(capabilities=('MOVE',))
+        actions.Move('Existing').process_batch(conn, [1, 2, 3, 5])
+        self.assertEqual([('move', '1:3,5', 'Existing')], conn.calls)
+
+    def test_copy_delete_and_uid_expunge(self):
+        conn = FakeConnection(capabilities=('UIDPLUS',))
+        actions.Move('Existing').process_batch(conn, [1, 2])
+        self.assertEqual(
+            [
+                ('copy', '1:2', 'Existing'),
+                ('delete_messages', '1:2'),
+                ('uid_expunge', '1:2'),
+            ],
+            conn.calls
+        )
+
+    def test_expunges_without_uidplus(self):
+        conn = FakeConnection()
+        actions.Move('Existing').process_batch(conn, [1, 2])
+        self.assertEqual(
+            [
+                ('copy', '1:2', 'Existing'),
+                ('delete_messages', '1:2'),
+                ('expunge',),
+            ],
+            conn.calls
+        )
+
+    def test_does_not_expunge_other_deleted_messages(self):
+        conn = FakeConnection(deleted=[7])
+        actions.Move('Existing').process_batch(conn, [1, 2])
+        self.assertEqual(
+            [
+                ('copy', '1:2', 'Existing'),
+                ('delete_messages', '1:2'),
+            ],
+            conn.calls
+        )
+
+    def test_creates_missing_folder(self):
+        conn = FakeConnection(capabilities=('MOVE',))
+        actions.Move('New').process_batch(conn, [1])
+        self.assertEqual(
+            [('create_folder', 'New'), ('move', '1', 'New')],
+            conn.calls
+        )
+
+    def test_prepare_creates_missing_folder(self):
+        conn = FakeConnection()
+        actions.Move('New').prepare(conn)
+        actions.Move('Existing').prepare(conn)
+        self.assertEqual([('create_folder', 'New')], conn.calls)
+
+    def test_process_copies_without_creating_existing_folder(self):
+        conn = FakeConnection()
+        message = type('FakeMessage', (), {'uid': lambda self: 5})()
+        actions.Move('Existing').process(conn, message)
+        self.assertEqual(
+            [('copy', 5, 'Existing'), ('delete_messages', 5)], conn.calls)
+
+    def test_batch_key(self):
+        self.assertEqual(
+            actions.Move('A').get_batch_key(),
+            actions.Move('A').get_batch_key()
+        )
+        self.assertNotEqual(
+            actions.Move('A').get_batch_key(),
+            actions.Move('B').get_batch_key()
+        )
+
+
+class DeleteBatchTests(TestCase):
+
+    def test_delete_and_uid_expunge(self):
+        conn = FakeConnection(capabilities=('UIDPLUS',))
+        actions.DeleteMessage().process_batch(conn, [3])
+        self.assertEqual(
+            [('delete_messages', '3'), ('uid_expunge', '3')],
+            conn.calls
+        )
+
+    def test_large_batches_are_split(self):
+        self.patch(actions, 'MAX_UID_SET_LENGTH', 10)
+        conn = FakeConnection(capabilities=('UIDPLUS',))
+        actions.DeleteMessage().process_batch(
+            conn, [1, 2, 3, 10, 12, 14, 16, 100])
+        self.assertEqual(
+            [
+                ('delete_messages', '1:3,10,12'),
+                ('delete_messages', '14,16,100'),
+                ('uid_expunge', '1:3,10,12'),
+                ('uid_expunge', '14,16,100'),
+            ],
+            conn.calls
+        )
+
+
+class UIDSetTests(TestCase):
+
+    def test_uid_sets_are_bounded(self):
+        uids = list(range(1, 100001, 2))
+        uid_sets = actions._uid_sets(uids)
+        self.assertLessEqual(
+            max(len(uid_set) for uid_set in uid_sets),
+            actions.MAX_UID_SET_LENGTH
+        )
+        self.assertEqual(
+            uids,
+            [int(uid) for uid_set in uid_sets for uid in uid_set.split(',')]
+        )
+
+    def test_runs_are_collapsed(self):
+        self.assertEqual(
+            ['1:100000'], actions._uid_sets(list(range(1, 100001))))
@@ -0,0 +1,294 @@
+
+import asyncio
+import datetime
+import re
+
+from testtools import TestCase
+
+from gmailfilter import _async
+from gmailfilter import _asyncimap
+from gmailfilter import actions
+from gmailfilter._retest import RetestScheduler
+from gmailfilter._rules import RuleSet
+from gmailfilter.test import SubjectContains
+
+
+class FakeServer(object):
+
+    """Answer IMAP commands written to it by feeding 'reader'.
+
+    Serves one folder of 'messages', a dictionary of UID to subject. If
+    'hold_fetches' is set, UID FETCH commands aren't answered until that
+    many have arrived, and are then answered newest first.
+
+    """
+
+    def __init__(self, messages, capabilities=b'IMAP4rev1 IDLE MOVE',
+                 hold_fetches=0):
+        self.reader = asyncio.StreamReader()
+        self.messages = messages
+        self.capabilities = capabilities
+        self.hold_fetches = hold_fetches
+        self.held = []
+        self.commands = []
+        self.max_pending_fetches = 0
+        self.folders = ['INBOX']
+        self.failing = set()
+        self._idle_tag = None
+
+    # StreamWriter interface:
+
+    def write(self, data):
+        for line in data.decode().splitlines():
+            self._handle(line)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+    def send(self, data):
+        self.reader.feed_data(data)
+
+    def _handle(self, line):
+        if line == 'DONE':
+            self.send(self._idle_tag + b' OK IDLE done\r\n')
+            return
+        tag, command = line.split(' ', 1)
+        tag = tag.encode()
+        self.commands.append(command)
+        name = command.split(' ')[0]
+        if name == 'UID':
+            name = ' '.join(command.split(' ')[:2])
+        if name in self.failing:
+            self.send(tag + b' NO failed\r\n')
+            return
+        if name == 'CAPABILITY':
+            self.send(b'* CAPABILITY ' + self.capabilities + b'\r\n')
+        elif name == 'SELECT':
+            self.send(
+                b'* %d EXISTS\r\n* OK [UIDVALIDITY 7] UIDs valid\r\n'
+                % len(self.messages))
+        elif name == 'UID SEARCH':
+            uids = sorted(self.messages)
+            match = re.search(r'UID (\d+):\*', command)
+            if match:
+                uids = [u for u in uids if u >= int(match.group(1))]
+            self.send(
+                b'* SEARCH ' + ' '.join(map(str, uids)).encode() + b'\r\n')
+        elif name == 'UID FETCH':
+            self.held.append((tag, command))
+            self.max_pending_fetches = max(
+                self.max_pending_fetches, len(self.held))
+            if len(self.held) >= self.hold_fetches:
+                held, self.held = self.held, []
+                for held_tag, held_command in reversed(held):
+                    self._fetch(held_tag, held_command)
+            return
+        elif name == 'LIST':
+            for folder in self.folders:
+                self.send(b'* LIST () "/" "%s"\r\n' % folder.encode())
+        elif name == 'CREATE':
+            # GMail says 'Success', which Move checks for:
+            self.folders.append(command.split('"')[1])
+            self.send(tag + b' OK Success\r\n')
+            return
+        elif name == 'IDLE':
+            self._idle_tag = tag
+            self.send(b'+ idling\r\n')
+            return
+        self.send(tag + b' OK done\r\n')
+
+    def _fetch(self, tag, command):
+        uid_set = command.split(' ')[2]
+        for uid in _parse_uid_set(uid_set):
+            if uid not in self.messages:
+                continue
+            items = [b'UID %d' % uid]
+            if 'FLAGS' in command:
+                items.append(b'FLAGS (\\Seen)')
+            if 'BODY.PEEK[HEADER]' in command:
+                header = b'Subject: %s\r\n\r\n' % self.messages[uid].encode()
+                items.append(
+                    b'BODY[HEADER] {%d}\r\n%s' % (len(header), header))
+            self.send(b'* %d FETCH (%s)\r\n' % (uid, b' '.join(items)))
+        self.send(tag + b' OK done\r\n')
+
+
+def _parse_uid_set(uid_set):
+    for part in uid_set.split(','):
+        start, _, end = part.partition(':')
+        yield from range(int(start), int(end or start) + 1)
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def get_client(server):
+    return _asyncimap.AsyncIMAPClient(server.reader, server)
+
+
+class AsyncIMAPClientTests(TestCase):
+
+    def test_login_reads_capabilities(self):
+        async def login():
+            client = await get_client(FakeServer({}))
+            await client.login('user', 'p"w')
+            return client
+
+        client = run(login())
+        self.assertTrue(client.has_capability('IDLE'))
+        self.assertFalse(client.has_capability('UIDPLUS'))
+
+    def test_select_folder(self):
+        async def select():
+            client = await get_client(FakeServer({1: 'a', 2: 'b'}))
+            return await client.select_folder('INBOX')
+
+        self.assertEqual(
+            {b'EXISTS': 2, b'UIDVALIDITY': 7}, run(select()))
+
+    def test_search(self):
+        async def search():
+            client = await get_client(FakeServer({1: 'a', 5: 'b', 9: 'c'}))
+            return await client.search(['UID', '5:*'])
+
+        self.assertEqual([5, 9], run(search()))
+
+    def test_fetch_parses_literals(self):
+        async def fetch():
+            client = await get_client(FakeServer({3: 'hello'}))
+            return await client.fetch([3], ['FLAGS', 'BODY.PEEK[HEADER]'])
+
+        [(uid, parts)] = run(fetch()).items()
+        self.assertEqual(3, uid)
+        self.assertEqual(b'Subject: hello\r\n\r\n', parts[b'BODY[HEADER]'])
+        self.assertEqual((b'\\Seen',), parts[b'FLAGS'])
+
+    def test_pipelined_fetches_get_their_own_responses(self):
+        async def fetch():
+            server = FakeServer({1: 'a', 2: 'b', 3: 'c'}, hold_fetches=2)
+            client = await get_client(server)
+            return await asyncio.gather(
+                client.fetch([1, 2], ['FLAGS']),
+                client.fetch([3], ['FLAGS']),
+            )
+
+        first, second = run(fetch())
+        self.assertEqual([1, 2], sorted(first))
+        self.assertEqual([3], sorted(second))
+
+    def test_commands_pipelined_behind_fetches_get_their_responses(self):
+        async def pipeline():
+            server = FakeServer({1: 'a', 2: 'b'}, hold_fetches=2)
+            client = await get_client(server)
+            return await asyncio.gather(
+                client.fetch([1], ['FLAGS']),
+                client.list_folders(),
+                client.search(['ALL']),
+                client.fetch([2], ['FLAGS']),
+            )
+
+        first, folders, uids, second = run(pipeline())
+        self.assertEqual([1], sorted(first))
+        self.assertEqual(['INBOX'], [name for _, _, name in folders])
+        self.assertEqual([1, 2], uids)
+        self.assertEqual([2], sorted(second))
+
+    def test_failed_command_raises(self):
+        async def fail():
+            server = FakeServer({})
+            server.failing = {'NOOP'}
+            client = await get_client(server)
+            await client.noop()
+
+        self.assertRaises(_asyncimap.IMAPError, run, fail())
+
+    def test_idle_returns_when_server_reports_new_messages(self):
+        async def idle():
+            server = FakeServer({})
+            client = await get_client(server)
+            waiting = asyncio.ensure_future(client.idle_wait(10))
+            await asyncio.sleep(0)
+            server.send(b'* 1 EXISTS\r\n')
+            return await waiting
+
+        self.assertTrue(run(idle()))
+
+    def test_idle_times_out(self):
+        async def idle():
+            client = await get_client(FakeServer({}))
+            return await client.idle_wait(0.01)
+
+        self.assertFalse(run(idle()))
+
+
+class FormatTests(TestCase):
+
+    def test_uid_set_collapses_ranges(self):
+        self.assertEqual(
+            '1:3,5,7:8', _asyncimap.format_uid_set([8, 1, 2, 3, 5, 7]))
+
+    def test_search_criteria(self):
+        self.assertEqual(
+            'NOT (SUBJECT "two words") BEFORE 2-Mar-2020 HEADER List-Id ""',
+            _asyncimap.format_search_criteria([
+                'NOT', ['SUBJECT', 'two words'],
+                'BEFORE', datetime.date(2020, 3, 2),
+                'HEADER', 'List-Id', '',
+            ])
+        )
+
+
+class AsyncConnectionTests(TestCase):
+
+    def get_connection(self, server, **kwargs):
+        return _async.AsyncIMAPConnection(
+            _asyncimap.AsyncIMAPClient(server.reader, server), **kwargs)
+
+    def test_get_messages_pipelines_fetches(self):
+        async def scan():
+            server = FakeServer(
+                {uid: str(uid) for uid in range(1, 401)}, hold_fetches=2)
+            connection = self.get_connection(server, pipeline_depth=2)
+            uids = [
+                m.uid() async for m in connection.get_messages(['FLAGS'])
+            ]
+            return server, uids
+
+        server, uids = run(scan())
+        self.assertEqual(list(range(1, 401)), uids)
+        self.assertEqual(2, server.max_pending_fetches)
+
+    def test_rules_fetch_missing_parts_and_run_actions(self):
+        rules = RuleSet([(SubjectContains('move'), actions.Move('Archive'))])
+
+        async def filter_inbox():
+            server = FakeServer({1: 'keep me', 2: 'move me'})
+            connection = self.get_connection(server)
+            await connection._client.capabilities()
+            processor = await _async.AsyncRuleProcessor.create(
+                rules, connection)
+            async for message in connection.get_messages(['FLAGS']):
+                await processor.process_message(message)
+            await processor.flush()
+            return server
+
+        server = run(filter_inbox())
+        self.assertIn('CREATE "Archive"', server.commands)
+        self.assertIn('UID MOVE 2 "Archive"', server.commands)
+        self.assertIn('UID FETCH 1 (BODY.PEEK[HEADER])', server.commands)
+
+    def test_watch_messages_retests_due_messages(self):
+        async def watch():
+            server = FakeServer({1: 'a', 2: 'b'})
+            connection = self.get_connection(server)
+            await connection._client.capabilities()
+            scheduler = RetestScheduler([(1, 0)])
+            async for message in connection.watch_messages(
+                    ['FLAGS'], 3, scheduler=scheduler):
+                return message.uid(), len(scheduler)
+
+        self.assertEqual((1, 0), run(watch()))
@@ -0,0 +1,97 @@
+import datetime
+import os.path
+
+from testtools import TestCase
+import fixtures
+
+from gmailfilter._cache import (
+    default_cache_path,
+    is_cacheable,
+    MessageCache,
+    response_key,
+)
+
+
+class CachePathTests(TestCase):
+
+    def test_default_path_in_normal_mode(self):
+        fake_home = '/some/fake/home'
+        self.useFixture(fixtures.EnvironmentVariable('HOME', fake_home))
+        self.assertEqual(
+            os.path.join(fake_home, '.cache/gmailfilter/cache.sqlite'),
+            default_cache_path()
+        )
+
+    def test_default_path_in_snap_mode(self):
+        fake_home = '/snap/foo'
+        self.useFixture(
+            fixtures.EnvironmentVariable('SNAP_USER_DATA', fake_home))
+        self.assertEqual(
+            os.path.join(fake_home, 'cache.sqlite'),
+            default_cache_path()
+        )
+
+
+class PartNameTests(TestCase):
+
+    def test_response_key_strips_peek(self):
+        self.assertEqual(b'BODY[HEADER]', response_key('BODY.PEEK[HEADER]'))
+        self.assertEqual(b'BODY[HEADER]', response_key(b'BODY.PEEK[HEADER]'))
+
+    def test_response_key_for_simple_parts(self):
+        self.assertEqual(b'FLAGS', response_key('FLAGS'))
+
+    def test_immutable_parts_are_cacheable(self):
+        self.assertTrue(is_cacheable('BODY.PEEK[HEADER]'))
+        self.assertTrue(is_cacheable(b'BODY[HEADER.FIELDS (SUBJECT)]'))
+        self.assertTrue(is_cacheable('INTERNALDATE'))
+        self.assertTrue(is_cacheable(b'RFC822.SIZE'))
+
+    def test_mutable_parts_are_not_cacheable(self):
+        self.assertFalse(is_cacheable('FLAGS'))
+        self.assertFalse(is_cacheable(b'UID'))
+
+
+class MessageCacheTests(TestCase):
+
+    def get_cache(self):
+        directory = self.useFixture(fixtures.TempDir()).path
+        return os.path.join(directory, 'cache.sqlite')
+
+    def test_values_roundtrip(self):
+        path = self.get_cache()
+        cache = MessageCache(path)
+        cache.select_folder('INBOX', 1)
+        parts = {
+            b'BODY[HEADER]': b'Subject: foo\r\n\r\n',
+            b'INTERNALDATE': datetime.datetime(2015, 7, 5, 12, 30),
+            b'RFC822.SIZE': 1234,
+            b'FLAGS': (b'\\Seen',),
+        }
+        cache.store(5, parts)
+        cache.close()
+
+        cache = MessageCache(path)
+        cache.select_folder('INBOX', 1)
+        del parts[b'FLAGS']
+        self.assertEqual({5: parts}, cache.get_parts([4, 5]))
+
+    def test_uidvalidity_change_clears_folder(self):
+        cache = MessageCache(self.get_cache())
+        cache.select_folder('INBOX', 1)
+        cache.store(5, {b'RFC822.SIZE': 10})
+        cache.select_folder('Other', 1)
+        cache.store(5, {b'RFC822.SIZE': 20})
+
+        cache.select_folder('INBOX', 2)
+        self.assertEqual({}, cache.get_parts([5]))
+        cache.select_folder('Other', 1)
+        self.assertEqual({5: {b'RFC822.SIZE': 20}}, cache.get_parts([5]))
+
+    def test_retain_evicts_other_uids(self):
+        cache = MessageCache(self.get_cache())
+        cache.select_folder('INBOX', 1)
+        for uid in (1, 2, 3):
+            cache.store(uid, {b'RFC822.SIZE': uid})
+        cache.retain([2])
+        self.assertEqual([2], list(cache.get_parts([1, 2, 3])))
@@ -0,0 +1,287 @@
+import os.path
+
+from testtools import TestCase
+import fixtures
+
+from gmailfilter import test
+from gmailfilter._checkpoint import (
+    FetchProfile,
+    HALF_LIFE,
+    PartUsage,
+    ScanCheckpoint,
+    ScanJournal,
+)
+from gmailfilter._rules import RuleSet
+
+
+DAY = 24 * 3600
+
+
+class ScanCheckpointTests(TestCase):
+
+    def get_checkpoint(self):
+        directory = self.useFixture(fixtures.TempDir()).path
+        return ScanCheckpoint(os.path.join(directory, 'checkpoint.json'))
+
+    def test_full_scan_with_no_checkpoint(self):
+        checkpoint = self.get_checkpoint()
+        self.assertIsNone(checkpoint.get_min_uid('INBOX', 1, 'abc', DAY))
+
+    def test_incremental_after_full_scan(self):
+        checkpoint = self.get_checkpoint()
+        checkpoint.record_scan('INBOX', 1, 'abc', 100, True, now=1000)
+        self.assertEqual(
+            101,
+            checkpoint.get_min_uid('INBOX', 1, 'abc', DAY, now=2000)
+        )
+
+    def test_checkpoint_survives_save(self):
+        checkpoint = self.get_checkpoint()
+        checkpoint.record_scan('INBOX', 1, 'abc', 100, True, now=1000)
+        checkpoint.save()
+
+        checkpoint = ScanCheckpoint(checkpoint.path)
+        self.assertEqual(
+            101,
+            checkpoint.get_min_uid('INBOX', 1, 'abc', DAY, now=2000)
+        )
+
+    def test_uidvalidity_change_forces_full_scan(self):
+        checkpoint = self.get_checkpoint()
+        checkpoint.record_scan('INBOX', 1, 'abc', 100, True, now=1000)
+        self.assertIsNone(
+            checkpoint.get_min_uid('INBOX', 2, 'abc', DAY, now=2000))
+
+    def test_rules_change_forces_full_scan(self):
+        checkpoint = self.get_checkpoint()
+        checkpoint.record_scan('INBOX', 1, 'abc', 100, True, now=1000)
+        self.assertIsNone(
+            checkpoint.get_min_uid('INBOX', 1, 'def', DAY, now=2000))
+
+    def test_rescan_interval_forces_full_scan(self):
+        checkpoint = self.get_checkpoint()
+        checkpoint.record_scan('INBOX', 1, 'abc', 100, True, now=1000)
+        checkpoint.record_scan('INBOX', 1, 'abc', 110, False, now=1000 + DAY)
+        self.assertIsNone(
+            checkpoint.get_min_uid('INBOX', 1, 'abc', DAY, now=1001 + DAY))
+
+    def test_incremental_scan_without_messages_keeps_last_uid(self):
+        checkpoint = self.get_checkpoint()
+        checkpoint.record_scan('INBOX', 1, 'abc', 100, True, now=1000)
+        checkpoint.record_scan('INBOX', 1, 'abc', 0, False, now=2000)
+        self.assertEqual(
+            101,
+            checkpoint.get_min_uid('INBOX', 1, 'abc', DAY, now=3000)
+        )
+
+    def test_corrupt_file_is_ignored(self):
+        checkpoint = self.get_checkpoint()
+        with open(checkpoint.path, 'w') as f:
+            f.write('{not json')
+        checkpoint = ScanCheckpoint(checkpoint.path)
+        self.assertIsNone(checkpoint.get_min_uid('INBOX', 1, 'abc', DAY))
+
+    def test_retests_survive_save(self):
+        checkpoint = self.get_checkpoint()
+        checkpoint.record_scan('INBOX', 1, 'abc', 100, True, now=1000)
+        checkpoint.set_retests('INBOX', [(5, 2000.5), (7, 3000.0)])
+        checkpoint.save()
+
+        checkpoint = ScanCheckpoint(checkpoint.path)
+        self.assertEqual(
+            [(5, 2000.5), (7, 3000.0)], checkpoint.get_retests('INBOX'))
+
+    def test_full_scan_drops_retests(self):
+        checkpoint = self.get_checkpoint()
+        checkpoint.record_scan('INBOX', 1, 'abc', 100, True, now=1000)
+        checkpoint.set_retests('INBOX', [(5, 2000.5)])
+        checkpoint.record_scan('INBOX', 1, 'abc', 100, True, now=1000)
+        self.assertEqual([], checkpoint.get_retests('INBOX'))
+
+    def test_highest_modseq_survives_save(self):
+        checkpoint = self.get_checkpoint()
+        self.assertIsNone(checkpoint.get_highest_modseq('INBOX'))
+        checkpoint.record_scan(
+            'INBOX', 1, 'abc', 100, True, now=1000, highest_modseq=917)
+        checkpoint.save()
+
+        checkpoint = ScanCheckpoint(checkpoint.path)
+        self.assertEqual(917, checkpoint.get_highest_modseq('INBOX'))
+
+
+class ScanJournalTests(TestCase):
+
+    def get_journal(self):
+        directory = self.useFixture(fixtures.TempDir()).path
+        return ScanJournal(os.path.join(directory, 'journal.json'))
+
+    def test_nothing_to_resume(self):
+        journal = self.get_journal()
+        self.assertIsNone(journal.get_tested_uids('INBOX', 1, 'abc'))
+
+    def test_progress_survives_save(self):
+        journal = self.get_journal()
+        journal.record_progress(
+            'INBOX', 1, 'abc', {1, 2, 3, 5, 7, 8}, {3}, [(9, 2000.0)],
+            now=1000)
+        journal.save()
+
+        journal = ScanJournal(journal.path)
+        self.assertEqual(
+            {1, 2, 5, 7, 8},
+            journal.get_tested_uids('INBOX', 1, 'abc', now=1000)
+        )
+        self.assertEqual([(9, 2000.0)], journal.get_retests('INBOX'))
+
+    def test_tested_uids_are_stored_as_ranges(self):
+        journal = self.get_journal()
+        journal.record_progress(
+            'INBOX', 1, 'abc', set(range(1, 1001)), set(), [])
+        journal.save()
+        with open(journal.path) as journal_file:
+            self.assertLess(len(journal_file.read()), 200)
+
+    def test_changes_prevent_resuming(self):
+        journal = self.get_journal()
+        journal.record_progress('INBOX', 1, 'abc', {1}, set(), [], now=1000)
+        self.assertIsNone(journal.get_tested_uids('INBOX', 2, 'abc', now=1000))
+        self.assertIsNone(journal.get_tested_uids('INBOX', 1, 'def', now=1000))
+        self.assertIsNone(
+            journal.get_tested_uids('INBOX', 1, 'abc', now=DAY * 2))
+
+    def test_later_progress_keeps_start_time(self):
+        journal = self.get_journal()
+        journal.record_progress('INBOX', 1, 'abc', {1}, set(), [], now=1000)
+        journal.record_progress(
+            'INBOX', 1, 'abc', {1, 2}, set(), [], now=DAY)
+        self.assertIsNone(
+            journal.get_tested_uids('INBOX', 1, 'abc', now=DAY + 1001))
+
+    def test_finish(self):
+        journal = self.get_journal()
+        journal.record_progress('INBOX', 1, 'abc', {1}, set(), [])
+        journal.finish('INBOX')
+        self.assertIsNone(journal.get_tested_uids('INBOX', 1, 'abc'))
+
+
+class PartUsageTests(TestCase):
+
+    def test_declared_parts_are_not_counted(self):
+        usage = PartUsage({'UID', 'FLAGS'})
+        usage.record(1, b'FLAGS')
+        usage.record(1, b'RFC822.SIZE')
+        self.assertEqual({'RFC822.SIZE': 1}, usage.counts)
+
+    def test_each_message_counts_once(self):
+        usage = PartUsage({'UID'})
+        usage.record(1, 'BODY.PEEK[HEADER]')
+        usage.record(1, 'BODY.PEEK[HEADER]')
+        usage.record(2, 'BODY.PEEK[HEADER]')
+        self.assertEqual({'BODY.PEEK[HEADER]': 2}, usage.counts)
+
+
+class FetchProfileTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.rules = RuleSet([(test.IsFlagged(), [])], source_hash='abc')
+
+    def get_profile(self):
+        directory = self.useFixture(fixtures.TempDir()).path
+        return FetchProfile(os.path.join(directory, 'profile.json'))
+
+    def record(self, profile, counts, messages=10, rules_hash='abc',
+               now=1000):
+        usage = PartUsage(self.rules.fetch_parts)
+        for part, count in counts.items():
+            for uid in range(count):
+                usage.record(uid, part)
+        profile.record_scan('INBOX', rules_hash, usage, messages, now=now)
+
+    def test_no_profile(self):
+        profile = self.get_profile()
+        self.assertEqual(
+            self.rules.fetch_parts,
+            profile.get_fetch_parts(self.rules, 'INBOX', now=1000)
+        )
+
+    def test_parts_read_are_fetched_next_time(self):
+        profile = self.get_profile()
+        self.record(profile, {'RFC822.SIZE': 5})
+        self.assertEqual(
+            self.rules.fetch_parts | {'RFC822.SIZE'},
+            profile.get_fetch_parts(self.rules, 'INBOX', now=2000)
+        )
+        self.assertEqual(
+            self.rules.fetch_parts,
+            profile.get_fetch_parts(self.rules, 'Archive', now=2000)
+        )
+
+    def test_rarely_read_parts_are_not_fetched(self):
+        profile = self.get_profile()
+        self.record(profile, {'RFC822.SIZE': 1}, messages=100)
+        self.assertEqual(
+            self.rules.fetch_parts,
+            profile.get_fetch_parts(self.rules, 'INBOX', now=2000)
+        )
+
+    def test_profile_survives_save(self):
+        profile = self.get_profile()
+        self.record(profile, {'RFC822.SIZE': 5})
+        profile.save()
+
+        profile = FetchProfile(profile.path)
+        self.assertIn(
+            'RFC822.SIZE',
+            profile.get_fetch_parts(self.rules, 'INBOX', now=2000)
+        )
+
+    def test_rules_change_discards_profile(self):
+        profile = self.get_profile()
+        self.record(profile, {'RFC822.SIZE': 5})
+        rules = RuleSet(self.rules, source_hash='def')
+        self.assertEqual(
+            rules.fetch_parts,
+            profile.get_fetch_parts(rules, 'INBOX', now=2000)
+        )
+
+        self.record(profile, {'BODY.PEEK[HEADER]': 5}, rules_hash='def')
+        # The full header replaces the subject field:
+        self.assertEqual(
+            {'BODY.PEEK[HEADER]', 'FLAGS', 'UID'},
+            profile.get_fetch_parts(rules, 'INBOX', now=2000)
+        )
+
+    def test_parts_no_longer_read_decay(self):
+        profile = self.get_profile()
+        self.record(profile, {'RFC822.SIZE': 4})
+        # Scans that don't read the part keep its share, decayed:
+        self.record(profile, {}, now=1000 + HALF_LIFE)
+        self.assertIn(
+            'RFC822.SIZE',
+            profile.get_fetch_parts(self.rules, 'INBOX', now=1000 + HALF_LIFE)
+        )
+        self.assertNotIn(
+            'RFC822.SIZE',
+            profile.get_fetch_parts(
+                self.rules, 'INBOX', now=1000 + 3 * HALF_LIFE)
+        )
+
+    def test_full_header_replaces_header_fields(self):
+        profile = self.get_profile()
+        rules = RuleSet(
+            [(test.SubjectContains('a'), [])], source_hash='abc')
+        self.record(profile, {'BODY.PEEK[HEADER]': 5})
+        self.assertEqual(
+            {'UID', 'BODY.PEEK[HEADER]'},
+            profile.get_fetch_parts(rules, 'INBOX', now=2000)
+        )
+
+    def test_rules_without_hash_are_not_profiled(self):
+        profile = self.get_profile()
+        self.record(profile, {'RFC822.SIZE': 5}, rules_hash=None)
+        rules = RuleSet(self.rules)
+        self.assertEqual(
+            rules.fetch_parts,
+            profile.get_fetch_parts(rules, 'INBOX', now=2000)
+        )
@@ -0,0 +1,71 @@
+from datetime import (
+    datetime,
+    timezone,
+)
+
+from testtools import TestCase
+
+from gmailfilter._chunk import MessageChunk
+
+
+utc = timezone.utc
+
+
+RESPONSES = [
+    {
+        b'UID': 10,
+        b'FLAGS': (b'\\Seen',),
+        b'INTERNALDATE': datetime(2015, 1, 2, 3, 4, 5, 6),
+        b'BODY[HEADER]': b'Subject: One\r\n\r\n',
+    },
+    {
+        b'UID': 11,
+        b'FLAGS': (),
+        b'INTERNALDATE': datetime(1969, 12, 31, 23, 59),
+        b'BODY[HEADER]': b'',
+        b'MODSEQ': (5,),
+    },
+    {
+        b'UID': 12,
+        b'FLAGS': (b'\\Seen',),
+        b'INTERNALDATE': datetime(2020, 2, 29),
+        b'BODY[HEADER]': b'Subject: Three\r\n\r\n',
+    },
+]
+
+
+class MessageChunkTests(TestCase):
+
+    def test_records_have_the_same_parts(self):
+        records = list(MessageChunk(RESPONSES))
+        self.assertEqual(3, len(records))
+        for parts, record in zip(RESPONSES, records):
+            self.assertEqual(sorted(parts), sorted(record.keys()))
+            for key, value in parts.items():
+                self.assertIn(key, record)
+                self.assertEqual(value, record[key])
+
+    def test_missing_part(self):
+        record = list(MessageChunk(RESPONSES))[0]
+        self.assertNotIn(b'MODSEQ', record)
+        self.assertRaises(KeyError, record.__getitem__, b'MODSEQ')
+        self.assertEqual(None, record.get(b'MODSEQ'))
+
+    def test_update(self):
+        record = list(MessageChunk(RESPONSES))[1]
+        record.update({b'RFC822.SIZE': 100, b'FLAGS': (b'\\Flagged',)})
+        self.assertEqual(100, record[b'RFC822.SIZE'])
+        self.assertEqual((b'\\Flagged',), record[b'FLAGS'])
+        self.assertEqual((5,), record[b'MODSEQ'])
+
+    def test_values_that_dont_fit_in_arrays(self):
+        responses = [
+            {b'UID': 2 ** 64, b'DATE': datetime(2015, 1, 1, tzinfo=utc)},
+            {b'UID': 1, b'DATE': datetime(2015, 1, 2, tzinfo=utc)},
+        ]
+        records = list(MessageChunk(responses))
+        self.assertEqual(2 ** 64, records[0][b'UID'])
+        self.assertEqual(responses[1][b'DATE'], records[1][b'DATE'])
+
+    def test_empty_chunk(self):
+        self.assertEqual([], list(MessageChunk([])))
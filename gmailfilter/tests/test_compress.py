@@ -0,0 +1,72 @@
+import socket
+import types
+import zlib
+
+from testtools import TestCase
+
+from gmailfilter._compress import (
+    DeflateStream,
+    enable_compression,
+)
+
+
+class DeflateStreamTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client_sock, self.server_sock = socket.socketpair()
+        self.addCleanup(self.client_sock.close)
+        self.addCleanup(self.server_sock.close)
+        self.imap = types.SimpleNamespace(
+            file=self.client_sock.makefile('rb'), sock=self.client_sock)
+        self.stream = DeflateStream(self.imap)
+        self.compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def server_send(self, data):
+        compressed = (self.compressor.compress(data)
+                      + self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.server_sock.sendall(compressed)
+        return len(compressed)
+
+    def test_takes_over_imaplib_io(self):
+        self.assertIs(self.stream, self.imap.file)
+        self.assertEqual(self.stream.send, self.imap.send)
+
+    def test_reads_lines_and_literals(self):
+        header = b'Subject: hello\r\n\r\n'
+        data = (
+            b'* 1 FETCH (BODY[HEADER] {%d}\r\n%s)\r\n' % (len(header), header)
+            + b'a1 OK done\r\n'
+        )
+        wire = self.server_send(data)
+
+        self.assertEqual(
+            b'* 1 FETCH (BODY[HEADER] {18}\r\n', self.imap.file.readline())
+        self.assertEqual(header, self.imap.file.read(len(header)))
+        self.assertEqual(b')\r\n', self.imap.file.readline())
+        self.assertEqual(b'a1 OK done\r\n', self.imap.file.readline())
+        self.assertEqual(wire, self.stream.wire_bytes_received)
+        self.assertEqual(len(data), self.stream.data_bytes_received)
+
+    def test_readline_limit(self):
+        self.server_send(b'abcdef\r\n')
+        self.assertEqual(b'abc', self.imap.file.readline(3))
+        self.assertEqual(b'def\r\n', self.imap.file.readline())
+
+    def test_send_compresses(self):
+        self.imap.send(b'a1 NOOP\r\n')
+
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        data = decompressor.decompress(self.server_sock.recv(1024))
+        self.assertEqual(b'a1 NOOP\r\n', data)
+        self.assertEqual(9, self.stream.data_bytes_sent)
+
+
+class EnableCompressionTests(TestCase):
+
+    def test_refused(self):
+        imap = types.SimpleNamespace(
+            _simple_command=lambda *args: ('NO', [b'not now']))
+        client = types.SimpleNamespace(_imap=imap)
+        self.assertIsNone(enable_compression(client))
@@ -3,7 +3,11 @@ import os.path
 from testtools import TestCase
 import fixtures
 
-from gmailfilter._config import default_credentials_file_location
+from gmailfilter._config import (
+    ScanOptions,
+    ServerInfo,
+    default_credentials_file_location,
+)
 
 
 class ConfigTests(TestCase):
@@ -27,3 +31,85 @@ class ConfigTests(TestCase):
 
         expected = os.path.join(fake_home, 'credentials.ini')
         self.assertEqual(expected, path)
+
+
+class ServerInfoTests(TestCase):
+
+    def write_config(self, text):
+        directory = self.useFixture(fixtures.TempDir()).path
+        path = os.path.join(directory, 'credentials.ini')
+        with open(path, 'w') as config_file:
+            config_file.write(
+                '[server]\nhost = example.com\nusername = u\npassword = p\n'
+                + text
+            )
+        os.chmod(path, 0o600)
+        return path
+
+    def test_compresses_by_default(self):
+        server_info = ServerInfo.read_config_file(self.write_config(''))
+        self.assertTrue(server_info.compress)
+
+    def test_compression_can_be_disabled(self):
+        server_info = ServerInfo.read_config_file(
+            self.write_config('compress = no\n'))
+        self.assertFalse(server_info.compress)
+
+    def test_invalid_compress_raises_runtime_error(self):
+        path = self.write_config('compress = maybe\n')
+        self.assertRaises(RuntimeError, ServerInfo.read_config_file, path)
+
+    def test_ssl_can_be_disabled(self):
+        server_info = ServerInfo.read_config_file(
+            self.write_config('use_ssl = False\n'))
+        self.assertIs(False, server_info.use_ssl)
+
+    def test_invalid_use_ssl_raises_runtime_error(self):
+        path = self.write_config('use_ssl = maybe\n')
+        self.assertRaises(RuntimeError, ServerInfo.read_config_file, path)
+
+
+class ScanOptionsTests(TestCase):
+
+    def write_config(self, text):
+        directory = self.useFixture(fixtures.TempDir()).path
+        path = os.path.join(directory, 'credentials.ini')
+        with open(path, 'w') as config_file:
+            config_file.write(text)
+        return path
+
+    def test_defaults_without_scan_section(self):
+        path = self.write_config('[server]\nhost = example.com\n')
+        options = ScanOptions.read_config_file(path)
+        self.assertEqual(100, options.initial_chunk_size)
+        self.assertEqual(1000, options.max_chunk_size)
+        self.assertEqual(1, options.connections)
+
+    def test_reads_scan_section(self):
+        path = self.write_config(
+            '[scan]\n'
+            'initial_chunk_size = 50\n'
+            'min_chunk_size = 5\n'
+            'max_chunk_size = 500\n'
+            'target_chunk_seconds = 0.5\n'
+            'max_chunk_megabytes = 1.5\n'
+            'connections = 4\n'
+        )
+        options = ScanOptions.read_config_file(path)
+        self.assertEqual(50, options.initial_chunk_size)
+        self.assertEqual(5, options.min_chunk_size)
+        self.assertEqual(500, options.max_chunk_size)
+        self.assertEqual(0.5, options.target_chunk_seconds)
+        self.assertEqual(1536 * 1024, options.max_chunk_bytes)
+        self.assertEqual(4, options.connections)
+
+    def test_invalid_value_raises_runtime_error(self):
+        path = self.write_config('[scan]\nmax_chunk_size = lots\n')
+        self.assertRaises(
+            RuntimeError, ScanOptions.read_config_file, path)
+
+    def test_inconsistent_bounds_raise_runtime_error(self):
+        path = self.write_config(
+            '[scan]\nmin_chunk_size = 10\nmax_chunk_size = 5\n')
+        self.assertRaises(
+            RuntimeError, ScanOptions.read_config_file, path)
@@ -1,6 +1,14 @@
+from contextlib import contextmanager
+import datetime
+import itertools
+import time
+
 from testtools import TestCase
 
 from gmailfilter import _connection as c
+from gmailfilter._cache import MessageCache
+from gmailfilter._config import ScanOptions
+from gmailfilter._message import DEFAULT_FETCH_PARTS
 
 
 class SequenceChunkTests(TestCase):
@@ -29,3 +37,723 @@ class SequenceChunkTests(TestCase):
 
     def test_with_no_chunking(self):
         self.assertSequenceChunk(5, 1, ['1', '2', '3', '4', '5'])
+
+    def test_reads_size_from_sizer_for_each_chunk(self):
+        sizer = c.ChunkSizer(
+            ScanOptions(initial_chunk_size=2, min_chunk_size=1))
+        chunks = c.sequence_chunk(10, sizer)
+        self.assertEqual('1:2', next(chunks))
+        sizer.size = 5
+        self.assertEqual(['3:7', '8:*'], list(chunks))
+
+
+class ChunkSizerTests(TestCase):
+
+    def get_sizer(self, **kwargs):
+        kwargs.setdefault('initial_chunk_size', 100)
+        kwargs.setdefault('target_chunk_seconds', 2.0)
+        return c.ChunkSizer(ScanOptions(**kwargs))
+
+    def test_starts_at_initial_size(self):
+        self.assertEqual(100, self.get_sizer().size)
+
+    def test_grows_when_fetches_are_fast(self):
+        sizer = self.get_sizer()
+        sizer.record(100, 1000, 1.0)
+        self.assertEqual(200, sizer.size)
+
+    def test_shrinks_when_fetches_are_slow(self):
+        sizer = self.get_sizer()
+        sizer.record(100, 1000, 2.5)
+        self.assertEqual(80, sizer.size)
+
+    def test_changes_by_at_most_a_factor_of_two(self):
+        sizer = self.get_sizer()
+        sizer.record(100, 1000, 100.0)
+        self.assertEqual(50, sizer.size)
+
+    def test_keeps_chunks_under_memory_ceiling(self):
+        sizer = self.get_sizer(max_chunk_bytes=100 * 1024)
+        sizer.record(100, 160 * 1024, 0.1)
+        self.assertEqual(62, sizer.size)
+
+    def test_stays_within_bounds(self):
+        sizer = self.get_sizer(min_chunk_size=90, max_chunk_size=150)
+        sizer.record(100, 1000, 0.1)
+        self.assertEqual(150, sizer.size)
+        sizer.record(150, 1000, 100.0)
+        self.assertEqual(90, sizer.size)
+
+    def test_ignores_empty_chunks(self):
+        sizer = self.get_sizer()
+        sizer.record(0, 0, 1.0)
+        self.assertEqual(100, sizer.size)
+
+    def test_response_size(self):
+        data = {
+            1: {b'UID': 1, b'FLAGS': (b'\\Seen',), b'BODY[HEADER]': b'abc'},
+        }
+        self.assertEqual(8, c.response_size(data))
+
+
+class SequenceSetIdsTests(TestCase):
+
+    def test_single_message(self):
+        self.assertEqual([4], c.sequence_set_ids('4', 10))
+
+    def test_range(self):
+        self.assertEqual([3, 4, 5], c.sequence_set_ids('3:5', 10))
+
+    def test_star_is_largest(self):
+        self.assertEqual([8, 9, 10], c.sequence_set_ids('8:*', 10))
+
+
+class FakeIMAPClient(object):
+
+    """A stand-in for IMAPClient that serves messages from memory."""
+
+    def __init__(self, messages):
+        self.use_uid = False
+        self.messages = messages
+        self.fetch_calls = []
+        self.search_calls = []
+        self.selected = []
+
+    def select_folder(self, folder, readonly=False):
+        self.selected.append(folder)
+        return {b'EXISTS': len(self.messages), b'UIDVALIDITY': 1}
+
+    def search(self, criteria):
+        """Search for messages.
+
+        Supports 'UID n:*', followed by 'SEEN' which matches even UIDs.
+
+        """
+        self.search_calls.append(criteria)
+        uids = self.messages
+        if criteria[0] == 'UID':
+            start = int(criteria[1].split(':')[0])
+            # Like a real server, 'n:*' includes the highest UID:
+            uids = [
+                uid for uid in uids
+                if uid >= start or uid == self.messages[-1]
+            ]
+            criteria = criteria[2:]
+        if criteria == ['SEEN']:
+            uids = [uid for uid in uids if uid % 2 == 0]
+        return uids
+
+    def fetch(self, messages, data):
+        self.fetch_calls.append((messages, data))
+        if isinstance(data, (str, bytes)):
+            data = [data]
+        if not self.use_uid:
+            return {
+                seq: {**self._get_parts(uid, data), b'SEQ': seq}
+                for seq, uid in enumerate(self.messages, 1)
+            }
+        if isinstance(messages, int):
+            messages = [messages]
+        response = {}
+        for uid in self.messages:
+            if uid in messages:
+                # Like IMAPClient, UIDs are only used as keys in UID mode:
+                parts = self._get_parts(uid, data)
+                del parts[b'UID']
+                response[uid] = parts
+        return response
+
+    def _get_parts(self, uid, data):
+        parts = {b'UID': uid}
+        for part in data:
+            if isinstance(part, bytes):
+                part = part.decode('ascii')
+            if part == 'FLAGS':
+                parts[b'FLAGS'] = (b'\\Seen',)
+            elif part == 'INTERNALDATE':
+                parts[b'INTERNALDATE'] = datetime.datetime(2015, 1, 1)
+            elif part == 'BODY.PEEK[HEADER]':
+                parts[b'BODY[HEADER]'] = b'Subject: %d\r\n\r\n' % uid
+        return parts
+
+
+class FakeIdleIMAPClient(FakeIMAPClient):
+
+    """A FakeIMAPClient that delivers new messages while idling.
+
+    'arrivals' is a list of lists of UIDs. Each call to idle_check delivers
+    the next list of messages, or times out if the list is empty.
+
+    """
+
+    def __init__(self, messages, arrivals, capabilities=(b'IDLE',)):
+        super().__init__(messages)
+        self.arrivals = arrivals
+        self.capabilities = capabilities
+        self.calls = []
+
+    def has_capability(self, capability):
+        return capability.encode() in self.capabilities
+
+    def idle(self):
+        self.calls.append('idle')
+
+    def idle_check(self, timeout=None):
+        self.calls.append('idle_check')
+        new = self.arrivals.pop(0)
+        self.messages.extend(new)
+        if new:
+            return [(len(self.messages), b'EXISTS')]
+        return []
+
+    def idle_done(self):
+        self.calls.append('idle_done')
+
+    def noop(self):
+        self.calls.append('noop')
+        if not self.has_capability('IDLE'):
+            self.messages.extend(self.arrivals.pop(0))
+
+
+def get_fake_connection(messages, cache=None):
+    connection = c.IMAPConnection.__new__(c.IMAPConnection)
+    connection._client = FakeIMAPClient(messages)
+    connection._cache = cache
+    connection._prefetch = 0
+    connection._fetch_connections = []
+    connection._scan_options = ScanOptions()
+    connection._stream = None
+    connection._part_usage = None
+    return connection
+
+
+class GetMessagesTests(TestCase):
+
+    def test_fetches_default_parts_when_unspecified(self):
+        connection = get_fake_connection([101, 102])
+        messages = list(connection.get_messages())
+
+        self.assertEqual([101, 102], [m.uid() for m in messages])
+        [(_, parts)] = connection._client.fetch_calls
+        self.assertEqual(sorted(DEFAULT_FETCH_PARTS), parts)
+
+    def test_fetches_only_requested_parts_plus_uid(self):
+        connection = get_fake_connection([101])
+        list(connection.get_messages(['FLAGS']))
+
+        [(_, parts)] = connection._client.fetch_calls
+        self.assertEqual(['FLAGS', 'UID'], parts)
+
+    def test_min_uid_fetches_newer_messages_by_uid(self):
+        connection = get_fake_connection([101, 102, 103])
+        messages = list(connection.get_messages(['FLAGS'], min_uid=102))
+
+        self.assertEqual([102, 103], [m.uid() for m in messages])
+        self.assertEqual([['UID', '102:*']], connection._client.search_calls)
+        self.assertEqual(
+            [([102, 103], ['FLAGS', 'UID'])], connection._client.fetch_calls)
+
+    def test_search_fetches_matching_messages(self):
+        connection = get_fake_connection([101, 102, 103, 104])
+        messages = list(connection.get_messages(['FLAGS'], search=['SEEN']))
+
+        self.assertEqual([102, 104], [m.uid() for m in messages])
+        self.assertEqual([['SEEN']], connection._client.search_calls)
+
+    def test_search_with_min_uid(self):
+        connection = get_fake_connection([101, 102, 103, 104])
+        messages = list(
+            connection.get_messages(['FLAGS'], min_uid=103, search=['SEEN']))
+
+        self.assertEqual([104], [m.uid() for m in messages])
+        self.assertEqual(
+            [['UID', '103:*', 'SEEN']], connection._client.search_calls)
+
+    def test_chunk_size_adapts_to_throughput(self):
+        connection = get_fake_connection(list(range(101, 111)))
+        connection._scan_options = ScanOptions(
+            initial_chunk_size=2, min_chunk_size=1)
+        # Every fetch takes a second, twice the target time:
+        clock = itertools.count()
+        self.patch(c.time, 'monotonic', lambda: next(clock))
+        connection._scan_options.target_chunk_seconds = 0.5
+        list(connection.get_messages(['FLAGS'], min_uid=101))
+
+        self.assertEqual(
+            [[101, 102], [103], [104], [105]],
+            [uids for uids, _ in connection._client.fetch_calls[:4]]
+        )
+
+    def test_selects_requested_folder(self):
+        cache = MessageCache(':memory:')
+        connection = get_fake_connection([101], cache)
+        list(connection.get_messages(['FLAGS'], folder='Spam'))
+
+        self.assertEqual(['Spam'], connection._client.selected)
+        self.assertEqual('Spam', cache._folder)
+
+    def test_exclude_uids_scans_by_uid(self):
+        connection = get_fake_connection([101, 102, 103, 104])
+        messages = list(
+            connection.get_messages(['FLAGS'], exclude_uids={101, 103}))
+
+        self.assertEqual([102, 104], [m.uid() for m in messages])
+        self.assertEqual([['ALL']], connection._client.search_calls)
+        self.assertEqual(
+            [([102, 104], ['FLAGS', 'UID'])], connection._client.fetch_calls)
+
+    def test_exclude_uids_with_min_uid(self):
+        connection = get_fake_connection([101, 102, 103, 104])
+        messages = list(connection.get_messages(
+            ['FLAGS'], min_uid=102, exclude_uids={103}))
+
+        self.assertEqual([102, 104], [m.uid() for m in messages])
+
+    def test_min_uid_ignores_lower_highest_uid(self):
+        connection = get_fake_connection([101, 102])
+        self.assertEqual([], list(connection.get_messages(min_uid=200)))
+
+
+class PrefetchTests(TestCase):
+
+    def get_prefetching_connection(self, messages):
+        connection = get_fake_connection(messages)
+        connection._prefetch = 2
+        connection._fetch_connections = [get_fake_connection(messages)]
+        return connection
+
+    def test_full_scan_fetches_on_fetch_connection(self):
+        connection = self.get_prefetching_connection([101, 102])
+        messages = list(connection.get_messages(['FLAGS']))
+
+        self.assertEqual([101, 102], [m.uid() for m in messages])
+        self.assertEqual([], connection._client.fetch_calls)
+        fetcher = connection._fetch_connections[0]._client
+        self.assertEqual([([1, 2], ['FLAGS', 'UID'])], fetcher.fetch_calls)
+
+    def test_incremental_scan_fetches_by_uid(self):
+        connection = self.get_prefetching_connection([101, 102, 103])
+        messages = list(connection.get_messages(['FLAGS'], min_uid=102))
+
+        self.assertEqual([102, 103], [m.uid() for m in messages])
+        self.assertEqual([['UID', '102:*']], connection._client.search_calls)
+        fetcher = connection._fetch_connections[0]._client
+        self.assertEqual([([102, 103], ['FLAGS', 'UID'])], fetcher.fetch_calls)
+        self.assertTrue(fetcher.use_uid)
+
+
+class ParallelScanTests(TestCase):
+
+    def get_parallel_connection(self, messages, connections, cache=None):
+        connection = get_fake_connection(messages, cache)
+        connection._scan_options = ScanOptions(connections=connections)
+        connection._fetch_connections = [
+            get_fake_connection(messages) for i in range(connections)
+        ]
+        return connection
+
+    def get_fetched_uids(self, connection):
+        return [
+            [uid for uids, _ in f._client.fetch_calls for uid in uids]
+            for f in connection._fetch_connections
+        ]
+
+    def test_full_scan_splits_uids_between_connections(self):
+        connection = self.get_parallel_connection(
+            list(range(101, 108)), 3)
+        messages = list(connection.get_messages(['FLAGS']))
+
+        self.assertEqual(
+            list(range(101, 108)), sorted(m.uid() for m in messages))
+        self.assertEqual([['ALL']], connection._client.search_calls)
+        self.assertEqual([], connection._client.fetch_calls)
+        self.assertEqual(
+            [[101, 102], [103, 104], [105, 106, 107]],
+            self.get_fetched_uids(connection)
+        )
+
+    def test_full_scan_evicts_deleted_messages_from_cache(self):
+        cache = MessageCache(':memory:')
+        cache.select_folder("INBOX", 1)
+        cache.store(100, {b'INTERNALDATE': datetime.datetime(2020, 1, 1)})
+        connection = self.get_parallel_connection([101, 102], 2, cache)
+        list(connection.get_messages(['FLAGS']))
+
+        self.assertEqual({}, cache.get_parts([100]))
+
+    def test_search_fetches_in_parallel(self):
+        connection = self.get_parallel_connection([101, 102, 103, 104], 2)
+        messages = list(connection.get_messages(['FLAGS'], search=['SEEN']))
+
+        self.assertEqual([102, 104], sorted(m.uid() for m in messages))
+        self.assertEqual([[102], [104]], self.get_fetched_uids(connection))
+
+    def test_fewer_messages_than_connections(self):
+        connection = self.get_parallel_connection([101], 3)
+        messages = list(connection.get_messages(['FLAGS']))
+
+        self.assertEqual([101], [m.uid() for m in messages])
+        self.assertEqual([[101], [], []], self.get_fetched_uids(connection))
+
+    def test_retests_use_main_connection(self):
+        connection = self.get_parallel_connection([101, 102], 2)
+        messages = list(connection.get_messages_by_uid(['FLAGS'], [102]))
+
+        self.assertEqual([102], [m.uid() for m in messages])
+        self.assertEqual(
+            [([102], ['FLAGS', 'UID'])], connection._client.fetch_calls)
+
+
+class WatchMessagesTests(TestCase):
+
+    def get_watched_uids(self, client, count, min_uid=1):
+        connection = get_fake_connection([])
+        connection._client = client
+        self.patch(c.time, 'sleep', lambda t: None)
+        return [
+            m.uid() for m in itertools.islice(
+                connection.watch_messages(['FLAGS'], min_uid, 0.01),
+                count
+            )
+        ]
+
+    def test_yields_messages_after_min_uid_first(self):
+        client = FakeIdleIMAPClient([1, 2, 3], [])
+        self.assertEqual([2, 3], self.get_watched_uids(client, 2, 2))
+
+    def test_yields_messages_announced_while_idle(self):
+        client = FakeIdleIMAPClient([1], [[2], [3, 4]])
+        self.assertEqual([1, 2, 3, 4], self.get_watched_uids(client, 4))
+        self.assertEqual(
+            ['idle', 'idle_check', 'idle_done'] * 2, client.calls)
+
+    def test_refreshes_idle_when_nothing_arrives(self):
+        client = FakeIdleIMAPClient([], [[], [2]])
+
+        real_sleep = time.sleep
+
+        def slow_idle_check(timeout=None):
+            real_sleep(timeout)
+            return FakeIdleIMAPClient.idle_check(client, timeout)
+        client.idle_check = slow_idle_check
+
+        self.assertEqual([2], self.get_watched_uids(client, 1))
+        self.assertEqual(
+            [
+                'idle', 'idle_check', 'idle_done', 'noop',
+                'idle', 'idle_check', 'idle_done',
+            ],
+            client.calls
+        )
+
+    def test_polls_with_noop_without_idle(self):
+        client = FakeIdleIMAPClient([1], [[2]], capabilities=())
+        self.assertEqual([1, 2], self.get_watched_uids(client, 2))
+        self.assertEqual(['noop'], client.calls)
+
+
+class FakeCondstoreIMAPClient(FakeIMAPClient):
+
+    """A FakeIMAPClient for a server with CONDSTORE.
+
+    'changed' maps UIDs to the mod-sequence they were last changed in.
+
+    """
+
+    def __init__(self, messages, changed, highest_modseq):
+        super().__init__(messages)
+        self.changed = changed
+        self.highest_modseq = highest_modseq
+
+    def has_capability(self, capability):
+        return capability == 'CONDSTORE'
+
+    def folder_status(self, folder, items):
+        status = {b'UIDVALIDITY': 1, b'UIDNEXT': self.messages[-1] + 1}
+        if 'HIGHESTMODSEQ' in items:
+            status[b'HIGHESTMODSEQ'] = self.highest_modseq
+        return status
+
+    def search(self, criteria):
+        if 'MODSEQ' not in criteria:
+            return super().search(criteria)
+        self.search_calls.append(criteria)
+        max_uid = int(criteria[1].split(':')[1])
+        return [
+            uid for uid, modseq in sorted(self.changed.items())
+            if uid <= max_uid and modseq >= criteria[3]
+        ]
+
+
+class CondstoreTests(TestCase):
+
+    def get_connection(self, client):
+        connection = get_fake_connection([])
+        connection._client = client
+        return connection
+
+    def test_folder_status_includes_highest_modseq(self):
+        connection = self.get_connection(
+            FakeCondstoreIMAPClient([1, 2], {}, 917))
+        status = connection.get_folder_status('INBOX')
+        self.assertEqual(917, status[b'HIGHESTMODSEQ'])
+
+    def test_folder_status_without_condstore(self):
+        connection = get_fake_connection([1, 2])
+        connection._client.has_capability = lambda capability: False
+        connection._client.folder_status = lambda folder, items: items
+        self.assertEqual(
+            ['UIDVALIDITY', 'UIDNEXT'], connection.get_folder_status('INBOX'))
+
+    def test_get_changed_uids(self):
+        client = FakeCondstoreIMAPClient([1, 2, 3, 4], {2: 900, 3: 950}, 950)
+        connection = self.get_connection(client)
+
+        self.assertEqual([3], connection.get_changed_uids(917, 4))
+        self.assertEqual([['UID', '1:4', 'MODSEQ', 918]], client.search_calls)
+        self.assertFalse(client.use_uid)
+
+    def test_no_changed_uids_without_old_messages(self):
+        client = FakeCondstoreIMAPClient([], {}, 950)
+        self.assertEqual(
+            [], self.get_connection(client).get_changed_uids(917, 0))
+        self.assertEqual([], client.search_calls)
+
+
+class UIDChunkTests(TestCase):
+
+    def test_no_uids(self):
+        self.assertEqual([], list(c.uid_chunk([], 10)))
+
+    def test_chunks(self):
+        self.assertEqual(
+            [[1, 5], [7, 9], [10]],
+            list(c.uid_chunk([1, 5, 7, 9, 10], 2))
+        )
+
+    def test_chunks_from_sizer(self):
+        sizer = c.ChunkSizer(
+            ScanOptions(initial_chunk_size=3, min_chunk_size=1))
+        self.assertEqual(
+            [[1, 5, 7], [9, 10]],
+            list(c.uid_chunk([1, 5, 7, 9, 10], sizer))
+        )
+
+    def test_chunk_description(self):
+        self.assertEqual('1:*', c.chunk_description('1:*'))
+        self.assertEqual('UID 5', c.chunk_description([5]))
+        self.assertEqual('UIDs 5-9', c.chunk_description([5, 7, 9]))
+
+
+class CachedGetMessagesTests(TestCase):
+
+    def test_uncached_messages_are_fetched_and_stored(self):
+        cache = MessageCache(':memory:')
+        connection = get_fake_connection([101, 102], cache)
+        messages = list(connection.get_messages())
+
+        self.assertEqual(['101', '102'], [m.subject() for m in messages])
+        self.assertEqual(
+            [
+                ([1, 2], ['FLAGS', 'UID']),
+                ([101, 102], ['BODY.PEEK[HEADER]', 'INTERNALDATE']),
+            ],
+            connection._client.fetch_calls
+        )
+        self.assertEqual(
+            {
+                b'BODY[HEADER]': b'Subject: 101\r\n\r\n',
+                b'INTERNALDATE': datetime.datetime(2015, 1, 1),
+            },
+            cache.get_parts([101])[101]
+        )
+
+    def test_cached_messages_only_fetch_mutable_parts(self):
+        cache = MessageCache(':memory:')
+        list(get_fake_connection([101, 102], cache).get_messages())
+
+        connection = get_fake_connection([101, 102, 103], cache)
+        messages = list(connection.get_messages())
+
+        self.assertEqual(
+            ['101', '102', '103'], [m.subject() for m in messages])
+        self.assertEqual(
+            [(b'\\Seen',)] * 3, [m.get_flags() for m in messages])
+        self.assertEqual(
+            [
+                ([1, 2, 3], ['FLAGS', 'UID']),
+                ([103], ['BODY.PEEK[HEADER]', 'INTERNALDATE']),
+            ],
+            connection._client.fetch_calls
+        )
+
+    def test_deleted_messages_are_evicted(self):
+        cache = MessageCache(':memory:')
+        list(get_fake_connection([101, 102], cache).get_messages())
+        list(get_fake_connection([102], cache).get_messages())
+
+        self.assertEqual([102], list(cache.get_parts([101, 102])))
+
+    def test_excluded_messages_stay_in_cache(self):
+        cache = MessageCache(':memory:')
+        list(get_fake_connection([101, 102, 103], cache).get_messages())
+        connection = get_fake_connection([101, 102, 103], cache)
+        list(connection.get_messages(exclude_uids={101}))
+
+        self.assertEqual(
+            [101, 102, 103], sorted(cache.get_parts([101, 102, 103])))
+
+
+class FakeProxyConnection(object):
+
+    def __init__(self, responses):
+        self._client = self
+        self._cache = None
+        self._part_usage = None
+        self.responses = responses
+        self.fetch_calls = []
+
+    @contextmanager
+    def use_uid(self):
+        yield
+
+    def fetch(self, messages, data):
+        self.fetch_calls.append((messages, data))
+        return {messages: self.responses}
+
+
+class LazyFetchGroupTests(TestCase):
+
+    def test_fetches_a_part_once_for_the_chunk(self):
+        connection = get_fake_connection([101, 102, 103])
+        messages = list(connection.get_messages(['FLAGS']))
+
+        self.assertEqual(
+            ['101', '102', '103'], [m.subject() for m in messages])
+        self.assertEqual(
+            [([1, 2, 3], [b'BODY.PEEK[HEADER]', 'UID'])],
+            connection._client.fetch_calls[1:]
+        )
+
+    def test_parts_for_another_uid_are_fetched_by_uid(self):
+        connection = get_fake_connection([101, 102, 103])
+        messages = list(connection.get_messages(['FLAGS']))
+        # Message 101 is expunged, so the sequence numbers move down:
+        connection._client.messages.remove(101)
+
+        self.assertEqual(['102', '103'], [m.subject() for m in messages[1:]])
+        self.assertEqual([102, 103], [m.uid() for m in messages[1:]])
+        self.assertEqual(
+            [(102, b'BODY.PEEK[HEADER]'), (103, b'BODY.PEEK[HEADER]')],
+            connection._client.fetch_calls[2:]
+        )
+
+
+class MessageConnectionProxyTests(TestCase):
+
+    def test_header_block_from_header_fields(self):
+        proxy = c.MessageConnectionProxy(
+            FakeProxyConnection({}),
+            {
+                b'UID': 1,
+                b'BODY[HEADER.FIELDS (SUBJECT)]': b'Subject: Hi\r\n\r\n',
+            }
+        )
+        self.assertEqual(
+            (b'Subject: Hi\r\n\r\n', {'subject'}),
+            proxy.get_header_block()
+        )
+
+    def test_header_block_prefers_full_header(self):
+        proxy = c.MessageConnectionProxy(
+            FakeProxyConnection({}),
+            {
+                b'UID': 1,
+                b'BODY[HEADER]': b'Subject: Hi\r\nX: Y\r\n\r\n',
+                b'BODY[HEADER.FIELDS (SUBJECT)]': b'Subject: Hi\r\n\r\n',
+            }
+        )
+        self.assertEqual(
+            (b'Subject: Hi\r\nX: Y\r\n\r\n', None),
+            proxy.get_header_block()
+        )
+
+    def test_header_block_fetched_lazily(self):
+        connection = FakeProxyConnection({b'BODY[HEADER]': b'X: Y\r\n\r\n'})
+        proxy = c.MessageConnectionProxy(connection, {b'UID': 1})
+        self.assertEqual((b'X: Y\r\n\r\n', None), proxy.get_header_block())
+        self.assertEqual(
+            [(1, b'BODY.PEEK[HEADER]')],
+            connection.fetch_calls
+        )
+
+
+class FakeFolderClient(object):
+
+    def __init__(self, folders):
+        self.use_uid = False
+        self.folders = list(folders)
+        self.calls = []
+
+    def list_folders(self):
+        self.calls.append('list_folders')
+        return [((b'\\HasNoChildren',), b'/', name) for name in self.folders]
+
+    def create_folder(self, folder):
+        self.calls.append(('create_folder', folder))
+        self.folders.append(folder)
+        return b'Success'
+
+    def delete_folder(self, folder):
+        self.calls.append(('delete_folder', folder))
+        self.folders.remove(folder)
+
+    def rename_folder(self, old_name, new_name):
+        self.calls.append(('rename_folder', old_name, new_name))
+
+    def copy(self, messages, folder):
+        self.calls.append(('copy', messages, folder, self.use_uid))
+
+
+class ConnectionProxyFolderCacheTests(TestCase):
+
+    def get_proxy(self, folders):
+        client = FakeFolderClient(folders)
+        return client, c.ConnectionProxy(client, c.FolderCache(client))
+
+    def test_folders_are_listed_once(self):
+        client, proxy = self.get_proxy(['INBOX', 'Archive'])
+        self.assertTrue(proxy.folder_exists('Archive'))
+        self.assertFalse(proxy.folder_exists('Other'))
+        self.assertEqual(['list_folders'], client.calls)
+
+    def test_trailing_delimiter_is_ignored(self):
+        client, proxy = self.get_proxy(['INBOX', 'Junk'])
+        self.assertTrue(proxy.folder_exists('Junk/'))
+
+    def test_created_folders_exist(self):
+        client, proxy = self.get_proxy(['INBOX'])
+        self.assertFalse(proxy.folder_exists('New'))
+        proxy.create_folder('New')
+        self.assertTrue(proxy.folder_exists('New'))
+        self.assertEqual(
+            ['list_folders', ('create_folder', 'New')], client.calls)
+
+    def test_deleted_and_renamed_folders(self):
+        client, proxy = self.get_proxy(['INBOX', 'A', 'B'])
+        proxy.folder_exists('A')
+        proxy.delete_folder('A')
+        proxy.rename_folder('B', 'C')
+        self.assertFalse(proxy.folder_exists('A'))
+        self.assertFalse(proxy.folder_exists('B'))
+        self.assertTrue(proxy.folder_exists('C'))
+
+    def test_other_methods_use_uid(self):
+        client, proxy = self.get_proxy([])
+        proxy.copy([1], 'A')
+        self.assertEqual([('copy', [1], 'A', True)], client.calls)
+        self.assertFalse(client.use_uid)
+
+    def test_unlisted_methods_are_hidden(self):
+        client, proxy = self.get_proxy([])
+        self.assertRaises(AttributeError, getattr, proxy, 'logout')
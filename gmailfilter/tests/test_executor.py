@@ -0,0 +1,125 @@
+from testtools import TestCase
+
+from gmailfilter import actions
+from gmailfilter._executor import (
+    ActionExecutor,
+    BatchingActionExecutor,
+)
+from gmailfilter.tests.factory import (
+    FakeMessage,
+    RecordingAction,
+)
+
+
+class RecordingBatchAction(actions.BatchAction):
+
+    def __init__(self, key, log):
+        self.key = key
+        self.log = log
+
+    def get_batch_key(self):
+        return self.key
+
+    def process(self, conn, message):
+        self.log.append((self.key, message.uid()))
+
+    def process_batch(self, conn, uids):
+        self.log.append((self.key, uids))
+
+
+class ActionExecutorTests(TestCase):
+
+    def test_runs_actions_immediately(self):
+        log = []
+        executor = ActionExecutor(None)
+        executor.run(RecordingBatchAction('a', log), FakeMessage(1))
+        self.assertEqual([('a', 1)], log)
+
+
+class BatchingActionExecutorTests(TestCase):
+
+    def test_batches_by_key(self):
+        log = []
+        executor = BatchingActionExecutor(None)
+        a1 = RecordingBatchAction('a', log)
+        a2 = RecordingBatchAction('a', log)
+        b = RecordingBatchAction('b', log)
+        executor.run(a1, FakeMessage(1))
+        executor.run(b, FakeMessage(2))
+        executor.run(a2, FakeMessage(3))
+        self.assertEqual([], log)
+
+        executor.flush()
+        self.assertEqual([('a', [1, 3]), ('b', [2])], log)
+
+    def test_flush_empties_batches(self):
+        log = []
+        executor = BatchingActionExecutor(None)
+        executor.run(RecordingBatchAction('a', log), FakeMessage(1))
+        executor.flush()
+        executor.flush()
+        self.assertEqual([('a', [1])], log)
+
+    def test_non_batch_actions_run_immediately(self):
+        action = RecordingAction()
+        message = FakeMessage(1)
+        executor = BatchingActionExecutor(None)
+        executor.run(action, message)
+        self.assertEqual([message], action.processed)
+
+    def test_batch_action_without_process_batch_runs_immediately(self):
+        class ImmediateBatchAction(RecordingAction, actions.BatchAction):
+            pass
+
+        action = ImmediateBatchAction()
+        message = FakeMessage(1)
+        executor = BatchingActionExecutor(None)
+        executor.run(action, message)
+        self.assertEqual([message], action.processed)
+        executor.flush()
+        self.assertEqual([message], action.processed)
+
+    def test_actions_without_batch_key_are_batched_alone(self):
+        log = []
+        executor = BatchingActionExecutor(None)
+        a = RecordingBatchAction(None, log)
+        b = RecordingBatchAction(None, log)
+        executor.run(a, FakeMessage(1))
+        executor.run(b, FakeMessage(2))
+        executor.run(a, FakeMessage(3))
+        executor.flush()
+        self.assertEqual([(None, [1, 3]), (None, [2])], log)
+
+    def test_pending_uids(self):
+        executor = BatchingActionExecutor(None)
+        executor.run(RecordingBatchAction('a', []), FakeMessage(1))
+        executor.run(RecordingAction(), FakeMessage(2))
+        self.assertEqual({1}, executor.pending_uids)
+
+        executor.flush()
+        self.assertEqual(set(), executor.pending_uids)
+
+    def test_failed_flush_keeps_batches_that_have_not_run(self):
+        class FailingBatchAction(RecordingBatchAction):
+
+            def process_batch(self, conn, uids):
+                raise OSError("Connection reset")
+
+        log = []
+        executor = BatchingActionExecutor(None)
+        executor.run(RecordingBatchAction('a', log), FakeMessage(1))
+        executor.run(FailingBatchAction('b', log), FakeMessage(2))
+        executor.run(RecordingBatchAction('c', log), FakeMessage(3))
+        self.assertRaises(OSError, executor.flush)
+        self.assertEqual([('a', [1])], log)
+        self.assertEqual({2, 3}, executor.pending_uids)
+
+    def test_second_batch_action_for_message_flushes_first(self):
+        log = []
+        executor = BatchingActionExecutor(None)
+        executor.run(RecordingBatchAction('a', log), FakeMessage(1))
+        executor.run(RecordingBatchAction('b', log), FakeMessage(1))
+        self.assertEqual([('a', [1])], log)
+
+        executor.flush()
+        self.assertEqual([('a', [1]), ('b', [1])], log)
@@ -0,0 +1,173 @@
+import os
+import os.path
+from concurrent.futures import ThreadPoolExecutor
+
+from testtools import TestCase
+import fixtures
+
+from gmailfilter import _fleet
+from gmailfilter._fleet import (
+    Account,
+    AccountResult,
+    FleetOptions,
+    FleetScheduler,
+    filter_account,
+    find_accounts,
+    get_account_scan_options,
+    run_fleet,
+)
+
+
+class FleetDirectoryMixin(object):
+
+    def make_fleet(self):
+        return self.useFixture(fixtures.TempDir()).path
+
+    def add_account(self, fleet, name, scan_section=''):
+        directory = os.path.join(fleet, name)
+        os.mkdir(directory)
+        with open(os.path.join(directory, 'credentials.ini'), 'w') as f:
+            f.write(
+                '[server]\nhost = example.com\nusername = u\npassword = p\n'
+                + scan_section
+            )
+        os.chmod(os.path.join(directory, 'credentials.ini'), 0o600)
+        return Account(name, directory)
+
+
+class FindAccountsTests(FleetDirectoryMixin, TestCase):
+
+    def test_finds_directories_with_credentials(self):
+        fleet = self.make_fleet()
+        bob = self.add_account(fleet, 'bob')
+        alice = self.add_account(fleet, 'alice')
+        os.mkdir(os.path.join(fleet, 'not-an-account'))
+        with open(os.path.join(fleet, 'README'), 'w'):
+            pass
+
+        self.assertEqual([alice, bob], find_accounts(fleet))
+
+
+class AccountScanOptionsTests(FleetDirectoryMixin, TestCase):
+
+    def test_one_connection_by_default(self):
+        account = self.add_account(self.make_fleet(), 'a')
+        _, prefetch, connections = get_account_scan_options(
+            account, FleetOptions())
+        self.assertEqual((0, 1), (prefetch, connections))
+
+    def test_prefetch_opens_another_connection(self):
+        account = self.add_account(self.make_fleet(), 'a')
+        _, prefetch, connections = get_account_scan_options(
+            account, FleetOptions(prefetch=2))
+        self.assertEqual((2, 2), (prefetch, connections))
+
+    def test_parallel_connections_are_limited(self):
+        account = self.add_account(
+            self.make_fleet(), 'a', '[scan]\nconnections = 8\n')
+        scan_options, _, connections = get_account_scan_options(
+            account, FleetOptions(account_connections=4))
+        self.assertEqual(3, scan_options.connections)
+        self.assertEqual(4, connections)
+
+    def test_limit_of_one_connection(self):
+        account = self.add_account(
+            self.make_fleet(), 'a', '[scan]\nconnections = 8\n')
+        scan_options, prefetch, connections = get_account_scan_options(
+            account, FleetOptions(prefetch=2, account_connections=1))
+        self.assertEqual(
+            (1, 0, 1), (scan_options.connections, prefetch, connections))
+
+
+class FilterAccountTests(FleetDirectoryMixin, TestCase):
+
+    def test_missing_rules_are_reported(self):
+        account = self.add_account(self.make_fleet(), 'a')
+        result = filter_account(account, FleetOptions())
+
+        self.assertEqual('a', result.name)
+        self.assertEqual(0, result.messages)
+        self.assertIn('No rules file found', result.error)
+        # No default rules file is written:
+        self.assertFalse(os.path.exists(account.path('rules.py')))
+
+    def test_identical_rules_files_are_loaded_once(self):
+        self.patch(_fleet, '_loaded_rules', {})
+        fleet = self.make_fleet()
+        paths = []
+        for name in ('a', 'b'):
+            path = self.add_account(fleet, name).path('rules.py')
+            with open(path, 'w') as rules_file:
+                rules_file.write('RULES = []\n')
+            paths.append(path)
+
+        self.assertIs(_fleet._load_rules(paths[0]),
+                      _fleet._load_rules(paths[1]))
+
+
+class FleetSchedulerTests(TestCase):
+
+    def test_accounts_run_once_without_interval(self):
+        scheduler = FleetScheduler({'a': 1, 'b': 1}, 10)
+        self.assertEqual('a', scheduler.next_account(0))
+        self.assertEqual('b', scheduler.next_account(0))
+        self.assertIsNone(scheduler.next_account(0))
+        scheduler.finished('a', 1)
+        scheduler.finished('b', 1)
+        self.assertTrue(scheduler.done)
+
+    def test_account_never_runs_twice_at_once(self):
+        scheduler = FleetScheduler({'a': 1}, 10, interval=0)
+        self.assertEqual('a', scheduler.next_account(0))
+        self.assertIsNone(scheduler.next_account(5))
+        scheduler.finished('a', 5)
+        self.assertEqual('a', scheduler.next_account(5))
+
+    def test_longest_waiting_goes_first(self):
+        scheduler = FleetScheduler({'a': 1, 'b': 1}, 10, interval=60)
+        scheduler.next_account(0)
+        scheduler.next_account(0)
+        scheduler.finished('b', 10)
+        scheduler.finished('a', 20)
+
+        self.assertIsNone(scheduler.next_account(69))
+        self.assertEqual(1, scheduler.seconds_until_due(69))
+        self.assertEqual('b', scheduler.next_account(100))
+        self.assertEqual('a', scheduler.next_account(100))
+
+    def test_big_account_is_not_overtaken(self):
+        scheduler = FleetScheduler({'a': 2, 'big': 4, 'c': 1}, 5)
+        self.assertEqual('a', scheduler.next_account(0))
+        # 'big' doesn't fit, and 'c' mustn't start ahead of it:
+        self.assertIsNone(scheduler.next_account(0))
+        scheduler.finished('a', 1)
+        self.assertEqual('big', scheduler.next_account(1))
+        self.assertEqual('c', scheduler.next_account(1))
+
+    def test_account_bigger_than_limit_runs_alone(self):
+        scheduler = FleetScheduler({'big': 20, 'c': 1}, 5)
+        self.assertEqual('big', scheduler.next_account(0))
+        self.assertIsNone(scheduler.next_account(0))
+
+
+class RunFleetTests(FleetDirectoryMixin, TestCase):
+
+    def test_runs_every_account_and_totals_results(self):
+        fleet = self.make_fleet()
+        accounts = [self.add_account(fleet, name) for name in 'abc']
+        filtered = []
+
+        def fake_filter(account, options):
+            filtered.append(account.name)
+            error = 'broken' if account.name == 'b' else None
+            return AccountResult(account.name, 10, 0.1, error)
+        self.patch(_fleet, 'filter_account', fake_filter)
+
+        report = run_fleet(
+            accounts, FleetOptions(), 2, 10,
+            executor=ThreadPoolExecutor(max_workers=2))
+
+        self.assertEqual(['a', 'b', 'c'], sorted(filtered))
+        self.assertEqual(3, report.accounts)
+        self.assertEqual(30, report.messages)
+        self.assertEqual(1, report.failures)
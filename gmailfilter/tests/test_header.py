@@ -0,0 +1,109 @@
+from testtools import TestCase
+
+from gmailfilter._header import (
+    MessageHeader,
+    decode_encoded_words,
+    decode_header_value,
+)
+
+
+HEADER = (
+    b'Received: from a.example.com\r\n'
+    b'\tby b.example.com\r\n'
+    b'Subject: =?utf-8?q?Caf=C3=A9?= menu\r\n'
+    b'Received: from c.example.com\r\n'
+    b'X-Empty:\r\n'
+    b'List-Id : Some list <some.list.id>\r\n'
+    b'\r\n'
+)
+
+
+class MessageHeaderTests(TestCase):
+
+    def test_get_first_value(self):
+        header = MessageHeader(HEADER)
+        self.assertEqual(
+            'from a.example.com\tby b.example.com', header['Received'])
+        self.assertEqual('Some list <some.list.id>', header.get('list-id'))
+
+    def test_get_all_values(self):
+        self.assertEqual(
+            ['from a.example.com\tby b.example.com', 'from c.example.com'],
+            MessageHeader(HEADER).get_all('RECEIVED')
+        )
+
+    def test_missing_field(self):
+        header = MessageHeader(HEADER)
+        self.assertEqual(None, header['X-Foo'])
+        self.assertEqual([], header.get_all('X-Foo', []))
+        self.assertNotIn('X-Foo', header)
+
+    def test_empty_field(self):
+        header = MessageHeader(HEADER)
+        self.assertIn('x-empty', header)
+        self.assertEqual('', header['X-Empty'])
+
+    def test_encoded_words_are_decoded(self):
+        self.assertEqual('Café menu', MessageHeader(HEADER)['Subject'])
+
+    def test_keys_and_items_in_order(self):
+        header = MessageHeader(HEADER)
+        self.assertEqual(
+            ['Received', 'Subject', 'Received', 'X-Empty', 'List-Id'],
+            header.keys()
+        )
+        self.assertEqual(5, len(header))
+        self.assertEqual(
+            ('Received', 'from c.example.com'), header.items()[2])
+
+    def test_8bit_header(self):
+        header = MessageHeader(
+            b'Subject: Caf\xc3\xa9\r\nFrom: Andr\xe9 <a@example.com>\r\n\r\n')
+        self.assertEqual('Café', header['Subject'])
+        self.assertEqual('André <a@example.com>', header['From'])
+
+    def test_ends_at_blank_line(self):
+        header = MessageHeader(b'Subject: Hi\r\n\r\nBody: text\r\n')
+        self.assertNotIn('Body', header)
+        self.assertEqual('Hi', header['Subject'])
+
+    def test_lf_line_endings(self):
+        header = MessageHeader(b'Subject: Hi\n  there\nTo: me\n\n')
+        self.assertEqual('Hi  there', header['Subject'])
+        self.assertEqual('me', header['To'])
+
+
+class DecodeTests(TestCase):
+
+    def test_plain_value(self):
+        self.assertEqual('Hello', decode_header_value(b' Hello\r\n'))
+
+    def test_base64_word(self):
+        self.assertEqual('Café', decode_encoded_words('=?UTF-8?B?Q2Fmw6k=?='))
+
+    def test_missing_base64_padding(self):
+        self.assertEqual('Café', decode_encoded_words('=?UTF-8?B?Q2Fmw6k?='))
+
+    def test_q_word_underscores(self):
+        self.assertEqual(
+            'a b é', decode_encoded_words('=?iso-8859-1?Q?a_b_=E9?='))
+
+    def test_space_between_words_is_dropped(self):
+        self.assertEqual(
+            'ab', decode_encoded_words('=?utf-8?q?a?= \t =?utf-8?q?b?='))
+
+    def test_text_between_words_is_kept(self):
+        self.assertEqual(
+            'a and b',
+            decode_encoded_words('=?utf-8?q?a?= and =?utf-8?q?b?='))
+
+    def test_character_split_across_words(self):
+        self.assertEqual(
+            'é', decode_encoded_words('=?utf-8?q?=C3?= =?utf-8?q?=A9?='))
+
+    def test_unknown_charset_is_left_alone(self):
+        self.assertEqual(
+            'x =?x-nothing?q?a?=', decode_encoded_words('x =?x-nothing?q?a?='))
+
+    def test_language_after_charset(self):
+        self.assertEqual('a', decode_encoded_words('=?utf-8*en?q?a?='))
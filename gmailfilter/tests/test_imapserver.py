@@ -0,0 +1,220 @@
+"""End-to-end tests: IMAPConnection and IMAPClient against FakeIMAPServer."""
+
+import os.path
+
+from testtools import TestCase
+import fixtures
+
+from gmailfilter import actions, test
+from gmailfilter._checkpoint import ScanCheckpoint
+from gmailfilter._config import ScanOptions
+from gmailfilter._connection import IMAPConnection
+from gmailfilter._rules import RuleSet
+from gmailfilter._scan import scan_folder
+from gmailfilter.tests import benchmark
+from gmailfilter.tests.imapserver import (
+    DEFAULT_CAPABILITIES,
+    FLAGGED,
+    FakeIMAPServer,
+    SEEN,
+    make_messages,
+    parse_arguments,
+    parse_sequence_set,
+)
+
+
+class ParseArgumentsTests(TestCase):
+
+    def test_atoms_strings_and_lists(self):
+        self.assertEqual(
+            [b'a1', b'LOGIN', b'user', b'pass word', [b'A', [b'B']]],
+            parse_arguments(b'a1 LOGIN user "pass word" (A (B))')
+        )
+
+    def test_brackets_may_contain_spaces(self):
+        self.assertEqual(
+            [[b'UID', b'BODY.PEEK[HEADER.FIELDS (FROM TO)]']],
+            parse_arguments(b'(UID BODY.PEEK[HEADER.FIELDS (FROM TO)])')
+        )
+
+    def test_literal(self):
+        self.assertEqual(
+            [b'SUBJECT', b'caf\xc3\xa9'],
+            parse_arguments(b'SUBJECT {5}\r\ncaf\xc3\xa9')
+        )
+
+    def test_sequence_set(self):
+        self.assertEqual(
+            [(1, 3), (5, 5), (7, 9)], parse_sequence_set(b'1:3,5,7:*', 9))
+
+
+class EndToEndTests(TestCase):
+
+    def get_server(self, count=20, **kwargs):
+        return self.useFixture(
+            FakeIMAPServer({'INBOX': make_messages(count)}, **kwargs))
+
+    def get_connection(self, server, compress=False, **kwargs):
+        connection = IMAPConnection(server.server_info(compress), **kwargs)
+        self.addCleanup(connection.close)
+        return connection
+
+    def test_full_scan(self):
+        server = self.get_server()
+        connection = self.get_connection(server)
+
+        messages = list(connection.get_messages())
+
+        stored = server.folders['INBOX'].messages
+        self.assertEqual(
+            [m.uid for m in stored], [m.uid() for m in messages])
+        self.assertEqual(
+            [m.get_header('Subject')[0] for m in stored],
+            [m.subject() for m in messages]
+        )
+        self.assertEqual(
+            [SEEN in m.flags for m in stored],
+            [test.IsRead().match(m) for m in messages]
+        )
+
+    def test_full_scan_fetches_in_chunks(self):
+        server = self.get_server(count=120)
+        connection = self.get_connection(
+            server,
+            scan_options=ScanOptions(
+                initial_chunk_size=50, min_chunk_size=50, max_chunk_size=50)
+        )
+        server.reset_stats()
+
+        self.assertEqual(120, len(list(connection.get_messages(['FLAGS']))))
+        self.assertEqual(3, server.stats.commands[b'FETCH'])
+        self.assertEqual(120, server.stats.messages_fetched)
+
+    def test_parallel_scan_fetches_each_message_once(self):
+        server = self.get_server(count=50)
+        connection = self.get_connection(
+            server, scan_options=ScanOptions(connections=3))
+        server.reset_stats()
+
+        messages = list(connection.get_messages(['FLAGS']))
+
+        self.assertEqual(
+            list(range(1, 51)), sorted(m.uid() for m in messages))
+        self.assertEqual(50, server.stats.messages_fetched)
+        self.assertEqual(3, server.stats.commands[b'UID FETCH'])
+
+    def test_lazy_parts_are_fetched_once_per_chunk(self):
+        server = self.get_server(count=120)
+        connection = self.get_connection(
+            server,
+            scan_options=ScanOptions(
+                initial_chunk_size=50, min_chunk_size=50, max_chunk_size=50)
+        )
+        server.reset_stats()
+
+        messages = connection.get_messages(['FLAGS'])
+        subjects = [m.subject() for m in messages]
+
+        self.assertEqual(
+            [m.get_header('Subject')[0]
+             for m in server.folders['INBOX'].messages],
+            subjects
+        )
+        self.assertEqual(6, server.stats.commands[b'FETCH'])
+        self.assertEqual(0, server.stats.commands[b'UID FETCH'])
+
+    def test_lazy_parts_of_parallel_scan(self):
+        server = self.get_server(count=60)
+        connection = self.get_connection(
+            server, scan_options=ScanOptions(connections=3))
+        server.reset_stats()
+
+        sizes = {m.uid(): m.get_size() for m in connection.get_messages()}
+
+        self.assertEqual(
+            {m.uid: m.size for m in server.folders['INBOX'].messages}, sizes)
+        self.assertEqual(6, server.stats.commands[b'UID FETCH'])
+
+    def test_compression_reduces_bytes_sent(self):
+        sizes = []
+        for compress in (False, True):
+            server = self.get_server()
+            connection = self.get_connection(server, compress)
+            server.reset_stats()
+            list(connection.get_messages())
+            sizes.append(server.stats.bytes_sent)
+        self.assertLess(sizes[1], sizes[0] / 2)
+
+    def test_actions_without_move(self):
+        capabilities = [c for c in DEFAULT_CAPABILITIES if c != 'MOVE']
+        server = self.get_server(capabilities=capabilities)
+        connection = self.get_connection(server)
+        rules = RuleSet([(test.IsRead(), actions.Move('Read'))])
+
+        scan_folder(connection, 'INBOX', rules)
+
+        self.assertEqual(
+            [False] * len(server.folders['INBOX'].messages),
+            [SEEN in m.flags for m in server.folders['INBOX'].messages]
+        )
+        self.assertNotEqual([], server.folders['Read'].messages)
+
+    def test_logging_a_match_does_not_fetch_headers(self):
+        server = self.get_server(count=200)
+        messages = server.folders['INBOX'].messages
+        for message in messages:
+            message.flags.discard(FLAGGED)
+        messages[50].flags.add(FLAGGED)
+        connection = self.get_connection(server)
+        rules = RuleSet([(test.IsFlagged(), actions.Move('Flagged'))])
+        server.reset_stats()
+
+        scan_folder(connection, 'INBOX', rules)
+
+        self.assertEqual(1, len(server.folders['Flagged'].messages))
+        # Moving the message logs its subject, which mustn't fetch the
+        # whole header for its chunk:
+        headers = sum(len(m.header) for m in messages)
+        self.assertLess(server.stats.bytes_sent, headers / 10)
+
+    def test_incremental_scan_retests_changed_flags(self):
+        directory = self.useFixture(fixtures.TempDir()).path
+        checkpoint = ScanCheckpoint(os.path.join(directory, 'checkpoint'))
+        server = self.get_server()
+        connection = self.get_connection(server)
+        rules = RuleSet(
+            [(test.IsFlagged(), actions.Move('Flagged'))], source_hash='a')
+        scan_folder(connection, 'INBOX', rules, checkpoint)
+
+        message = server.folders['INBOX'].messages[3]
+        with server.lock:
+            message.flags.add(FLAGGED)
+            server.folders['INBOX'].touch(message)
+        scan = scan_folder(connection, 'INBOX', rules, checkpoint)
+
+        self.assertEqual(1, scan.messages)
+        self.assertIn(
+            message.header,
+            [m.header for m in server.folders['Flagged'].messages]
+        )
+
+    def test_bad_password(self):
+        server = self.get_server()
+        server_info = server.server_info()
+        server.password = 'other'
+        self.assertRaises(RuntimeError, IMAPConnection, server_info)
+
+
+class BenchmarkTests(TestCase):
+
+    def test_scenarios_run(self):
+        for scenario in benchmark.SCENARIOS:
+            result = benchmark.run_scenario(scenario, {'count': 20}, 0, True)
+            self.assertGreater(result.messages, 0)
+            self.assertGreater(result.round_trips, 0)
+            self.assertGreater(result.peak_memory, 0)
+
+    def test_peak_memory_is_bounded_by_chunk_size(self):
+        small = benchmark.measure_scan_memory({'count': 100}, 25, 'rules')
+        large = benchmark.measure_scan_memory({'count': 800}, 25, 'rules')
+        self.assertLess(large, small * 1.2)
@@ -2,7 +2,12 @@
 
 from testtools import TestCase
 
-from gmailfilter._message import parse_list_id
+from gmailfilter._message import (
+    EmailMessage,
+    header_fields_part,
+    parse_header_fields,
+    parse_list_id,
+)
 
 
 class ListIdParsingTestCase(TestCase):
@@ -26,3 +31,98 @@ class ListIdParsingTestCase(TestCase):
             parse_list_id('some description <list.id>'),
             parse_list_id('some other description <list.id>'),
             )
+
+
+class FakeMessageProxy(object):
+
+    """A stand-in for MessageConnectionProxy that records lazy fetches."""
+
+    def __init__(self, full_header, fields_header=None, fields=None):
+        self.full_header = full_header
+        self.fields_header = fields_header
+        self.fields = fields
+        self.fetched = []
+
+    def get_header_block(self):
+        if self.fields is None:
+            return self.get_message_part(b'BODY.PEEK[HEADER]'), None
+        return self.fields_header, self.fields
+
+    def get_message_part(self, part_name):
+        self.fetched.append(part_name)
+        if part_name == b'UID':
+            return 1234
+        return self.full_header
+
+
+FULL_HEADER = (
+    b'Subject: Hello\r\n'
+    b'List-Id: Some list <some.list.id>\r\n'
+    b'X-Foo: bar\r\n'
+    b'\r\n'
+)
+
+
+class EmailMessageHeaderTests(TestCase):
+
+    def test_full_header(self):
+        proxy = FakeMessageProxy(FULL_HEADER)
+        message = EmailMessage(proxy)
+        self.assertEqual('Hello', message.subject())
+        self.assertEqual('bar', message.get_header('X-Foo'))
+        self.assertEqual('some.list.id', message.list_id())
+
+    def test_8bit_header(self):
+        proxy = FakeMessageProxy(b'Subject: Caf\xc3\xa9\r\n\r\n')
+        self.assertEqual('Caf\xe9', EmailMessage(proxy).subject())
+
+    def test_prefetched_fields_are_used_without_fetching(self):
+        proxy = FakeMessageProxy(
+            FULL_HEADER,
+            b'Subject: Hello\r\n\r\n',
+            {'subject', 'list-id'}
+        )
+        message = EmailMessage(proxy)
+        self.assertEqual('Hello', message.subject())
+        self.assertEqual(None, message.list_id())
+        self.assertFalse(message.is_list_message())
+        self.assertEqual([], proxy.fetched)
+
+    def test_header_outside_fields_fetches_full_header(self):
+        proxy = FakeMessageProxy(
+            FULL_HEADER,
+            b'Subject: Hello\r\n\r\n',
+            {'subject'}
+        )
+        message = EmailMessage(proxy)
+        self.assertEqual('bar', message.get_header('X-Foo'))
+        self.assertIn(b'BODY.PEEK[HEADER]', proxy.fetched)
+        self.assertEqual('some.list.id', message.list_id())
+
+    def test_get_headers_returns_full_header(self):
+        proxy = FakeMessageProxy(
+            FULL_HEADER,
+            b'Subject: Hello\r\n\r\n',
+            {'subject'}
+        )
+        headers = EmailMessage(proxy).get_headers()
+        self.assertIn('X-Foo', headers)
+
+
+class HeaderFieldsTests(TestCase):
+
+    def test_header_fields_part(self):
+        self.assertEqual(
+            'BODY.PEEK[HEADER.FIELDS (LIST-ID SUBJECT)]',
+            header_fields_part(['Subject', 'List-Id', 'subject'])
+        )
+
+    def test_parse_header_fields_from_response_key(self):
+        self.assertEqual(
+            {'subject', 'list-id'},
+            parse_header_fields(b'BODY[HEADER.FIELDS (SUBJECT "LIST-ID")]')
+        )
+
+    def test_parse_header_fields_roundtrip(self):
+        part = header_fields_part(['Subject', 'X-Foo'])
+        self.assertEqual({'subject', 'x-foo'}, parse_header_fields(part))
@@ -0,0 +1,77 @@
+
+import threading
+
+from testtools import TestCase
+
+from gmailfilter._pipeline import (
+    merge,
+    prefetch,
+)
+
+
+class PrefetchTests(TestCase):
+
+    def test_yields_items_in_order(self):
+        self.assertEqual(list(range(10)), list(prefetch(range(10), 2)))
+
+    def test_empty_iterable(self):
+        self.assertEqual([], list(prefetch([], 1)))
+
+    def test_iterates_in_another_thread(self):
+        def get_thread():
+            yield threading.current_thread()
+
+        [thread] = prefetch(get_thread(), 1)
+        self.assertIsNot(threading.current_thread(), thread)
+
+    def test_reraises_exceptions_in_consumer(self):
+        def fail():
+            yield 1
+            raise ValueError("boom")
+
+        items = prefetch(fail(), 1)
+        self.assertEqual(1, next(items))
+        self.assertRaises(ValueError, next, items)
+
+    def test_stops_producer_when_consumer_stops(self):
+        produced = []
+        finished = threading.Event()
+
+        def produce():
+            try:
+                for i in range(1000):
+                    produced.append(i)
+                    yield i
+            finally:
+                finished.set()
+
+        items = prefetch(produce(), 1)
+        self.assertEqual(0, next(items))
+        items.close()
+        self.assertTrue(finished.wait(5))
+        self.assertLess(len(produced), 1000)
+
+
+class MergeTests(TestCase):
+
+    def test_yields_items_from_all_iterables(self):
+        items = list(merge([range(5), range(10, 15), []], 2))
+        self.assertEqual(
+            list(range(5)) + list(range(10, 15)), sorted(items))
+
+    def test_keeps_order_within_each_iterable(self):
+        items = list(merge([range(50), range(100, 150)], 3))
+        self.assertEqual(list(range(50)), [i for i in items if i < 100])
+        self.assertEqual(
+            list(range(100, 150)), [i for i in items if i >= 100])
+
+    def test_no_iterables(self):
+        self.assertEqual([], list(merge([], 1)))
+
+    def test_reraises_exceptions_in_consumer(self):
+        def fail():
+            raise ValueError("boom")
+            yield
+
+        items = merge([range(3), fail()], 1)
+        self.assertRaises(ValueError, list, items)
@@ -0,0 +1,135 @@
+"""Tests for recording IMAP sessions and replaying them."""
+
+import os.path
+
+from testtools import TestCase
+import fixtures
+
+from gmailfilter import actions, test
+from gmailfilter._config import ScanOptions
+from gmailfilter._connection import IMAPConnection
+from gmailfilter._replay import (
+    ReplayConnection,
+    ReplayError,
+    SessionRecorder,
+    SessionRecording,
+)
+from gmailfilter._rules import RuleSet
+from gmailfilter._scan import scan_folder
+from gmailfilter.tests import benchmark
+from gmailfilter.tests.imapserver import (
+    FakeIMAPServer,
+    SEEN,
+    make_messages,
+)
+
+
+class RecordAndReplayTests(TestCase):
+
+    def record(self, fetch_parts=None, count=30):
+        """Scan a fake server's INBOX while recording it.
+
+        Returns the server and the path of the recording.
+
+        """
+        server = self.useFixture(
+            FakeIMAPServer({'INBOX': make_messages(count)}))
+        directory = self.useFixture(fixtures.TempDir()).path
+        path = os.path.join(directory, 'session.gz')
+        recorder = SessionRecorder(path)
+        connection = IMAPConnection(
+            server.server_info(False), recorder=recorder)
+        try:
+            list(connection.get_messages(fetch_parts))
+        finally:
+            connection.close()
+            recorder.close()
+        return server, path
+
+    def get_replay(self, path, **kwargs):
+        connection = ReplayConnection(SessionRecording.load(path), **kwargs)
+        self.addCleanup(connection.close)
+        return connection
+
+    def test_replay_returns_the_recorded_messages(self):
+        server, path = self.record()
+        connection = self.get_replay(path)
+
+        messages = list(connection.get_messages())
+
+        stored = server.folders['INBOX'].messages
+        self.assertEqual([m.uid for m in stored], [m.uid() for m in messages])
+        self.assertEqual(
+            [m.get_header('Subject')[0] for m in stored],
+            [m.subject() for m in messages]
+        )
+        self.assertEqual(
+            [SEEN in m.flags for m in stored],
+            [test.IsRead().match(m) for m in messages]
+        )
+
+    def test_replay_in_other_chunks_and_in_parallel(self):
+        server, path = self.record()
+        connection = self.get_replay(
+            path,
+            scan_options=ScanOptions(
+                connections=3, initial_chunk_size=7, min_chunk_size=7,
+                max_chunk_size=7)
+        )
+
+        messages = list(connection.get_messages(['FLAGS']))
+
+        self.assertEqual(
+            [m.uid for m in server.folders['INBOX'].messages],
+            sorted(m.uid() for m in messages)
+        )
+
+    def test_replay_fetches_fewer_header_fields(self):
+        server, path = self.record(['BODY.PEEK[HEADER]', 'FLAGS'])
+        connection = self.get_replay(path)
+
+        messages = list(connection.get_messages(
+            ['BODY.PEEK[HEADER.FIELDS (SUBJECT)]', 'FLAGS']))
+
+        self.assertEqual(
+            [m.get_header('Subject')[0]
+             for m in server.folders['INBOX'].messages],
+            [m.subject() for m in messages]
+        )
+
+    def test_part_not_recorded(self):
+        server, path = self.record(['BODY.PEEK[HEADER.FIELDS (SUBJECT)]'])
+        connection = self.get_replay(path)
+
+        self.assertRaises(
+            ReplayError, list,
+            connection.get_messages(['BODY.PEEK[HEADER]']))
+
+    def test_actions_are_not_run(self):
+        server, path = self.record()
+        connection = self.get_replay(path)
+        rules = RuleSet([(test.IsRead(), actions.Move('Read'))])
+
+        scan = scan_folder(connection, 'INBOX', rules)
+
+        self.assertEqual(30, scan.messages)
+        self.assertIn(
+            'move', [action[0] for action in connection._client.actions])
+        self.assertNotIn('Read', server.folders)
+
+    def test_not_a_recording(self):
+        directory = self.useFixture(fixtures.TempDir()).path
+        path = os.path.join(directory, 'rules.py')
+        with open(path, 'w') as f:
+            f.write('RULES = []\n')
+        self.assertRaises(ValueError, SessionRecording.load, path)
+
+    def test_benchmark_replays(self):
+        server, path = self.record()
+        recording = SessionRecording.load(path)
+        scenario = benchmark.SCENARIOS[0]
+        result = benchmark.run_replay_scenario(
+            scenario, recording, benchmark.get_rules(), True)
+        self.assertEqual(30, result.messages)
+        self.assertGreater(result.bytes_sent, 0)
+        self.assertGreater(result.peak_memory, 0)
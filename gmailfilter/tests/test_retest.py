@@ -0,0 +1,77 @@
+from datetime import datetime
+
+from testtools import TestCase
+
+from gmailfilter._retest import RetestScheduler
+
+
+def at(timestamp):
+    return datetime.fromtimestamp(timestamp)
+
+
+class RetestSchedulerTests(TestCase):
+
+    def get_scheduler(self, entries=()):
+        return RetestScheduler(entries, minimum_delay=0)
+
+    def test_empty_scheduler(self):
+        scheduler = self.get_scheduler()
+        self.assertEqual(0, len(scheduler))
+        self.assertIsNone(scheduler.next_retest())
+        self.assertIsNone(scheduler.seconds_until_next_retest())
+        self.assertEqual([], scheduler.pop_due())
+
+    def test_pop_due_returns_only_due_uids_in_order(self):
+        scheduler = self.get_scheduler()
+        scheduler.schedule(1, at(3000), now=0)
+        scheduler.schedule(2, at(1000), now=0)
+        scheduler.schedule(3, at(2000), now=0)
+
+        self.assertEqual([2, 3], scheduler.pop_due(now=2500))
+        self.assertEqual([1], [uid for uid, t in scheduler.get_entries()])
+
+    def test_reschedule_replaces_earlier_time(self):
+        scheduler = self.get_scheduler()
+        scheduler.schedule(1, at(1000), now=0)
+        scheduler.schedule(1, at(5000), now=0)
+
+        self.assertEqual([], scheduler.pop_due(now=2000))
+        self.assertEqual(at(5000), scheduler.next_retest())
+        self.assertEqual([1], scheduler.pop_due(now=5000))
+
+    def test_discard(self):
+        scheduler = self.get_scheduler()
+        scheduler.schedule(1, at(1000), now=0)
+        scheduler.discard(1)
+        scheduler.discard(2)
+
+        self.assertNotIn(1, scheduler)
+        self.assertIsNone(scheduler.next_retest())
+        self.assertEqual([], scheduler.pop_due(now=2000))
+
+    def test_seconds_until_next_retest(self):
+        scheduler = self.get_scheduler()
+        scheduler.schedule(1, at(1000), now=0)
+        self.assertEqual(400, scheduler.seconds_until_next_retest(now=600))
+        self.assertEqual(0, scheduler.seconds_until_next_retest(now=2000))
+
+    def test_minimum_delay(self):
+        scheduler = RetestScheduler(minimum_delay=60)
+        scheduler.schedule(1, at(1000), now=990)
+        self.assertEqual([(1, 1050)], scheduler.get_entries())
+
+    def test_entries_roundtrip(self):
+        scheduler = self.get_scheduler()
+        scheduler.schedule(1, at(1000), now=0)
+        scheduler.schedule(2, at(2000), now=0)
+
+        restored = self.get_scheduler(scheduler.get_entries())
+        self.assertEqual(2, len(restored))
+        self.assertEqual([1, 2], restored.pop_due(now=2000))
+
+    def test_heap_is_compacted(self):
+        scheduler = self.get_scheduler()
+        for i in range(1000):
+            scheduler.schedule(1, at(1000 + i), now=0)
+        self.assertLess(len(scheduler._heap), 100)
+        self.assertEqual([(1, 1999)], scheduler.get_entries())
@@ -1,9 +1,24 @@
+import datetime
 import os
 
 from testtools import TestCase
 import fixtures
 
-from gmailfilter._rules import default_rules_path
+from gmailfilter import actions, test
+from gmailfilter._message import FLAGS, HEADER, INTERNALDATE, UID
+from gmailfilter._retest import RetestScheduler
+from gmailfilter._rules import (
+    default_rules_path,
+    load_folder_rules,
+    load_rules,
+    RuleLoadError,
+    RuleSet,
+    SimpleRuleProcessor,
+)
+from gmailfilter.tests.factory import (
+    RecordingAction,
+    TestFactoryMixin,
+)
 
 
 class RulePathTests(TestCase):
@@ -27,3 +42,167 @@ class RulePathTests(TestCase):
 
         expected = os.path.join(fake_home, 'rules.py')
         self.assertEqual(expected, path)
+
+
+class LoadRulesTests(TestCase):
+
+    def write_rules(self, text):
+        directory = self.useFixture(fixtures.TempDir()).path
+        path = os.path.join(directory, 'rules.py')
+        with open(path, 'w') as rules_file:
+            rules_file.write(
+                'from gmailfilter import actions, test\n'
+                "DELETE_SEEN = ((test.IsRead(), actions.DeleteMessage()),)\n"
+                + text
+            )
+        return path
+
+    def test_rules_are_for_inbox(self):
+        path = self.write_rules("RULES = DELETE_SEEN\n")
+        rulesets = load_folder_rules(path)
+        self.assertEqual(['INBOX'], list(rulesets))
+        self.assertIsInstance(load_rules(path), RuleSet)
+
+    def test_folder_rules(self):
+        path = self.write_rules(
+            "RULES = DELETE_SEEN\n"
+            "FOLDER_RULES = {\n"
+            "    'Spam': DELETE_SEEN,\n"
+            "}\n"
+        )
+        rulesets = load_folder_rules(path)
+        self.assertEqual(['INBOX', 'Spam'], list(rulesets))
+        self.assertEqual(
+            rulesets['INBOX'].source_hash, rulesets['Spam'].source_hash)
+
+    def test_folder_rules_without_inbox_rules(self):
+        path = self.write_rules(
+            "FOLDER_RULES = {\n"
+            "    'inbox': DELETE_SEEN,\n"
+            "}\n"
+        )
+        self.assertEqual(['INBOX'], list(load_folder_rules(path)))
+
+    def test_inbox_rules_set_twice(self):
+        path = self.write_rules(
+            "RULES = DELETE_SEEN\n"
+            "FOLDER_RULES = {\n"
+            "    'INBOX': DELETE_SEEN,\n"
+            "}\n"
+        )
+        self.assertRaises(RuleLoadError, load_folder_rules, path)
+
+    def test_no_rules(self):
+        path = self.write_rules("")
+        self.assertRaises(RuleLoadError, load_folder_rules, path)
+
+    def test_load_rules_needs_inbox_rules(self):
+        path = self.write_rules(
+            "FOLDER_RULES = {\n"
+            "    'Spam': DELETE_SEEN,\n"
+            "}\n"
+        )
+        self.assertRaises(RuleLoadError, load_rules, path)
+
+
+SUBJECT = 'BODY.PEEK[HEADER.FIELDS (SUBJECT)]'
+
+
+class RuleSetFetchPartsTests(TestCase):
+
+    def test_fetch_parts_is_union_of_all_tests(self):
+        rules = RuleSet([
+            (test.IsRead(), actions.LogMessage()),
+            (
+                test.MessageOlderThan(datetime.timedelta(days=1)),
+                actions.DeleteMessage()
+            ),
+        ])
+        self.assertEqual(
+            {UID, FLAGS, INTERNALDATE, SUBJECT}, rules.fetch_parts)
+
+    def test_fetch_parts_always_includes_uid(self):
+        rules = RuleSet([(test.Or(), actions.LogMessage())])
+        self.assertEqual({UID, SUBJECT}, rules.fetch_parts)
+
+    def test_fetches_only_referenced_header_fields(self):
+        rules = RuleSet([
+            (test.SubjectContains('foo'), actions.LogMessage()),
+            (
+                test.Or(test.ListId('foo.bar'), test.MatchesHeader('X-Foo')),
+                actions.LogMessage()
+            ),
+        ])
+        self.assertEqual(
+            {UID, 'BODY.PEEK[HEADER.FIELDS (LIST-ID SUBJECT X-FOO)]'},
+            rules.fetch_parts
+        )
+
+    def test_fetches_full_header_for_undeclared_header_use(self):
+        class CustomTest(test.Test):
+            def match(self, message):
+                return 'X-Foo' in message.get_headers()
+
+            def get_required_parts(self):
+                return {HEADER}
+
+        rules = RuleSet([
+            (test.SubjectContains('foo'), actions.LogMessage()),
+            (CustomTest(), actions.LogMessage()),
+        ])
+        self.assertEqual({UID, HEADER}, rules.fetch_parts)
+
+    def test_only_subject_fetched_for_tests_not_needing_header(self):
+        # The subject is still fetched, for logging:
+        rules = RuleSet([(test.IsRead(), actions.LogMessage())])
+        self.assertEqual({UID, FLAGS, SUBJECT}, rules.fetch_parts)
+
+
+class RuleProcessorRetestTests(TestCase, TestFactoryMixin):
+
+    def setUp(self):
+        super().setUp()
+        self.scheduler = RetestScheduler(minimum_delay=0)
+        self.action = RecordingAction()
+        self.processor = SimpleRuleProcessor(
+            RuleSet([
+                (test.IsFlagged(), self.action),
+                (
+                    test.MessageOlderThan(datetime.timedelta(days=10)),
+                    self.action
+                ),
+                (
+                    test.MessageOlderThan(datetime.timedelta(days=5)),
+                    self.action
+                ),
+            ]),
+            None,
+            self.scheduler
+        )
+
+    def get_message(self, uid, age, flags=()):
+        message = self.get_email_message(
+            date=datetime.datetime.now() - age,
+            flags=flags
+        )
+        message.uid = lambda: uid
+        return message
+
+    def test_young_message_is_scheduled_for_earliest_rule(self):
+        message = self.get_message(1, datetime.timedelta(days=1))
+        self.processor.process_message(message)
+
+        self.assertEqual([], self.action.processed)
+        self.assertEqual(
+            message.date + datetime.timedelta(days=5),
+            self.scheduler.next_retest()
+        )
+
+    def test_matching_message_is_not_scheduled(self):
+        message = self.get_message(1, datetime.timedelta(days=1))
+        self.processor.process_message(message)
+        message.flags = (test.HasFlag.FLAGGED,)
+        self.processor.process_message(message)
+
+        self.assertEqual([message], self.action.processed)
+        self.assertNotIn(1, self.scheduler)
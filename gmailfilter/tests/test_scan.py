@@ -0,0 +1,224 @@
+import os.path
+
+from testtools import TestCase
+import fixtures
+
+from gmailfilter import actions, test
+from gmailfilter._checkpoint import (
+    FetchProfile,
+    ScanCheckpoint,
+    ScanJournal,
+)
+from gmailfilter._config import ScanOptions
+from gmailfilter._rules import RuleSet
+from gmailfilter._scan import scan_folder
+from gmailfilter.tests.test_connection import (
+    FakeCondstoreIMAPClient,
+    get_fake_connection,
+)
+from gmailfilter.tests.test_executor import RecordingBatchAction
+
+
+SUBJECT = 'BODY.PEEK[HEADER.FIELDS (SUBJECT)]'
+
+
+class ScanFolderTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = self.useFixture(fixtures.TempDir()).path
+        self.checkpoint = ScanCheckpoint(
+            os.path.join(directory, 'checkpoint.json'))
+        self.rules = RuleSet(
+            [(test.IsFlagged(), actions.DeleteMessage())], source_hash='abc')
+
+    def get_connection(self, client):
+        connection = get_fake_connection([])
+        connection._client = client
+        connection._folder_cache = None
+        return connection
+
+    def test_full_scan_records_highest_modseq(self):
+        client = FakeCondstoreIMAPClient([1, 2, 3], {}, 917)
+        scan = scan_folder(
+            self.get_connection(client), 'INBOX', self.rules, self.checkpoint)
+
+        self.assertEqual(3, scan.messages)
+        self.assertEqual(4, scan.next_uid)
+        self.assertEqual(917, self.checkpoint.get_highest_modseq('INBOX'))
+
+    def test_incremental_scan_retests_changed_messages(self):
+        client = FakeCondstoreIMAPClient([1, 2, 3], {}, 917)
+        scan_folder(
+            self.get_connection(client), 'INBOX', self.rules, self.checkpoint)
+
+        client = FakeCondstoreIMAPClient([1, 2, 3, 4], {2: 950, 4: 951}, 951)
+        scan = scan_folder(
+            self.get_connection(client), 'INBOX', self.rules, self.checkpoint)
+
+        # Message 4 is new, and message 2's flags changed:
+        self.assertEqual(2, scan.messages)
+        self.assertEqual(
+            [['UID', '4:*'], ['UID', '1:3', 'MODSEQ', 918]],
+            client.search_calls
+        )
+        self.assertEqual(
+            [
+                ([4], [SUBJECT, 'FLAGS', 'UID']),
+                ([2], [SUBJECT, 'FLAGS', 'UID']),
+            ],
+            client.fetch_calls
+        )
+        self.assertEqual(951, self.checkpoint.get_highest_modseq('INBOX'))
+
+    def test_profile_learns_undeclared_parts(self):
+        directory = self.useFixture(fixtures.TempDir()).path
+        profile = FetchProfile(os.path.join(directory, 'profile.json'))
+        rules = RuleSet(
+            [(ReadsFrom(), actions.DeleteMessage())], source_hash='abc')
+
+        client = FakeCondstoreIMAPClient([1, 2, 3], {}, 1)
+        scan_folder(self.get_connection(client), 'INBOX', rules,
+                    profile=profile)
+        # The header was fetched a chunk at a time, when it was read:
+        self.assertEqual([SUBJECT, 'FLAGS', 'UID'], client.fetch_calls[0][1])
+        self.assertEqual(
+            [b'BODY.PEEK[HEADER]', 'UID'], client.fetch_calls[1][1])
+
+        client = FakeCondstoreIMAPClient([1, 2, 3], {}, 1)
+        scan_folder(self.get_connection(client), 'INBOX', rules,
+                    profile=profile)
+        self.assertEqual(
+            [([1, 2, 3], ['BODY.PEEK[HEADER]', 'FLAGS', 'UID'])],
+            [(sorted(uids), parts) for uids, parts in client.fetch_calls]
+        )
+
+
+class ReadsFrom(test.Test):
+
+    """A test that reads the sender without declaring the header."""
+
+    def match(self, message):
+        message.from_()
+        return False
+
+    def get_required_parts(self):
+        return {'FLAGS'}
+
+
+class FailingIMAPClient(FakeCondstoreIMAPClient):
+
+    """A FakeCondstoreIMAPClient whose connection drops on the nth fetch."""
+
+    def __init__(self, messages, fail_on_fetch):
+        super().__init__(messages, {}, 1)
+        self.fail_on_fetch = fail_on_fetch
+
+    def fetch(self, messages, data):
+        if len(self.fetch_calls) + 1 == self.fail_on_fetch:
+            raise OSError("Connection reset")
+        return super().fetch(messages, data)
+
+
+class QuietBatchAction(RecordingBatchAction):
+
+    def log_message(self, message):
+        pass
+
+
+class FailingBatchAction(QuietBatchAction):
+
+    """A QuietBatchAction whose connection drops the first time it runs."""
+
+    failed = False
+
+    def process_batch(self, conn, uids):
+        if not self.failed:
+            self.failed = True
+            raise OSError("Connection reset")
+        super().process_batch(conn, uids)
+
+
+class UIDBelow(test.Test):
+
+    def __init__(self, uid):
+        self.uid = uid
+
+    def match(self, message):
+        return message.uid() < self.uid
+
+    def get_required_parts(self):
+        return set()
+
+
+class ResumeScanTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = self.useFixture(fixtures.TempDir()).path
+        self.journal = ScanJournal(os.path.join(directory, 'journal.json'))
+        self.log = []
+
+    def scan(self, client, rule_test, rules=None):
+        connection = get_fake_connection([])
+        connection._client = client
+        connection._folder_cache = None
+        connection._scan_options = ScanOptions(
+            initial_chunk_size=2, min_chunk_size=1, max_chunk_size=2)
+        if rules is None:
+            rules = [(rule_test, QuietBatchAction('a', self.log))]
+        rules = RuleSet(rules, source_hash='abc')
+        # Let the server search, so messages are fetched by UID in chunks:
+        return scan_folder(
+            connection, 'INBOX', rules, search=True, journal=self.journal)
+
+    def test_interrupted_scan_resumes(self):
+        self.assertRaises(
+            OSError,
+            self.scan, FailingIMAPClient([1, 2, 3, 4, 5, 6], 2),
+            test.IsFlagged()
+        )
+        self.assertEqual(
+            {1, 2}, self.journal.get_tested_uids('INBOX', 1, 'abc'))
+
+        client = FakeCondstoreIMAPClient([1, 2, 3, 4, 5, 6], {}, 1)
+        scan = self.scan(client, test.IsFlagged())
+
+        self.assertEqual(4, scan.messages)
+        self.assertEqual(7, scan.next_uid)
+        self.assertEqual(
+            [[3, 4], [5, 6]], [uids for uids, parts in client.fetch_calls])
+        self.assertIsNone(self.journal.get_tested_uids('INBOX', 1, 'abc'))
+
+    def test_messages_with_pending_actions_are_tested_again(self):
+        self.assertRaises(
+            OSError,
+            self.scan, FailingIMAPClient([2, 4, 6, 8], 2), test.IsRead()
+        )
+        self.assertEqual([], self.log)
+        self.assertEqual(
+            set(), self.journal.get_tested_uids('INBOX', 1, 'abc'))
+
+        self.scan(FakeCondstoreIMAPClient([2, 4, 6, 8], {}, 1), test.IsRead())
+        self.assertEqual([('a', [2, 4, 6, 8])], self.log)
+
+    def test_batches_that_fail_to_run_are_run_again(self):
+        failing = FailingBatchAction('b', self.log)
+        rules = [
+            (UIDBelow(5), QuietBatchAction('a', self.log)),
+            (test.IsRead(), failing),
+        ]
+        self.assertRaises(
+            OSError,
+            self.scan, FakeCondstoreIMAPClient([2, 4, 6, 8], {}, 1), None,
+            rules
+        )
+        self.assertEqual([('a', [2, 4])], self.log)
+        self.assertEqual(
+            {2, 4}, self.journal.get_tested_uids('INBOX', 1, 'abc'))
+
+        client = FakeCondstoreIMAPClient([2, 4, 6, 8], {}, 1)
+        self.scan(client, None, rules)
+        self.assertEqual([('a', [2, 4]), ('b', [6, 8])], self.log)
+        self.assertEqual(
+            [[6, 8]], [uids for uids, parts in client.fetch_calls])
@@ -0,0 +1,138 @@
+import datetime
+
+from testtools import TestCase
+
+from gmailfilter import test
+from gmailfilter._search import (
+    compile_rules,
+    compile_test,
+    MATCH_NOTHING,
+)
+
+
+class UntranslatableTest(test.Test):
+
+    def match(self, message):
+        return True
+
+
+class CompileLeafTests(TestCase):
+
+    def test_system_flags(self):
+        self.assertEqual((['SEEN'], True), compile_test(test.IsRead()))
+        self.assertEqual((['FLAGGED'], True), compile_test(test.IsFlagged()))
+
+    def test_keyword_flag(self):
+        self.assertEqual(
+            (['KEYWORD', '$Label1'], True),
+            compile_test(test.HasFlag(b'$Label1'))
+        )
+
+    def test_subject(self):
+        self.assertEqual(
+            (['SUBJECT', 'hello'], False),
+            compile_test(test.SubjectContains('hello'))
+        )
+
+    def test_caseless_subject_is_not_translated(self):
+        self.assertIsNone(
+            compile_test(test.SubjectContains('hello', case_sensitive=False)))
+
+    def test_non_ascii_subject_is_not_translated(self):
+        self.assertIsNone(compile_test(test.SubjectContains('Buße')))
+
+    def test_header_presence_is_exact(self):
+        self.assertEqual(
+            (['HEADER', 'X-Foo', ''], True),
+            compile_test(test.MatchesHeader('X-Foo'))
+        )
+
+    def test_header_value_is_a_superset(self):
+        self.assertEqual(
+            (['HEADER', 'X-Foo', 'bar'], False),
+            compile_test(test.MatchesHeader('X-Foo', 'bar'))
+        )
+
+    def test_list_id(self):
+        self.assertEqual(
+            (['HEADER', 'List-Id', 'foo.bar'], False),
+            compile_test(test.ListId('foo.bar'))
+        )
+
+    def test_message_age(self):
+        criteria, exact = compile_test(
+            test.MessageOlderThan(datetime.timedelta(days=90)))
+        expected = (
+            datetime.date.today()
+            - datetime.timedelta(days=90)
+            + datetime.timedelta(days=2)
+        )
+        self.assertEqual(['BEFORE', expected], criteria)
+        self.assertFalse(exact)
+
+    def test_text_search_can_be_disabled(self):
+        self.assertIsNone(
+            compile_test(test.SubjectContains('hello'), text_search=False))
+        self.assertEqual(
+            (['SEEN'], True),
+            compile_test(test.IsRead(), text_search=False)
+        )
+
+    def test_untranslatable_test(self):
+        self.assertIsNone(compile_test(UntranslatableTest()))
+
+
+class CompileAggregateTests(TestCase):
+
+    def test_and_concatenates(self):
+        self.assertEqual(
+            (['SEEN', 'FLAGGED'], True),
+            compile_test(test.And(test.IsRead(), test.IsFlagged()))
+        )
+
+    def test_and_with_untranslatable_test_is_a_superset(self):
+        self.assertEqual(
+            (['SEEN'], False),
+            compile_test(test.And(test.IsRead(), UntranslatableTest()))
+        )
+
+    def test_and_with_only_untranslatable_tests(self):
+        self.assertIsNone(compile_test(test.And(UntranslatableTest())))
+
+    def test_or_nests(self):
+        self.assertEqual(
+            (['OR', ['SEEN'], ['OR', ['FLAGGED'], ['DRAFT']]], True),
+            compile_test(
+                test.Or(test.IsRead(), test.IsFlagged(), test.IsDraft()))
+        )
+
+    def test_or_with_untranslatable_test(self):
+        self.assertIsNone(
+            compile_test(test.Or(test.IsRead(), UntranslatableTest())))
+
+    def test_not_exact(self):
+        self.assertEqual(
+            (['NOT', ['SEEN']], True),
+            compile_test(test.Not(test.IsRead()))
+        )
+
+    def test_not_superset_is_not_translated(self):
+        self.assertIsNone(
+            compile_test(test.Not(test.SubjectContains('hello'))))
+
+    def test_empty_aggregates_match_nothing(self):
+        self.assertEqual((MATCH_NOTHING, True), compile_test(test.And()))
+        self.assertEqual((MATCH_NOTHING, True), compile_test(test.Or()))
+
+
+class CompileRulesTests(TestCase):
+
+    def test_rules_are_ored(self):
+        self.assertEqual(
+            ['OR', ['SEEN'], ['SUBJECT', 'foo']],
+            compile_rules([test.IsRead(), test.SubjectContains('foo')])
+        )
+
+    def test_any_untranslatable_rule_disables_search(self):
+        self.assertIsNone(
+            compile_rules([test.IsRead(), UntranslatableTest()]))
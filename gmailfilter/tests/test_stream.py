@@ -0,0 +1,130 @@
+from imapclient import IMAPClient
+from testtools import TestCase
+
+from gmailfilter._cache import MessageCache
+from gmailfilter._connection import IMAPConnection
+from gmailfilter._stream import FetchStream
+from gmailfilter.tests.imapserver import (
+    FakeIMAPServer,
+    make_messages,
+)
+
+
+class FetchStreamTests(TestCase):
+
+    def get_client(self, count=20):
+        self.server = self.useFixture(
+            FakeIMAPServer({'INBOX': make_messages(count)}))
+        server_info = self.server.server_info(False)
+        client = IMAPClient(
+            server_info.host, port=server_info.port, ssl=False)
+        client.login(server_info.username, server_info.password)
+        self.addCleanup(client.logout)
+        client.select_folder('INBOX')
+        return client
+
+    def test_same_as_fetch(self):
+        client = self.get_client()
+        parts = ['FLAGS', 'INTERNALDATE', 'BODY.PEEK[HEADER]']
+        expected = client.fetch(list(range(1, 21)), parts)
+
+        streamed = dict(
+            FetchStream(client, list(range(1, 21)), range(1, 21), parts))
+
+        self.assertEqual(list(range(1, 21)), list(streamed))
+        for uid, message in streamed.items():
+            self.assertEqual(uid, message.pop(b'UID'))
+            self.assertEqual(expected[uid], message)
+
+    def test_sequence_set(self):
+        client = self.get_client()
+        client.use_uid = False
+        streamed = list(FetchStream(client, '3:5', [3, 4, 5], ['UID']))
+        self.assertEqual([3, 4, 5], [msg_id for msg_id, _ in streamed])
+        self.assertEqual([3, 4, 5], [parts[b'UID'] for _, parts in streamed])
+
+    def test_yields_before_the_end(self):
+        client = self.get_client()
+        stream = FetchStream(
+            client, list(range(1, 21)), range(1, 21), ['BODY.PEEK[HEADER]'])
+        total = sum(
+            len(m.header) for m in self.server.folders['INBOX'].messages)
+        messages = iter(stream)
+        next(messages)
+        self.assertLess(stream.size_bytes, total / 2)
+
+    def test_other_commands_wait_for_the_stream(self):
+        client = self.get_client()
+        stream = iter(FetchStream(client, [1, 2, 3], [1, 2, 3], ['FLAGS']))
+        first = next(stream)
+        header = client.fetch([2], ['BODY.PEEK[HEADER]'])
+        self.assertEqual(
+            [1, 2, 3], [first[0]] + [msg_id for msg_id, _ in stream])
+        self.assertIn(b'BODY[HEADER]', header[2])
+
+    def test_abandoned_stream_is_read(self):
+        client = self.get_client()
+        stream = iter(FetchStream(client, [1, 2, 3], [1, 2, 3], ['FLAGS']))
+        next(stream)
+        stream.close()
+        self.assertEqual([4], list(client.fetch([4], ['FLAGS'])))
+
+    def test_unsolicited_responses_are_dropped(self):
+        client = self.get_client()
+        streamed = list(FetchStream(client, '1:5', [2, 3], ['FLAGS']))
+        self.assertEqual([2, 3], [msg_id for msg_id, _ in streamed])
+
+
+class StreamingScanTests(TestCase):
+
+    def get_connection(self, server, cache=None):
+        connection = IMAPConnection(server.server_info(False), cache)
+        self.addCleanup(connection.close)
+        return connection
+
+    def get_subjects(self, server):
+        return [
+            m.get_header('Subject')[0]
+            for m in server.folders['INBOX'].messages
+        ]
+
+    def test_lazy_fetches_during_a_stream(self):
+        server = self.useFixture(
+            FakeIMAPServer({'INBOX': make_messages(30)}))
+        connection = self.get_connection(server)
+
+        subjects = [m.subject() for m in connection.get_messages(['FLAGS'])]
+
+        self.assertEqual(self.get_subjects(server), subjects)
+
+    def test_streams_cached_messages(self):
+        server = self.useFixture(
+            FakeIMAPServer({'INBOX': make_messages(30)}))
+        cache = MessageCache(':memory:')
+        parts = ['FLAGS', 'BODY.PEEK[HEADER]']
+        list(self.get_connection(server, cache).get_messages(parts))
+        connection = self.get_connection(server, cache)
+        server.reset_stats()
+
+        messages = connection.get_messages(parts)
+        first = next(messages)
+
+        # The stream is still being read:
+        self.assertIn('_command', vars(connection._client._imap))
+        subjects = [first.subject()] + [m.subject() for m in messages]
+        self.assertEqual(self.get_subjects(server), subjects)
+        self.assertNotIn(b'UID FETCH', server.stats.commands)
+
+    def test_messages_missing_from_the_cache_stay_in_order(self):
+        server = self.useFixture(
+            FakeIMAPServer({'INBOX': make_messages(30)}))
+        cache = MessageCache(':memory:')
+        parts = ['FLAGS', 'BODY.PEEK[HEADER]']
+        list(self.get_connection(server, cache).get_messages(parts))
+        cache.retain(range(1, 11))
+        connection = self.get_connection(server, cache)
+
+        subjects = [m.subject() for m in connection.get_messages(parts)]
+
+        self.assertEqual(self.get_subjects(server), subjects)
+        self.assertEqual(30, len(cache.get_parts(range(1, 31))))
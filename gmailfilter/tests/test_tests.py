@@ -13,8 +13,17 @@ from gmailfilter.test import (
     SubjectContains,
     ListId,
     HasFlag,
+    MessageOlderThan,
+    Mismatch,
+    get_required_parts,
+)
+from gmailfilter._message import (
+    DEFAULT_FETCH_PARTS,
+    FLAGS,
+    HEADER,
+    INTERNALDATE,
+    Message,
 )
-from gmailfilter._message import Message
 
 # Let's define some tests that will pass and fail regardless of their input:
 class AlwaysPassingTest(Test):
@@ -29,6 +38,15 @@ class AlwaysFailingTest(Test):
         return False
 
 
+class MismatchingTest(Test):
+
+    def __init__(self, retest_at):
+        self.retest_at = retest_at
+
+    def match(self, message):
+        return Mismatch(self.retest_at)
+
+
 class TestBooleanTests(TestCase, TestFactoryMixin):
 
     def test_and_can_be_Created_without_tests(self):
@@ -179,3 +197,105 @@ class MessageAgeTests(TestCase, TestFactoryMixin):
         now = datetime.datetime(2015, 7, 5)
         # TODO: Figure out how best to mock datetime.now() in the actual test
         # and then complete this test.
+
+    def test_old_message_matches(self):
+        date = datetime.datetime.now() - datetime.timedelta(days=3)
+        message = self.get_email_message(date=date)
+        self.assertTrue(
+            MessageOlderThan(datetime.timedelta(days=2)).match(message))
+
+    def test_young_message_returns_mismatch(self):
+        date = datetime.datetime.now() - datetime.timedelta(days=1)
+        message = self.get_email_message(date=date)
+        result = MessageOlderThan(datetime.timedelta(days=2)).match(message)
+        self.assertFalse(result)
+        self.assertEqual(
+            Mismatch(date + datetime.timedelta(days=2)), result)
+
+
+class MismatchTests(TestCase, TestFactoryMixin):
+
+    T1 = datetime.datetime(2015, 7, 5)
+    T2 = datetime.datetime(2015, 7, 6)
+
+    def test_mismatch_is_falsy(self):
+        self.assertFalse(Mismatch(self.T1))
+
+    def test_and_retests_at_latest_mismatch(self):
+        test = And(
+            MismatchingTest(self.T1),
+            MismatchingTest(self.T2),
+            AlwaysPassingTest()
+        )
+        self.assertEqual(
+            Mismatch(self.T2), test.match(self.get_email_message()))
+
+    def test_and_with_plain_failure_does_not_retest(self):
+        test = And(MismatchingTest(self.T1), AlwaysFailingTest())
+        self.assertIs(False, test.match(self.get_email_message()))
+
+    def test_or_retests_at_earliest_mismatch(self):
+        test = Or(
+            MismatchingTest(self.T2),
+            AlwaysFailingTest(),
+            MismatchingTest(self.T1)
+        )
+        self.assertEqual(
+            Mismatch(self.T1), test.match(self.get_email_message()))
+
+    def test_or_without_mismatches_does_not_retest(self):
+        test = Or(AlwaysFailingTest())
+        self.assertIs(False, test.match(self.get_email_message()))
+
+    def test_not_mismatch_matches(self):
+        test = Not(MismatchingTest(self.T1))
+        self.assertTrue(test.match(self.get_email_message()))
+
+
+class RequiredPartsTests(TestCase):
+
+    def test_default_requires_everything(self):
+        self.assertEqual(
+            set(DEFAULT_FETCH_PARTS),
+            get_required_parts(AlwaysPassingTest())
+        )
+
+    def test_tests_not_inheriting_from_test_require_everything(self):
+        class DuckTest(object):
+            def match(self, message):
+                return True
+
+        self.assertEqual(
+            set(DEFAULT_FETCH_PARTS),
+            get_required_parts(DuckTest())
+        )
+
+    def test_header_tests_require_header(self):
+        for test in (
+            MatchesHeader('Foo'),
+            SubjectContains('foo'),
+            ListId('foo.bar'),
+        ):
+            self.assertEqual({HEADER}, get_required_parts(test))
+
+    def test_flag_test_requires_flags(self):
+        self.assertEqual({FLAGS}, get_required_parts(HasFlag(HasFlag.SEEN)))
+
+    def test_age_test_requires_internaldate(self):
+        self.assertEqual(
+            {INTERNALDATE},
+            get_required_parts(MessageOlderThan(datetime.timedelta(days=1)))
+        )
+
+    def test_aggregate_tests_union_their_children(self):
+        test = And(
+            HasFlag(HasFlag.SEEN),
+            Or(
+                MessageOlderThan(datetime.timedelta(days=1)),
+                Not(HasFlag(HasFlag.FLAGGED))
+            )
+        )
+        self.assertEqual({FLAGS, INTERNALDATE}, get_required_parts(test))
+
+    def test_empty_aggregate_requires_nothing(self):
+        self.assertEqual(set(), get_required_parts(Or()))
@@ -28,7 +28,8 @@ setup(
     author_email='thomi.richards@canonical.com',
     url='http://launchpad.net/gmailfilter',
     packages=['gmailfilter'],
-    install_requires=['IMAPClient==0.13'],
+    python_requires='>=3.9',
+    install_requires=['IMAPClient>=2.2'],
     entry_points={
         'console_scripts': ['gmailfilter = gmailfilter._command:run']
     },